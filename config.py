@@ -7,7 +7,9 @@ class Config:
 		base_path = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
 		local_config_path = os.path.join(base_path,'mount.cfg')
 
-		for config_path in [ "/etc/moodledata-fuse/mount.cfg", local_config_path ]:
+		# where the config is read from, in order; later files override earlier ones
+		self.config_paths = [ "/etc/moodledata-fuse/mount.cfg", local_config_path ]
+		for config_path in self.config_paths:
 			if os.path.isfile(config_path):
 				self.parser.readfp(open(config_path))
 
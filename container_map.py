@@ -0,0 +1,62 @@
+import hashlib
+
+class ContainerMap:
+	"""
+	Maps object names to the Swift containers holding them.
+
+	Unsharded (the default), everything lives in source_bucket. With shard_count > 1 objects are spread over
+	shard_count containers named <source_bucket>_<n>, picked by a stable hash of a key taken from the path:
+		top      the top level directory, so a directory tree always shares one container
+		filedir  like top, except under filedir/ where the first hash level (filedir/xx) is the key, which spreads
+		         Moodle's file pool over all the shards
+	Every object of a folder lands in the same container, so listing a directory never needs more than one.
+
+	While an existing container is resharded (see tool_reshard.py), fallback names it: objects not found in their
+	shard are looked for there.
+
+	Config keys: shard_count, shard_key and shard_fallback_container
+	"""
+	def __init__(self, source_bucket, shard_count=1, shard_key="top", fallback=None):
+		if shard_key not in ("top", "filedir"):
+			raise ValueError("unknown shard_key '%s'" % shard_key)
+		self.source_bucket = source_bucket
+		self.shard_count = shard_count
+		self.shard_key = shard_key
+		self.fallback = fallback
+
+	@staticmethod
+	def from_config(config):
+		shard_count = int(config["shard_count"]) if "shard_count" in config else 1
+		shard_key = config["shard_key"] if "shard_key" in config else "top"
+		fallback = config["shard_fallback_container"] if "shard_fallback_container" in config else None
+		return ContainerMap(config["source_bucket"], shard_count, shard_key, fallback)
+
+	@property
+	def sharded(self):
+		return self.shard_count > 1 or self.fallback is not None
+
+	def containers(self):
+		"""
+		Every container objects are written to
+		"""
+		if self.shard_count <= 1:
+			return [self.source_bucket]
+		return ["%s_%d" % (self.source_bucket, shard) for shard in xrange(self.shard_count)]
+
+	def container(self, path):
+		if self.shard_count <= 1:
+			return self.source_bucket
+		key = self.key(path)
+		if isinstance(key, unicode):
+			key = key.encode('utf-8')
+		shard = int(hashlib.md5(key).hexdigest()[:8], 16) % self.shard_count
+		return "%s_%d" % (self.source_bucket, shard)
+
+	def key(self, path):
+		parts = path.lstrip("/").split("/")
+		if self.shard_key == "filedir" and parts[0] == "filedir" and len(parts) > 2:
+			return "filedir/" + parts[1]
+		if len(parts) == 1:
+			# entries at the top share the root's container
+			return ""
+		return parts[0]
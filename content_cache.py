@@ -0,0 +1,76 @@
+from collections import OrderedDict
+from threading import Lock
+
+import metrics
+
+requests = metrics.counter("content_cache_requests_total", "Reads of small files by result: hit when served from memory")
+bytes_served = metrics.counter("content_cache_bytes_served_total",
+	"Bytes of reads served from memory, i.e. disk reads saved by the content cache")
+evictions = metrics.counter("content_cache_evictions_total", "Files evicted from the content cache to stay within its budget")
+
+class ContentCache:
+	"""
+	Keeps the whole content of small, hot files in memory so reads of them never touch the cache directory.
+
+	Entries are kept in least recently used order and evicted from the old end once their total size passes
+	max_bytes. Each entry remembers the mtime and size of the node it was read from; an entry that does not match the
+	node any more is a miss, so a change that was not explicitly invalidated can not serve stale data.
+
+	Parameters
+		max_bytes: the memory budget for file contents
+		max_file_size: files larger than this are never cached
+	"""
+	def __init__(self, max_bytes, max_file_size=65536):
+		self.max_bytes = max_bytes
+		self.max_file_size = max_file_size
+		self.lock = Lock()
+		# path -> (mtime, size, data)
+		self.entries = OrderedDict()
+		self.size = 0
+		metrics.gauge("content_cache_bytes", "Bytes of file contents held by the content cache", lambda: self.size)
+		metrics.gauge("content_cache_files", "Files held by the content cache", lambda: len(self.entries))
+
+	def accepts(self, node):
+		return node.is_file() and node.size <= self.max_file_size
+
+	def get(self, path, node):
+		"""
+		Returns the content of path if it is cached for the node's current mtime and size, None otherwise
+		"""
+		with self.lock:
+			entry = self.entries.pop(path, None)
+			if entry is None or entry[0] != node.mtime or entry[1] != node.size:
+				if entry is not None:
+					self.size -= len(entry[2])
+				requests.inc(result="miss")
+				return None
+			# back in at the most recently used end
+			self.entries[path] = entry
+		requests.inc(result="hit")
+		return entry[2]
+
+	def put(self, path, mtime, size, data):
+		"""
+		Caches the content of path as read for a node with the given mtime and size
+		"""
+		if len(data) > self.max_file_size:
+			return
+		with self.lock:
+			previous = self.entries.pop(path, None)
+			if previous is not None:
+				self.size -= len(previous[2])
+			self.entries[path] = (mtime, size, data)
+			self.size += len(data)
+			while self.size > self.max_bytes and self.entries:
+				evicted_path, evicted = self.entries.popitem(last=False)
+				self.size -= len(evicted[2])
+				evictions.inc()
+
+	def served(self, length):
+		bytes_served.inc(length)
+
+	def discard(self, path):
+		with self.lock:
+			entry = self.entries.pop(path, None)
+			if entry is not None:
+				self.size -= len(entry[2])
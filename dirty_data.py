@@ -0,0 +1,130 @@
+import logging
+import thread
+import time
+
+from threading import Lock, Condition
+
+import metrics
+
+throttled_writes = metrics.counter("dirty_throttled_writes_total",
+	"Writes that had to wait because more than dirty_max_bytes were waiting to be uploaded")
+throttled_seconds = metrics.counter("dirty_throttled_seconds_total",
+	"Time writes spent waiting for dirty data to be uploaded")
+write_backs = metrics.counter("dirty_write_backs_total",
+	"Uploads started before the file was released, by reason: age or bytes")
+
+# seconds before a file handed to flush may be handed again, if it is still dirty
+FLUSH_RETRY_SECONDS = 60
+
+class DirtyData:
+	"""
+	Accounts for the data written to the cache directory that is not in Swift yet: the size of every dirty file and
+	since when it has been dirty.
+
+	Uploads normally start when a file is released, so a file held open (or a burst of writes faster than the
+	uploads) could pile up any amount of data that exists nowhere but here. With limits set, files dirty for longer
+	than max_age seconds and, while more than max_bytes are dirty, the oldest dirty files are handed to flush (the
+	FileSystem queues their upload) even if they are still open. Writers that find more than max_bytes dirty wait
+	for uploads to make room, for at most max_wait seconds.
+
+	Parameters
+		flush: called with the path of a file whose upload should start now
+		max_bytes: dirty bytes beyond which files are written back and writers wait; None for no limit
+		max_age: seconds a file may stay dirty; None for no limit
+		max_wait: seconds a writer waits for room at most
+		interval: seconds between checks of the limits
+	"""
+	def __init__(self, flush, max_bytes=None, max_age=None, max_wait=30.0, interval=1.0):
+		self.logger = logging.getLogger('fuse')
+		self.flush = flush
+		self.max_bytes = max_bytes
+		self.max_age = max_age
+		self.max_wait = max_wait
+		self.interval = interval
+		self.lock = Lock()
+		self.room = Condition(self.lock)
+		# path -> [size, dirty since]
+		self.files = {}
+		self.bytes = 0
+		# path -> when it was handed to flush
+		self.flushing = {}
+		metrics.gauge("dirty_bytes", "Bytes written to the cache and not yet uploaded", lambda: self.bytes)
+		metrics.gauge("dirty_files", "Files written to the cache and not yet uploaded", lambda: len(self.files))
+		metrics.gauge("dirty_oldest_age_seconds", "Time the oldest dirty file has been waiting to be uploaded",
+			self.oldest_age)
+
+	def start(self):
+		if self.max_bytes is not None or self.max_age is not None:
+			thread.start_new_thread(self._write_back_thread_main, ())
+
+	def written(self, path, size):
+		"""
+		Takes note of a file that is dirty with size bytes. Returns whether more than max_bytes are dirty, in which
+		case the writer should wait_for_room
+		"""
+		with self.lock:
+			entry = self.files.get(path)
+			if entry is None:
+				self.files[path] = [size, time.time()]
+				self.bytes += size
+			else:
+				self.bytes += size - entry[0]
+				entry[0] = size
+			return self.max_bytes is not None and self.bytes > self.max_bytes
+
+	def wait_for_room(self):
+		start = time.time()
+		deadline = start + self.max_wait
+		throttled_writes.inc()
+		with self.lock:
+			while self.bytes > self.max_bytes and time.time() < deadline:
+				self.room.wait(min(1.0, deadline - time.time()))
+		throttled_seconds.inc(time.time() - start)
+
+	def cleaned(self, path):
+		"""
+		Forgets a file that is in Swift now, or no longer exists
+		"""
+		with self.lock:
+			entry = self.files.pop(path, None)
+			self.flushing.pop(path, None)
+			if entry is not None:
+				self.bytes -= entry[0]
+				self.room.notify_all()
+
+	def oldest_age(self):
+		with self.lock:
+			if not self.files:
+				return 0
+			return time.time() - min(since for size, since in self.files.itervalues())
+
+	def _due(self):
+		"""
+		The files to write back now, with the reason
+		"""
+		now = time.time()
+		due = []
+		with self.lock:
+			candidates = sorted((since, path, size) for path, (size, since) in self.files.iteritems()
+				if now - self.flushing.get(path, 0) > FLUSH_RETRY_SECONDS)
+			excess = self.bytes - self.max_bytes if self.max_bytes is not None else 0
+			for since, path, size in candidates:
+				if self.max_age is not None and now - since > self.max_age:
+					due.append((path, "age"))
+				elif excess > 0:
+					due.append((path, "bytes"))
+				else:
+					break
+				excess -= size
+				self.flushing[path] = now
+		return due
+
+	def _write_back_thread_main(self):
+		while True:
+			time.sleep(self.interval)
+			for path, reason in self._due():
+				try:
+					write_backs.inc(reason=reason)
+					self.flush(path)
+				except Exception, e:
+					self.logger.error("write back of %s failed: %s", path, e)
@@ -3,33 +3,126 @@ import logging
 from collections import deque
 from shutil import copyfile
 from stat import S_IFDIR, S_IFLNK, S_IFREG
-from threading import Lock
+from threading import Lock, BoundedSemaphore, Event
 import thread
+from multiprocessing.pool import ThreadPool
 
 from fuse import FUSE, FuseOSError, Operations, LoggingMixIn, fuse_get_context
 
 from swift_source import SwiftSource
+from container_map import ContainerMap
+from retry_policy import RetryPolicy, CircuitBreaker
 from fsnode import FSNode
 import file_system_cache_init
+import posix_io
+import metrics
+from operation_journal import OperationJournal
+from operation_trace import TraceRecorder
+from metadata_syncer import MetadataSyncer
+from path_rules import PathRules
+from tombstone_batcher import TombstoneBatcher
+from small_file_batcher import SmallFileBatcher
+from content_cache import ContentCache
+from immutable_index import ImmutableIndex
+from dirty_data import DirtyData
+from single_flight import SingleFlight
+
+operation_seconds = metrics.histogram("fuse_operation_seconds", "Latency of FUSE operations by operation")
+operation_errors = metrics.counter("fuse_operation_errors_total", "FUSE operations that failed, by operation")
+kernel_invalidations = metrics.counter("kernel_invalidations_total",
+	"Files whose data changed other than through a write on this mount")
+revalidations = metrics.counter("cache_revalidations_total",
+	"Conditional GETs of cached files by result: not_modified kept the cached copy, modified replaced it")
+immutable_skips = metrics.counter("immutable_skips_total",
+	"Operations on immutable paths that needed no Swift request because the content is known to be there, by operation")
+local_only_operations = metrics.counter("local_only_operations_total",
+	"Operations on local-only paths, which would otherwise have needed Swift requests, by operation")
+cache_requests = metrics.counter("cache_requests_total",
+	"Opens by result: hit when the file was in the local cache, miss when it had to be fetched from Swift")
+write_through_seconds = metrics.histogram("write_through_seconds",
+	"Time flush and fsync waited for the upload of the file in write-through mode")
+
+# times a server-side copy is tried before it is given up on (left outstanding in the journal)
+COPY_ATTEMPTS = 5
 
 class FileSystem(LoggingMixIn, Operations):
-	def __init__(self, config):
+	# operations that change the file system; these are refused on a read-only (snapshot) mount
+	_write_operations = frozenset(['chmod', 'chown', 'create', 'link', 'mkdir', 'mknod', 'rename', 'rmdir',
+		'symlink', 'truncate', 'unlink', 'write'])
+
+	def __init__(self, config, swift_connection=None):
+		"""
+		Parameters
+			config: the mount configuration
+			swift_connection: an object store to use instead of a SwiftSource built from the config, such as the
+			                  LocalSwiftSource stand-in
+		"""
 		self.logger = logging.getLogger('fuse')
-		self.rwlock = Lock()
+		# Data I/O is positional (pread/pwrite) and needs no locking. Metadata changes on a node are serialized by a
+		# small set of striped locks, picked by path, rather than one lock per node.
+		self._node_locks = [Lock() for i in xrange(64)]
 
 		self.config = config
 		self.cache_root = os.path.realpath(config["cache_dir"])
 
-		self.swift_connection = SwiftSource(
-			auth_url=config["swift.auth_url"],
-			username=config["swift.username"],
-			password=config["swift.password"],
-			tenant_id=config["swift.tenant_id"],
-			region_name=config["swift.region_name"],
-			source_bucket=config["source_bucket"])
+		# A mount with a snapshot time is a read-only, point-in-time view of the container. The time is parsed once
+		# here; visibility of every entry is decided once by refresh_from_object_store.
+		self.snapshot_time = None
+		if "snapshot_time" in self.config:
+			self.snapshot_time = time.mktime(dateutil.parser.parse(self.config["snapshot_time"]).timetuple())
+		self.read_only = self.snapshot_time is not None
+
+		# one download (or revalidation) per path at a time, however many threads open it at once
+		self.downloads = SingleFlight("download")
+		# path -> handles opened while its download was running, and the handles whose download then failed: their
+		# file is partial, so reads through them fail rather than return it
+		self.download_handles = {}
+		self.failed_handles = set()
+		self.download_handles_lock = Lock()
+
+		# content under immutable_paths never changes once written (Moodle's filedir)
+		self.immutable = ImmutableIndex(PathRules.from_config(self.config, "immutable_paths"))
+
+		# Paths under local_only_paths (scratch trees such as temp/, cache/ or sessions/) live in the cache directory
+		# alone: they are never uploaded, tombstoned or looked up in Swift
+		self.local_only = PathRules.from_config(self.config, "local_only_paths")
+		FSNode.set_local_only(self.local_only)
+		# directories holding the top of a local-only tree, whose listings have to include what is in the cache
+		self._local_only_parents = frozenset(os.path.dirname(prefix.rstrip("/")) for prefix in self.local_only.prefixes)
+
+		# FUSE runs multithreaded; fuse_threads caps how many operations run in here at once
+		self.operation_slots = None
+		if "fuse_threads" in self.config and int(self.config["fuse_threads"]) > 0:
+			self.operation_slots = BoundedSemaphore(int(self.config["fuse_threads"]))
+
+		# every FUSE operation can optionally be recorded for offline replay
+		self.trace = None
+		if "trace_path" in self.config:
+			hash_paths = "trace_hash_paths" in self.config and self.config["trace_hash_paths"].lower() in ("1", "true", "yes")
+			trace_salt = self.config["trace_salt"] if "trace_salt" in self.config else ""
+			self.trace = TraceRecorder(self.config["trace_path"], hash_paths, trace_salt)
+
+		if swift_connection is not None:
+			self.swift_connection = swift_connection
+		else:
+			self.swift_connection = SwiftSource(
+				auth_url=config["swift.auth_url"],
+				username=config["swift.username"],
+				password=config["swift.password"],
+				tenant_id=config["swift.tenant_id"],
+				region_name=config["swift.region_name"],
+				source_bucket=config["source_bucket"],
+				container_map=ContainerMap.from_config(config),
+				retry_policy=RetryPolicy.from_config(config),
+				circuit_breaker=CircuitBreaker.from_config(config),
+				config=config)
 
 		FSNode.set_swift_connection(self.swift_connection)
-		if self.config["metadata_collection"] == "prefetch":
+		if self.read_only:
+			# the full listing is taken once at mount, so a miss means the entry is not part of the snapshot
+			FSNode.set_remote_lookups(False)
+			self.refresh_from_object_store()
+		elif self.config["metadata_collection"] == "prefetch":
 			self.refresh_from_object_store()
 		else:
 			# initialize cache
@@ -37,17 +130,94 @@ class FileSystem(LoggingMixIn, Operations):
 			node.update_from_cache("/", self.cache_path("/"))
 			node.save()
 		
+		# Cached files older than revalidate_ttl seconds are checked against Swift (a conditional GET on the etag)
+		# when opened, except for paths matching revalidate_never
+		self.revalidate_ttl = float(self.config["revalidate_ttl"]) if "revalidate_ttl" in self.config else None
+		self.revalidate_never = PathRules.from_config(self.config, "revalidate_never")
+		self.revalidate_timeout = float(self.config["revalidate_timeout"]) if "revalidate_timeout" in self.config else 30
+
+		# whole small files can be kept in memory, within content_cache_bytes
+		self.content_cache = None
+		if "content_cache_bytes" in self.config:
+			max_file_size = int(self.config["content_cache_max_file_size"]) if "content_cache_max_file_size" in self.config else 65536
+			self.content_cache = ContentCache(int(self.config["content_cache_bytes"]), max_file_size)
+
+		# nodes of the file handles currently open for writing, by handle
+		self.open_files = {}
 		self.pending_operations = deque()
-		self.job_executor_thread = thread.start_new_thread(self._job_executor_thread_main, ())
+		# number of operations in pending_operations for each path
+		self.queued_paths = {}
+		self.queued_paths_lock = Lock()
+
+		# Operations queued for Swift are journaled so a restart only has to re-queue what never made it
+		self.journal = None
+		if "journal_path" in self.config and not self.read_only:
+			sync_interval = float(self.config["journal_sync_interval"]) if "journal_sync_interval" in self.config else 0.05
+			self.journal = OperationJournal(self.config["journal_path"], sync_interval)
+
+		metrics.gauge("pending_operations", "Operations waiting in the job executor queue",
+			lambda: len(self.pending_operations))
+		metrics.gauge("pending_operation_oldest_age_seconds", "Time the oldest queued operation has been waiting",
+			self._oldest_pending_operation_age)
+
+		# nothing is ever uploaded from a read-only mount, so it has no need for the job executor
+		if not self.read_only:
+			self.job_executor_thread = thread.start_new_thread(self._job_executor_thread_main, ())
+
+		# deletions are sent to Swift in batches
+		self.tombstones = None
+		if not self.read_only:
+			batch_size = int(self.config["tombstone_batch_size"]) if "tombstone_batch_size" in self.config else 100
+			batch_delay = float(self.config["tombstone_batch_delay"]) if "tombstone_batch_delay" in self.config else 0.05
+			self.tombstones = TombstoneBatcher(self.swift_connection, batch_size, batch_delay)
+			self.tombstones.start()
+
+		# files up to bulk_upload_max_size bytes are uploaded together, as bulk-extract archives
+		self.small_files = None
+		if "bulk_upload_max_size" in self.config and not self.read_only:
+			window = float(self.config["bulk_upload_window"]) if "bulk_upload_window" in self.config else 0.2
+			max_files = int(self.config["bulk_upload_max_files"]) if "bulk_upload_max_files" in self.config else 500
+			self.small_files = SmallFileBatcher(self.swift_connection, self.cache_root,
+				int(self.config["bulk_upload_max_size"]), window, max_files)
+			self.small_files.start()
+
+		# write_mode "write-back" (the default) uploads a file once it is released; "write-through" also uploads it on
+		# flush and fsync, which only return once Swift has it
+		self.write_mode = self.config["write_mode"] if "write_mode" in self.config else "write-back"
+		if self.write_mode not in ("write-back", "write-through"):
+			raise ValueError("write_mode must be write-back or write-through")
+		self.write_through_timeout = float(self.config["write_through_timeout"]) if "write_through_timeout" in self.config else 300
+
+		# what has not been uploaded yet, limited to dirty_max_bytes and dirty_max_age
+		max_bytes = int(self.config["dirty_max_bytes"]) if "dirty_max_bytes" in self.config else None
+		max_age = float(self.config["dirty_max_age"]) if "dirty_max_age" in self.config else None
+		max_wait = float(self.config["dirty_max_wait"]) if "dirty_max_wait" in self.config else 30
+		self.dirty_data = DirtyData(self._write_back, max_bytes, max_age, max_wait)
+		if not self.read_only:
+			self.dirty_data.start()
+
+		# picks up changes other mounts of the container make
+		self.metadata_syncer = None
+		if "metadata_sync_interval" in self.config and not self.read_only:
+			self.metadata_syncer = MetadataSyncer(self, float(self.config["metadata_sync_interval"]))
+			self.metadata_syncer.start()
+
+		# last, as replaying uploads and tombstones needs everything above
+		if self.journal is not None:
+			self._recover_journal()
 
 	####### FUSE Functions #######
 
 	### Fuse functions that need to work with the object store
 
 	def chmod(self, path, mode):
-		node = self.get(path)
-		node.mode = mode
-		node.save()
+		if self.immutable.contains(path):
+			immutable_skips.inc(op="chmod")
+			return 0
+		with self.node_lock(path):
+			node = self.get(path)
+			node.mode = mode
+			node.save()
 		# TODO: This has the potential to be quite slow. We may want to send the
 		# operation off to a background process
 		### obj = self.swift_connection.get_object(path)
@@ -55,10 +225,11 @@ class FileSystem(LoggingMixIn, Operations):
 		return 0
 
 	def chown(self, path, uid, gid):
-		node = self.get(path)
-		node.uid = uid
-		node.gid = gid
-		node.save()
+		with self.node_lock(path):
+			node = self.get(path)
+			node.uid = uid
+			node.gid = gid
+			node.save()
 		# TODO: This has the potential to be quite slow. We may want to send the
 		# operation off to a background process
 		### obj = self.swift_connection.get_object(path)
@@ -82,23 +253,27 @@ class FileSystem(LoggingMixIn, Operations):
 		node = self.get_or_create(path)
 		node.update_from_cache(path, self.cache_path(path))
 		node.save()
+		if self.local_only.matches(path):
+			local_only_operations.inc(op="mkdir")
+			return 0
 
-		def callback(success, error_message):
+		def callback(success, error_message, result=None):
 			pass
 
 		def pre_execution():
 			pass
 				
-		args = (node, self.cache_root, callback)
+		args = (node, self.cache_root, self._journaled("upload", path, callback))
 		operation = FileOperation(path, self.swift_connection.update_object, args, pre_execution)
-		self.pending_operations.append(operation)
+		self._queue(operation)
 
 		return 0
 
 	def read(self, path, size, offset, fh):
 		"""
 		Returns the chunk of the file specified.
-		If the file is currently downloading we wait until the request can be fulfilled
+		If the file is currently downloading we wait until the request can be fulfilled. Handles opened while a
+		download ran that then failed get EIO, their file being partial.
 		"""
 		node = self.get(path)
 		cached_file = self.cache_path(path)
@@ -110,96 +285,211 @@ class FileSystem(LoggingMixIn, Operations):
 			#       and time elapsed for download
 			time.sleep(0.1)
 			node = self.get(path) # refresh node object from db
-		if fh:
-			with self.rwlock:
-				os.lseek(fh, offset, 0)
-				return os.read(fh, size)
-		else:
+		if not fh:
 			raise FuseOSError(errno.ENOENT)
+		if fh in self.failed_handles:
+			raise FuseOSError(errno.EIO)
+		if self.content_cache is not None and node.downloading is None and self.content_cache.accepts(node):
+			key = path.lstrip("/")
+			data = self.content_cache.get(key, node)
+			if data is None:
+				# the version is taken before reading, so a write racing with us leaves an entry that never matches
+				mtime, file_size = node.mtime, node.size
+				data = posix_io.pread(fh, file_size, 0)
+				self.content_cache.put(key, mtime, file_size, data)
+			else:
+				self.content_cache.served(min(size, max(0, len(data) - offset)))
+			return data[offset:offset + size]
+		return posix_io.pread(fh, size, offset)
 
 	def readdir(self, path, fh):
+		if self.local_only.matches(path):
+			try:
+				return os.listdir(self.cache_path(path))
+			except OSError, e:
+				raise FuseOSError(errno.ENOENT)
+
 		fsnode = self.get(path)
 
 		if fsnode:
-			return [child_node.name for child_node in fsnode.children()]
+			names = fsnode.child_names()
+			if path.strip("/") in self._local_only_parents:
+				# local-only entries that have not been looked at since the mount are only in the cache
+				folder = path.strip("/")
+				listed = set(names)
+				cached = os.listdir(self.cache_path(path)) if os.path.isdir(self.cache_path(path)) else []
+				for name in cached:
+					if name not in listed and self.local_only.matches(folder + "/" + name if folder else name):
+						names.append(name)
+			return names
 		else:
 			raise FuseOSError(errno.ENOENT)
 
 	def write(self, path, data, offset, fh):
-		# Make sure the path exists to grab the file to.
-		# TODO: make sure to set mode/gid/uid and various times according to what's in the metadata db
-		# as all of these folders should actually have objects and thus database items for them.
-		cache_folder_path = os.path.dirname(self.cache_path(path))
-		if not os.path.exists(cache_folder_path):
-			os.makedirs(cache_folder_path)
-
-		node = self.get(path)
-
-		os.lseek(fh, offset, 0)
-		retval = os.write(fh, data)
+		"""
+		Writes are on the hot path for large files, so all this does is the pwrite and keeping size, mtime and dirty
+		up to date in memory. The cache directory is created by create/open and the node is synced with the cached
+		file's stat once, on flush/release.
+		"""
+		node = self.open_files.get(fh)
+		if node is None:
+			node = self.get(path)
 
-		if node:
-			node.dirty = 1
-			node.save()
+		retval = posix_io.pwrite(fh, data, offset)
+		if self.content_cache is not None:
+			self.content_cache.discard(path.lstrip("/"))
 
-		node.update_from_cache(path, self.cache_path(path))
+		with self.node_lock(path):
+			if offset + retval > node.size:
+				node.size = offset + retval
+			node.mtime = time.time()
+			if node.dirty != 1:
+				node.dirty = 1
+				node.save()
+		if self.dirty_data.written(path.lstrip("/"), node.size):
+			self.dirty_data.wait_for_room()
 		# Strange things happen if you don't return the number of bytes written from this function call.
 		return retval
 
 	def release(self, path, fh):
 		if fh:
+			# forget the handle before closing it; once closed the number can be handed out to another open
+			self.open_files.pop(fh, None)
+			with self.download_handles_lock:
+				self.failed_handles.discard(fh)
+				self.download_handles.get(path.lstrip("/"), set()).discard(fh)
 			os.close(fh)
+		self._upload(path)
+		return 0
 
+	def _upload(self, path, on_done=None):
+		"""
+		Queues the upload of a dirty file. on_done, if given, gets whether the upload succeeded (failed uploads are
+		retried regardless). Returns whether an upload was queued
+		"""
 		node = self.get(path)
-		def callback(success, error_message):
-			node = self.get(path)
+		# the mtime the upload started with; a write since then leaves the node dirty
+		uploaded = {}
+		def callback(success, error_message, result=None):
+			# the node may have been renamed or unlinked while it was uploading
+			node = self.get(path, include_deleted=True)
 			if node is None:
 				self.logger.error("In the callback of release, node should not be none, but it is")
 				return
 			if node.dirty == 1 and node.uploading is not None:
 				node.uploading = None
-				if success:
+				if success and (node.mtime == uploaded.get("mtime") or node.is_deleted()):
 					node.dirty = 0
+					self.dirty_data.cleaned(path.lstrip("/"))
+					# what we uploaded is what is in the cache, so it does not need revalidating
+					node.etag = result["etag"] if result else None
+					node.validated = time.time()
+					if not node.is_deleted():
+						self.immutable.add(path)
 				node.save()
 				if not success:
 					self.logger.error("Upload failed, trying again")
-					self.release(path, fh)
+					# the handle was closed by the first release; retries only re-queue the upload
+					self.release(path, None)
 			elif node.dirty == 1 and node.uploading is None:
-				self.release(path, fh)
+				self.release(path, None)
 			else:
 				# TODO: do we need to do anything if we have an unexpected value for dirty or uploading?
 			  #       I don't think that it's possible to have dirty == 0 and uploading == 1, but what about the case
 				#       that both are 0? Does this possibly indicate that we are in an unexpected state?
 				pass
+			if on_done is not None:
+				on_done(success)
 
 		def pre_execution():
+			uploaded["mtime"] = node.mtime
 			node.uploading = time.time()
 			node.save()
 				
 		if node and node.dirty == 1:
 			node.update_from_cache(path, self.cache_path(path))
+			if self.local_only.matches(path):
+				local_only_operations.inc(op="upload")
+				node.dirty = 0
+				node.save()
+				self.dirty_data.cleaned(path.lstrip("/"))
+				return False
+			if self.immutable.contains(path):
+				# the same content is already in Swift
+				immutable_skips.inc(op="upload")
+				node.dirty = 0
+				node.save()
+				self.dirty_data.cleaned(path.lstrip("/"))
+				return False
 			node.save()
-			args = (node, self.cache_root, callback)
+			self.dirty_data.written(path.lstrip("/"), node.size)
+			if self.small_files is not None and self.small_files.accepts(node):
+				args = (node, self._journaled("upload", path, callback))
+				operation = FileOperation(path, self.small_files.add, args, pre_execution)
+				self._queue(operation)
+				return True
+			# with a complete index an immutable object missing from it is not in Swift, so there is no need to look
+			check_existing = not (self.immutable.complete and self.immutable.covers(path))
+			args = (node, self.cache_root, self._journaled("upload", path, callback), None, check_existing)
 			operation = FileOperation(path, self.swift_connection.update_object, args, pre_execution)
-			self.pending_operations.append(operation)
-		return 0
+			self._queue(operation)
+			return True
+		return False
+
+	def _write_back(self, path):
+		"""
+		Starts the upload of a dirty file ahead of its release (see DirtyData), unless one is already on its way
+		"""
+		node = self.get(path)
+		if node is None or node.dirty != 1:
+			self.dirty_data.cleaned(path.lstrip("/"))
+			return
+		if node.uploading is not None or self.queued_paths.get(path.lstrip("/"), 0) > 0:
+			return
+		if self.immutable.covers(path) and node in self.open_files.values():
+			# an immutable file is uploaded once, when it is complete
+			return
+		with self.node_lock(path):
+			self._upload(path)
+
+	def _upload_and_wait(self, path):
+		"""
+		Uploads a dirty file and waits until Swift has it, for write-through mode
+		"""
+		start = time.time()
+		finished = Event()
+		outcome = {}
+		def on_done(success):
+			outcome["success"] = success
+			finished.set()
+		if not self._upload(path, on_done):
+			return
+		finished.wait(self.write_through_timeout)
+		write_through_seconds.observe(time.time() - start)
+		if not outcome.get("success"):
+			self.logger.error("write-through upload of %s %s", path, "failed" if finished.is_set() else "timed out")
+			raise FuseOSError(errno.EIO)
 
 	def symlink(self, target, source):
 		# TODO: Handle existing symbolic link
-		def callback(success, error_message):
+		def callback(success, error_message, result=None):
 			# TODO: implement callback
 			pass
 		def pre_execution():
 			pass
 				
-		os.symlink(source, self.cache_path(target))
+		path = target
+		os.symlink(source, self.cache_path(path))
 		node = self.get_or_create(path)
 		node.update_from_cache(path, self.cache_path(path))
 		node.save()
+		if self.local_only.matches(path):
+			local_only_operations.inc(op="symlink")
+			return 0
 
-		args = (node, self.cache_root, callback)
+		args = (node, self.cache_root, self._journaled("upload", path, callback))
 		operation = FileOperation(path, self.swift_connection.update_object, args, pre_execution)
-		self.pending_operations.append(operation)
+		self._queue(operation)
 		return 0
 
 	def readlink(self, path):
@@ -211,61 +501,80 @@ class FileSystem(LoggingMixIn, Operations):
 		# TODO: From call traces, it looks like this is what a "delete" turns into. So this is where we should
 		# be able to hook in our metadata tagging instead of actual removal (though we could remove from the
 		# cache as well)
-		def callback(success, error_message):
-			# TODO: Once the metadata is set on the object, we could actually remove it from the sqlite
-			# local store. This may improve operations that need to weed out deleted files.
-			if not success:
-				# TODO: log errors
-				pass
+		if self.content_cache is not None:
+			self.content_cache.discard(path.lstrip("/"))
+		self.dirty_data.cleaned(path.lstrip("/"))
+		if self.local_only.matches(path):
+			local_only_operations.inc(op="unlink")
+			os.unlink(self.cache_path(path))
+			FSNode.forget(path)
+			return 0
 
-		def pre_execution():
+		# the deletion is visible right away; telling Swift is left to _queue_tombstone
+		deletion_time = time.time()
+		with self.node_lock(path):
 			node = self.get(path)
+			if node is None:
+				raise FuseOSError(errno.ENOENT)
 			node.deleted_on = deletion_time
 			node.save()
-			if os.path.exists(self.cache_path(path)):
-				os.unlink(self.cache_path(path))
-
-		deletion_time = time.time()
-		metadata = { "fs-deleted-on": "%f" % deletion_time }
-		args = (path, metadata, callback)
-		operation = FileOperation(path, self.swift_connection.set_object_metadata, args, pre_execution)
-		self.pending_operations.append(operation)
+			# an upload still queued or running reads the cached copy, which then goes with the tombstone queued
+			# behind it
+			upload_pending = node.uploading is not None or self.queued_paths.get(path.lstrip("/"), 0) > 0
+		if not upload_pending and os.path.lexists(self.cache_path(path)):
+			os.unlink(self.cache_path(path))
+		self._queue_tombstone(path, deletion_time, upload_pending)
 
 	def rmdir(self, path):
 		# TODO: From call traces, it looks like this is what a "delete" turns into. So this is where we should
 		# be able to hook in our metadata tagging instead of actual removal (though we could remove from the
 		# cache as well)
-		def callback(success, error_message):
-			# TODO: Once the metadata is set on the object, we could actually remove it from the sqlite
-			# local store. This may improve operations that need to weed out deleted files.
-			if not success:
-				# TODO: log errors
-				pass
-		
-		def pre_execution():
-			pass
+		if self.local_only.matches(path):
+			local_only_operations.inc(op="rmdir")
+			try:
+				os.rmdir(self.cache_path(path))
+			except OSError, e:
+				raise FuseOSError(e.errno)
+			FSNode.forget(path)
+			return 0
 
 		deletion_time = time.time()
 		node = self.get(path)
-		if len(node.children()) > 0:
+		if len(node.child_names()) > 0:
 			raise FuseOSError(errno.ENOTEMPTY)
 		else:
 			node.deleted_on = deletion_time
 			node.save()
 			if os.path.exists(self.cache_path(path)):
 				os.rmdir(self.cache_path(path))
-			metadata = { "fs-deleted-on": "%f" % deletion_time }
-			args = (path, metadata, callback)
-			operation = FileOperation(path, self.swift_connection.set_object_metadata, args, pre_execution)
-			self.pending_operations.append(operation)
+			self._queue_tombstone(path, deletion_time)
 
 
 	def rename(self, old, new):
 		# Note: This function only gets called when we're moving within the Fuse mount. If
 		# external directories are involved, different functions are called.
+		if self.content_cache is not None:
+			self.content_cache.discard(old.lstrip("/"))
+			self.content_cache.discard(new.lstrip("/"))
 		old_node = self.get(old)
 		if old_node is None:
 			return 1
+		if self.local_only.matches(old) and self.local_only.matches(new):
+			local_only_operations.inc(op="rename")
+			os.rename(self.cache_path(old), self.cache_path(new))
+			FSNode.forget(old)
+			FSNode.forget(new)
+			return 0
+		if self.immutable.contains(new) and self.get(new) is not None:
+			# the content is already in Swift under the new name, only the old one has to go
+			immutable_skips.inc(op="rename")
+			self.unlink(old)
+			return 0
+		if not (self.local_only.matches(old) or self.local_only.matches(new)):
+			self._rename_in_swift(old, new, old_node)
+			return 0
+
+		# data moving in or out of a local-only tree has to be uploaded or fetched
 		mode = old_node.mode
 		def pre_execution():
 			pass
@@ -283,7 +592,7 @@ class FileSystem(LoggingMixIn, Operations):
 		else:
 			self.refresh_cache_file(old)
 			operation = FileOperation(old, execute, {}, pre_execution)
-			self.pending_operations.append(operation)
+			self._queue(operation)
 
 		return 0
 
@@ -298,17 +607,21 @@ class FileSystem(LoggingMixIn, Operations):
 			'f_frsize', 'f_namemax'))
 
 	def truncate(self, path, length, fh=None):
-		node = self.get_or_create(path)
-		node.update_from_cache(path, self.cache_path(path))
+		with self.node_lock(path):
+			node = self.get_or_create(path)
+			node.update_from_cache(path, self.cache_path(path))
 
-		if fh:
-			os.ftruncate(fh, length)
-		else:
-			with open(self.cache_path(path), 'r+') as f:
-				f.truncate(length)
+			if fh:
+				os.ftruncate(fh, length)
+			else:
+				with open(self.cache_path(path), 'r+') as f:
+					f.truncate(length)
+			if self.content_cache is not None:
+				self.content_cache.discard(path.lstrip("/"))
 
-		node.dirty = 1
-		node.save()
+			node.dirty = 1
+			node.save()
+		self.dirty_data.written(path.lstrip("/"), length)
 
 	### Fuse functions that we might not really need
 
@@ -317,10 +630,26 @@ class FileSystem(LoggingMixIn, Operations):
 		return 0
 
 	def open(self, path, flags):
+		if self.read_only and flags & (os.O_WRONLY | os.O_RDWR | os.O_APPEND | os.O_TRUNC):
+			raise FuseOSError(errno.EROFS)
 		if not os.path.exists(self.cache_path(path)):
+			if self.local_only.matches(path):
+				raise FuseOSError(errno.ENOENT)
+			cache_requests.inc(result="miss")
 			self.refresh_cache_file(path)
-
-		return os.open(self.cache_path(path), flags)
+		else:
+			cache_requests.inc(result="hit")
+			node = self.get(path)
+			if node is not None and self._needs_revalidation(path, node):
+				self.revalidate_cache_file(path, node)
+
+		fh = os.open(self.cache_path(path), flags)
+		if flags & (os.O_WRONLY | os.O_RDWR):
+			self.open_files[fh] = self.get(path)
+		with self.download_handles_lock:
+			if self.downloads.in_flight(path.lstrip("/")):
+				self.download_handles.setdefault(path.lstrip("/"), set()).add(fh)
+		return fh
 
 	def create(self, path, mode):
 		uid, gid, pid = fuse_get_context()
@@ -339,6 +668,7 @@ class FileSystem(LoggingMixIn, Operations):
 			node.update_from_cache(path, self.cache_path(path))
 
 		node.save()
+		self.open_files[fh] = node
 
 		return fh
 
@@ -350,19 +680,28 @@ class FileSystem(LoggingMixIn, Operations):
 		# TODO: Do we need to implement this? We can't use the python os.fsync method unless we actually
 		# have a valid file handle, and we don't really keep track of them or use them in our implementation.
 		# return os.fsync(fh)
+		node = self.open_files.get(fh)
+		if node is not None and node.dirty == 1:
+			with self.node_lock(path):
+				node.update_from_cache(path, self.cache_path(path))
+				node.save()
 		if fh:
-			return os.fsync(fh)
-		else:
-			return 0
+			os.fsync(fh)
+		if self.write_mode == "write-through" and node is not None and node.dirty == 1:
+			self._upload_and_wait(path)
+		return 0
 
 	def fsync(self, path, datasync, fh):
 		# TODO: Do we need to implement this? We can't use the python os.fsync method unless we actually
 		# have a valid file handle, and we don't really keep track of them or use them in our implementation.
 		# return os.fsync(fh)
 		if fh:
-			return os.fsync(fh)
-		else:
-			return 0
+			os.fsync(fh)
+		if self.write_mode == "write-through":
+			node = self.get(path)
+			if node is not None and node.dirty == 1:
+				self._upload_and_wait(path)
+		return 0
 
 	### Needs more research / implementation thought
 
@@ -408,25 +747,514 @@ class FileSystem(LoggingMixIn, Operations):
 
 	def get(self, path, include_deleted=False):
 		fsnode = FSNode.get_by_path(path)
+		if fsnode is None and self.local_only.matches(path):
+			fsnode = self._load_local_only(path)
 		# Don't return the node if a soft delete has been performed on it
-		if fsnode and (include_deleted or not fsnode.is_deleted(self.snapshot_timestamp())):
+		if fsnode and (include_deleted or not fsnode.is_deleted()):
 			return fsnode
 		else:
 			return None
 
+	def _rename_in_swift(self, old, new, old_node):
+		"""
+		Renames with server-side copies: the cache is renamed locally and Swift copies each object to its new name
+		(tombstoning the old one once the copy exists), so no data goes over the network. A directory is renamed with
+		everything under it, the copies running in parallel on the Swift workers. Entries with changes that have not
+		reached Swift yet are uploaded from the cache instead.
+		"""
+		old = old.strip("/")
+		new = new.strip("/")
+		entries = [(old, new, old_node)]
+		if old_node.is_directory():
+			entries.extend(self._subtree(old, new))
+
+		# What each entry still has to send to Swift is settled before the cache moves: an upload finishing after that
+		# finds no file at the old name, so whatever was not in Swift by then is uploaded again under the new one
+		deletion_time = time.time()
+		renamed = []
+		for old_path, new_path, node in entries:
+			with self.node_lock(old_path):
+				local_changes = node.dirty == 1 or node.uploading is not None
+				# a file created here with no upload queued or running has no object to tombstone
+				never_uploaded = node.is_file() and node.etag is None and node.validated is None and \
+					node.uploading is None and self.queued_paths.get(old_path, 0) == 0
+				partial = node.downloading is not None
+				node.deleted_on = deletion_time
+				node.save()
+			renamed.append((old_path, new_path, node, local_changes, never_uploaded, partial))
+
+		cache_old, cache_new = self.cache_path(old), self.cache_path(new)
+		if os.path.lexists(cache_old):
+			if not os.path.exists(os.path.dirname(cache_new)):
+				os.makedirs(os.path.dirname(cache_new))
+			os.rename(cache_old, cache_new)
+
+		# handles still open for writing follow their file to the new name
+		handles = {}
+		for fh, open_node in self.open_files.items():
+			handles.setdefault(id(open_node), []).append(fh)
+
+		progress = BatchProgress("rename of %s to %s" % (old, new), len(entries), self.logger) if len(entries) > 1 else None
+		for old_path, new_path, node, local_changes, never_uploaded, partial in renamed:
+			if partial and os.path.exists(self.cache_path(new_path)):
+				# a partial copy; the new name downloads its own once the copy is in Swift
+				os.unlink(self.cache_path(new_path))
+			self.dirty_data.cleaned(old_path)
+			new_node = node.renamed(new_path)
+			for fh in handles.get(id(node), ()):
+				self.open_files[fh] = new_node
+			if local_changes:
+				new_node.dirty = 1
+				new_node.save()
+				self.release(new_path, None)
+				if not never_uploaded:
+					self._queue_tombstone(old_path, deletion_time)
+				if progress is not None:
+					progress.done(True)
+			else:
+				new_node.dirty = 0
+				new_node.save()
+				self._queue_copy(new_path, old_path, deletion_time, progress)
+
+	def _subtree(self, old, new):
+		"""
+		Returns (old path, new path, node) for everything under the directory old
+		"""
+		if self.config["metadata_collection"] != "prefetch":
+			# entries of folders nobody has looked at yet are not loaded
+			for obj in self.swift_connection.get_objects(old + "/"):
+				folder, name = FSNode._parse_folder_and_file_from_path(obj.name)
+				if name in FSNode._fsdata.get(folder, {}) or name in FSNode._tombstones.get(folder, {}):
+					continue
+				node = FSNode()
+				node.update_from_swift(obj)
+				if not node.is_deleted():
+					node.save()
+		entries = []
+		prefix = old + "/"
+		for folder in [folder for folder in FSNode._fsdata if folder == old or folder.startswith(prefix)]:
+			for name, node in FSNode._fsdata[folder].items():
+				if name == "":
+					continue
+				old_path = folder + "/" + name
+				entries.append((old_path, new + old_path[len(old):], node))
+		return entries
+
+	def _queue_copy(self, new, old, deletion_time, progress=None, on_done=None, attempt=1):
+		"""
+		Queues the server-side copy of the object at old to new, followed by the tombstoning of old. on_done, if
+		given, gets whether new made it to Swift, by the copy or by an upload from the cache. A copy whose source is
+		not in Swift fails right away, others after COPY_ATTEMPTS tries
+		"""
+		def callback(success, error_message, result=None):
+			node = self.get(new)
+			if node is None:
+				self.logger.error("%s was removed while it was being copied from %s", new, old)
+				self._queue_tombstone(old, deletion_time)
+				if on_done is not None:
+					on_done(success)
+				return
+			node.uploading = None
+			node.save()
+			if success:
+				if result:
+					node.etag = result["etag"]
+				self.immutable.add(new)
+				self._queue_tombstone(old, deletion_time)
+				if on_done is not None:
+					on_done(True)
+			elif os.path.exists(self.cache_path(new)):
+				self.logger.error("copy of %s to %s failed (%s), uploading it instead", old, new, error_message)
+				node.dirty = 1
+				node.save()
+				if not self._upload(new, on_done) and on_done is not None:
+					on_done(True)
+				self._queue_tombstone(old, deletion_time)
+			elif (result is None or not result.get("source_missing")) and attempt < COPY_ATTEMPTS:
+				self.logger.error("copy of %s to %s failed, trying again: %s", old, new, error_message)
+				self._queue_copy(new, old, deletion_time, progress, on_done, attempt + 1)
+				return
+			else:
+				self.logger.error("copy of %s to %s failed after %d attempts, giving up: %s", old, new, attempt,
+					error_message)
+				if on_done is not None:
+					on_done(False)
+			if progress is not None:
+				progress.done(success)
+
+		def pre_execution():
+			node = self.get(new)
+			if node is not None:
+				node.uploading = time.time()
+				node.save()
+
+		args = (self.get(new), old, self._journaled("copy", new, callback, {"source": old, "deleted_on": deletion_time}))
+		operation = FileOperation(new, self.swift_connection.copy_object, args, pre_execution)
+		self._queue(operation)
+
+	def _queue_tombstone(self, path, deletion_time, remove_cache=False):
+		"""
+		Sends the metadata update marking the object at path deleted, for a node that is already marked locally.
+		Usually this goes to the tombstone batcher, as a POST of the node's full metadata. A node with an upload or
+		another operation still to reach Swift has its tombstone queued behind those instead, as a metadata update
+		that keeps whatever metadata the object has by then. With remove_cache, the cached copy is removed when that
+		update runs, unless the path has been created again since.
+		"""
+		def callback(success, error_message):
+			if not success:
+				self.logger.error("tombstoning %s failed: %s", path, error_message)
+
+		self.immutable.discard(path)
+		node = self.get(path, include_deleted=True)
+		if node is not None and not self._has_swift_work(path, node):
+			metadata = node.swift_metadata()
+			metadata["fs-deleted-on"] = "%f" % deletion_time
+			def batched_callback(success, error_message):
+				if not success:
+					# try again behind anything queued for the path since
+					self.logger.error("tombstoning %s failed, queueing it again: %s", path, error_message)
+					self._queue_tombstone_operation(path, deletion_time, callback)
+			self.tombstones.add(path, metadata, self._journaled("metadata", path, batched_callback, metadata))
+		else:
+			self._queue_tombstone_operation(path, deletion_time, callback, remove_cache)
+
+	def _queue_tombstone_operation(self, path, deletion_time, callback, remove_cache=False):
+		def pre_execution():
+			if not remove_cache:
+				return
+			# the upload queued ahead of the tombstone is done with the cached copy by now
+			node = self.get(path, include_deleted=True)
+			if node is not None and node.deleted_on == deletion_time and os.path.lexists(self.cache_path(path)):
+				os.unlink(self.cache_path(path))
+
+		metadata = { "fs-deleted-on": "%f" % deletion_time }
+		args = (path, metadata, self._journaled("metadata", path, callback, metadata))
+		operation = FileOperation(path, self.swift_connection.set_object_metadata, args, pre_execution)
+		self._queue(operation)
+
+	def _has_swift_work(self, path, node):
+		"""
+		Whether the node has data not yet in Swift, or operations queued or running for it
+		"""
+		return node.dirty == 1 or node.uploading is not None or node.downloading is not None or \
+			self.queued_paths.get(path.lstrip("/"), 0) > 0
+
+	def _queue(self, operation):
+		"""
+		Hands an operation to the job executor
+		"""
+		with self.queued_paths_lock:
+			key = operation.path.lstrip("/")
+			self.queued_paths[key] = self.queued_paths.get(key, 0) + 1
+		self.pending_operations.append(operation)
+
+	def _dequeued(self, operation):
+		with self.queued_paths_lock:
+			key = operation.path.lstrip("/")
+			count = self.queued_paths.get(key, 0) - 1
+			if count > 0:
+				self.queued_paths[key] = count
+			else:
+				self.queued_paths.pop(key, None)
+
+	def _load_local_only(self, path):
+		"""
+		Builds the node of a local-only path from the cache, where it is the only copy
+		"""
+		cache_path = self.cache_path(path)
+		if not os.path.lexists(cache_path):
+			return None
+		node = FSNode()
+		node.update_from_cache(path, cache_path)
+		node.dirty = 0
+		node.save()
+		return node
+
+	def _journaled(self, kind, path, callback, metadata=None):
+		"""
+		Records an operation in the journal and returns a callback that marks it done once Swift has acknowledged it.
+		Failed operations stay outstanding in the journal.
+		"""
+		if self.journal is None:
+			return callback
+		entry_id = self.journal.queued(kind, path.lstrip("/"), metadata)
+		def journaled_callback(success, error_message, *result):
+			# done only after the callback, which may journal follow-up operations
+			try:
+				callback(success, error_message, *result)
+			finally:
+				if success:
+					self.journal.done(entry_id)
+		return journaled_callback
+
+	def _recover_journal(self):
+		"""
+		Re-queues the operations a previous mount journaled but never completed. The operations of a path are replayed
+		in the order they were journaled, only the latest of each kind, and uploads and copies followed by a deletion
+		are dropped rather than bringing the file back. Paths are recovered from a pool of threads, for the lookups
+		involved. The recovered entries are marked done once the re-queued operation has succeeded; those that could
+		not be replayed stay outstanding.
+		"""
+		by_path = {}
+		for record in self.journal.recovered:
+			by_path.setdefault(record["path"], []).append(record)
+		if not by_path:
+			return
+		self.logger.warning("recovering journaled operations of %d paths", len(by_path))
+
+		def recover_path(records):
+			path = records[0]["path"]
+			deletions = [record["id"] for record in records if record["kind"] == "metadata" and
+				"fs-deleted-on" in (record["metadata"] or {})]
+			last_deletion = deletions[-1] if deletions else -1
+			latest = {}
+			entry_ids = {}
+			for record in records:
+				if record["kind"] in ("upload", "copy") and record["id"] < last_deletion:
+					# the file was deleted after this
+					self.journal.done(record["id"])
+					continue
+				latest[record["kind"]] = record
+				entry_ids.setdefault(record["kind"], []).append(record["id"])
+			if last_deletion == records[-1]["id"] and not self.local_only.matches(path) and \
+					os.path.isfile(self.cache_path(path)):
+				# kept by unlink for an upload that is not going to happen now
+				os.unlink(self.cache_path(path))
+			# queued in journal order, so the job executor runs them in that order too
+			for record in sorted(latest.values(), key=lambda record: record["id"]):
+				recover(record, entry_ids[record["kind"]])
+
+		def recover(record, ids):
+			path = record["path"]
+			def finished(success):
+				if success:
+					for entry_id in ids:
+						self.journal.done(entry_id)
+				else:
+					self.logger.error("recovered %s of %s failed, it stays in the journal", record["kind"], path)
+
+			if self.local_only.matches(path):
+				# never meant for Swift
+				finished(True)
+				return
+			try:
+				if record["kind"] == "upload":
+					node = self.get(path)
+					if node is None and os.path.lexists(self.cache_path(path)):
+						node = self.get_or_create(path)
+						node.update_from_cache(path, self.cache_path(path))
+					if node is None or not os.path.lexists(self.cache_path(path)):
+						self.logger.error("can not recover upload of %s, it is not in the cache", path)
+						return
+					node.dirty = 1
+					node.save()
+					if not self._upload(path, finished):
+						# nothing to send after all (see _upload)
+						finished(True)
+				elif record["kind"] == "copy":
+					if self.get(path) is None:
+						self.logger.error("can not recover copy of %s to %s, it is no longer there", record["metadata"]["source"], path)
+						return
+					self._queue_copy(path, record["metadata"]["source"], record["metadata"]["deleted_on"], on_done=finished)
+				else:
+					def callback(success, error_message):
+						if not success:
+							self.logger.error("recovered metadata update of %s failed: %s", path, error_message)
+						finished(success)
+					metadata = record["metadata"]
+					node = self.get(path, include_deleted=True)
+					if node is None and "fs-deleted-on" in metadata:
+						# never made it to Swift, nothing to mark deleted
+						finished(True)
+						return
+					if node is not None and "fs-deleted-on" in metadata:
+						node.deleted_on = float(metadata["fs-deleted-on"])
+						node.save()
+					args = (path, metadata, self._journaled("metadata", path, callback, metadata))
+					operation = FileOperation(path, self.swift_connection.set_object_metadata, args, lambda: None)
+					self._queue(operation)
+			except Exception, e:
+				self.logger.error("recovery of %s failed: %s", path, e)
+
+		threads = int(self.config["journal_recovery_threads"]) if "journal_recovery_threads" in self.config else 16
+		pool = ThreadPool(threads)
+		pool.map(recover_path, by_path.values())
+		pool.close()
+
+	def node_lock(self, path):
+		"""
+		Returns the lock guarding metadata changes to the node at path
+		"""
+		return self._node_locks[hash(path.lstrip("/")) % len(self._node_locks)]
+
 	def cache_path(self, path):
 		return os.path.join(self.cache_root, path.lstrip("/"))
 
+	def apply_remote_change(self, path):
+		"""
+		Brings the node at path up to date with an object another mount added or changed. Nodes with local changes
+		that have not reached Swift yet are left alone. When the data changed, the cached copy is dropped so the next
+		open downloads the new one; an object with the etag the node already has only refreshes its metadata.
+		"""
+		path = path.lstrip("/")
+		if self.local_only.matches(path):
+			return
+		# entries of folders nobody has looked at yet are loaded when they are first needed
+		file_folder, file_name = FSNode._parse_folder_and_file_from_path(path)
+		if file_folder not in FSNode._fsdata:
+			return
+		node = FSNode.loaded(path)
+		if node is not None and self._has_local_changes(node):
+			return
+		try:
+			obj = self.swift_connection.get_object(path)
+		except Exception, e:
+			return
+		with self.node_lock(path):
+			if node is None:
+				node = FSNode()
+				node.update_from_swift(obj)
+				node.save()
+				if not node.is_deleted():
+					self.immutable.add(path)
+				return
+			if self._has_local_changes(node):
+				return
+			previous_mtime, previous_size, previous_etag = node.mtime, node.size, node.etag
+			node.deleted_on = None
+			node.update_from_swift(obj)
+			node.save()
+			if node.is_deleted():
+				self.immutable.discard(path)
+			else:
+				self.immutable.add(path)
+		if node.etag is not None and node.etag == previous_etag:
+			# the same data, often this mount's own upload coming back: only the metadata needed refreshing
+			return
+		# Swift has the times as "%f", which the ones from the cache are not rounded to
+		if ("%f" % node.mtime, node.size, node.etag) != ("%f" % previous_mtime, previous_size, previous_etag):
+			self._drop_cached_copy(path, node)
+			self.invalidate(path, previous_mtime, previous_size)
+
+	def apply_remote_removal(self, path):
+		"""
+		Forgets an object that was removed from the container outright (rather than tombstoned)
+		"""
+		path = path.lstrip("/")
+		if self.local_only.matches(path):
+			return
+		# only what is in memory can be stale; nothing is looked up
+		node = FSNode.loaded(path)
+		if node is None or node.is_deleted() or self._has_local_changes(node):
+			return
+		with self.node_lock(path):
+			node.deleted_on = time.time()
+			node.save()
+		self.immutable.discard(path)
+		self._drop_cached_copy(path, node)
+
+	def _has_local_changes(self, node):
+		return node.dirty == 1 or node.uploading is not None or node.downloading is not None or \
+			node in self.open_files.values()
+
+	def _drop_cached_copy(self, path, node):
+		if self.content_cache is not None:
+			self.content_cache.discard(path.lstrip("/"))
+		cache_path = self.cache_path(path)
+		if node.is_file() and os.path.exists(cache_path):
+			os.unlink(cache_path)
+
+	def invalidate(self, path, previous_mtime, previous_size):
+		"""
+		Called when the data of path changed other than through a write on this mount, once the node holds the new
+		attributes. fusepy uses the libfuse 2 high-level API, which can not push invalidations to the kernel, so we
+		rely on auto_cache instead: the kernel drops cached pages of a file when an open finds a different mtime or
+		size from getattr than when they were cached. A change that kept both is made visible by nudging the mtime.
+		"""
+		if self.content_cache is not None:
+			self.content_cache.discard(path.lstrip("/"))
+		node = self.get(path)
+		if node is None:
+			return
+		kernel_invalidations.inc()
+		if node.mtime == previous_mtime and node.size == previous_size:
+			node.mtime += 0.000001
+			node.save()
+
+	def _needs_revalidation(self, path, node):
+		if self.revalidate_ttl is None or self.read_only or not node.is_file() or node.etag is None:
+			return False
+		if self.immutable.covers(path):
+			return False
+		if self._has_local_changes(node) or self.revalidate_never.matches(path):
+			return False
+		return node.validated is None or time.time() - node.validated > self.revalidate_ttl
+
+	def revalidate_cache_file(self, path, node):
+		"""
+		Checks the cached copy of path against Swift with a conditional GET on its etag: a 304 keeps the copy, a 200
+		replaces it with the new data. Blocks until Swift has answered, or for at most revalidate_timeout seconds
+		after which the cached copy is served as it is. Threads revalidating the same path at once share one GET.
+		"""
+		self.downloads.do(path.lstrip("/"), self._revalidate_cache_file, path, node)
+
+	def _revalidate_cache_file(self, path, node):
+		finished = Event()
+		def callback(success, error_message, result=None):
+			try:
+				node = self.get(path)
+				if node is None:
+					return
+				node.downloading = None
+				if success and result is not None:
+					node.validated = time.time()
+					if result["modified"]:
+						revalidations.inc(result="modified")
+						previous_mtime, previous_size = node.mtime, node.size
+						try:
+							node.update_from_swift(self.swift_connection.get_object(path))
+						except Exception, e:
+							self.logger.error("unable to refresh the metadata of revalidated %s: %s", path, e)
+						node.etag = result["etag"] or node.etag
+						node.save()
+						self.invalidate(path, previous_mtime, previous_size)
+					else:
+						revalidations.inc(result="not_modified")
+				else:
+					self.logger.error("revalidation of %s failed: %s", path, error_message)
+				node.save()
+			finally:
+				finished.set()
+
+		node.downloading = time.time()
+		node.save()
+		self.swift_connection.download_object(path.lstrip("/"), self.cache_path(path), callback, node.etag, node.size)
+		finished.wait(self.revalidate_timeout)
+
 	def refresh_cache_file(self, path):
-		def callback(success, error_message):
+		key = path.lstrip("/")
+		def callback(success, error_message, result=None):
 			# TODO: is there any circumstance that we don't want to clear the downloading field
 			#       in the node?
-			node = self.get(path)
-			node.downloading = None
-			node.save()
-			if not success:
-				# TODO: need to be logging failures and in this case probably retry the download
-				pass
+			try:
+				# before readers stop waiting on downloading
+				with self.download_handles_lock:
+					handles = self.download_handles.pop(key, set())
+					if not success:
+						self.failed_handles.update(handles)
+				node = self.get(path)
+				node.downloading = None
+				if success:
+					node.validated = time.time()
+				node.save()
+				if not success:
+					# transient errors were already retried by the worker; the next open fetches the file again
+					self.logger.error("download of %s failed: %s", path, error_message)
+					# a partial copy would pass for the file on the next open
+					if not node.dirty and os.path.exists(self.cache_path(path)):
+						os.remove(self.cache_path(path))
+			finally:
+				self.downloads.finish(key)
 
 		# Make sure the path exists to grab the file to.
 		# TODO: make sure to set mode/gid/uid and various times according to what's in the metadata db
@@ -445,19 +1273,32 @@ class FileSystem(LoggingMixIn, Operations):
 		if not os.path.exists(cache_folder_path):
 			os.makedirs(cache_folder_path)
 
-		# First we make sure that the file exists so other methods can open it and query the size, ect
-		uid, gid, pid = fuse_get_context()
-		open(self.cache_path(path), 'a').close()
-		os.chown(self.cache_path(path), uid, gid)
-		
-		# Now we mark the node as download in progress
-		node = self.get(path)
-		node.downloading = time.time()
-		node.save()
-		self.swift_connection.download_object(path.lstrip("/"), self.cache_path(path), callback)
+		# a download of the path already running (another open, a rename) fills the same cache file
+		leader = self.downloads.begin(key)
+		try:
+			if leader:
+				# Now we mark the node as download in progress, before the empty file appears, so readers finding
+				# it wait for the data
+				node = self.get(path)
+				node.downloading = time.time()
+				node.save()
+
+			# First we make sure that the file exists so other methods can open it and query the size, ect
+			uid, gid, pid = fuse_get_context()
+			open(self.cache_path(path), 'a').close()
+			os.chown(self.cache_path(path), uid, gid)
+
+			if leader:
+				self.swift_connection.download_object(key, self.cache_path(path), callback, size=node.size)
+		except Exception, e:
+			if leader:
+				self.downloads.finish(key)
+			raise
 
 	def refresh_from_object_store(self):
 		FSNode._fsdata = {}
+		FSNode._tombstones = {}
+		FSNode._pending_deletions = []
 
 		# Add the root node
 		node = FSNode()
@@ -465,48 +1306,105 @@ class FileSystem(LoggingMixIn, Operations):
 		node.save()
 
 		for obj in self.swift_connection.get_objects("/"):
+			if self.local_only.matches(obj.name):
+				continue
 			node = FSNode()
 			node.update_from_swift(obj)
-			if not node.is_deleted(self.snapshot_timestamp()):
+			if self.read_only:
+				if node.is_visible(self.snapshot_time):
+					# a deletion that happened after the snapshot is not part of this view
+					node.deleted_on = None
+					node.save()
+			elif not node.is_deleted():
 				node.save()
-
-
-	def snapshot_timestamp(self):
-		if "snapshot_time" in self.config:
-			return time.mktime(dateutil.parser.parse(self.config["snapshot_time"]).timetuple())
-		else:
-			return None
+				self.immutable.add(node.path)
+		self.immutable.complete = True
 
 	def __call__(self, op, path, *args):
+		if self.read_only and op in self._write_operations:
+			raise FuseOSError(errno.EROFS)
 		# print "calling %s (path: %s | args: %s)" % (op, path, args)
-		retval = super(FileSystem, self).__call__(op, path, *args)
+		start = time.time()
+		try:
+			if self.operation_slots is None:
+				retval = super(FileSystem, self).__call__(op, path, *args)
+			else:
+				with self.operation_slots:
+					retval = super(FileSystem, self).__call__(op, path, *args)
+		except OSError, e:
+			operation_errors.inc(op=op)
+			if self.trace is not None:
+				self.trace.record(op, path, args, start, time.time() - start, error=e.errno)
+			raise
+		finally:
+			operation_seconds.observe(time.time() - start, op=op)
+		if self.trace is not None:
+			self.trace.record(op, path, args, start, time.time() - start, retval)
 
 		# if op != "get":
 		# 	print "retval: %s from %s (path: %s | args: %s)" % (retval, op, path, args)
 
 		return retval
 	
+	def _oldest_pending_operation_age(self):
+		try:
+			return time.time() - self.pending_operations[0].queued_at
+		except IndexError, e:
+			return 0
+
 	def _job_executor_thread_main(self):
 		# TODO: limit the number of attempts
 		while True:
-			print "job deque: " + str(len(self.pending_operations))
 			try:
 				op = self.pending_operations.popleft()
 			except IndexError, e:
 				time.sleep(1)
 				continue
-			node = self.get(op.path)
+			# tombstoning operations run on nodes that are already marked deleted
+			node = self.get(op.path, include_deleted=True)
 			if node is None:
 				time.sleep(1)
 				op.attempt += 1
-				print "node does not exist: %s" % op.path
+				self.logger.debug("node does not exist: %s", op.path)
+				self._dequeued(op)
 				continue
-			if node.uploading is not None or node.downloading is not None:
-				print "upload or download in progress, %s-%s-|" % (str(node.uploading), str(node.downloading))
+			if node.uploading is not None or node.downloading is not None or \
+					self.downloads.in_flight(op.path.lstrip("/")):
+				self.logger.debug("upload or download in progress on %s, %s-%s-|", op.path, node.uploading, node.downloading)
 				self.pending_operations.appendleft(op)
 				continue
-			op.pre_execution()
-			op.operation(*op.operation_args)
+			try:
+				op.pre_execution()
+				op.operation(*op.operation_args)
+			finally:
+				self._dequeued(op)
+
+class BatchProgress:
+	"""
+	Counts the completion of the operations of a batch (such as the copies of a directory rename) and logs progress
+	about every tenth of the way, and once all are done.
+	"""
+	def __init__(self, description, total, logger):
+		self.description = description
+		self.total = total
+		self.logger = logger
+		self.completed = 0
+		self.failed = 0
+		self.started_at = time.time()
+		self.lock = Lock()
+		self.logger.info("%s: %d operations queued", description, total)
+
+	def done(self, success):
+		with self.lock:
+			self.completed += 1
+			if not success:
+				self.failed += 1
+			completed, failed = self.completed, self.failed
+		if completed == self.total:
+			self.logger.info("%s: finished %d operations (%d failed) in %.1fs", self.description, completed, failed,
+				time.time() - self.started_at)
+		elif completed % max(1, self.total / 10) == 0:
+			self.logger.info("%s: %d of %d operations done", self.description, completed, self.total)
 
 class FileOperation:
 	"""
@@ -522,5 +1420,6 @@ class FileOperation:
 		self.operation_args = operation_args
 		self.pre_execution = pre_execution
 		self.attempt = 0
+		self.queued_at = time.time()
 
 
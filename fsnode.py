@@ -1,17 +1,21 @@
-import os, stat, time
+import heapq, os, stat, time
 
 from threading import Lock
 
-import file_system
 from swift_source import SwiftSource
+from single_flight import SingleFlight
 
-class FSNode:
+class FSNode(object):
 	"""
 	FSNode represents either a file, directory. This class will work as is when using in-memory storage for file metadata.
 	To use a different data backend you will likely need to create a subclass and override some methods.
 
+	A mount can hold millions of nodes, so attributes live in __slots__ rather than a per-instance __dict__, folder
+	strings are interned (every node in a directory shares one copy) and the path is derived from folder and name
+	rather than stored.
+
 	Public Attributes:
-		path         string   The full path of the object from the root of the file system
+		path         string   The full path of the object from the root of the file system (read only, derived)
 		name         string   File name
 		folder       string   The folder path (eg. this/is/my/subfolder)
 		link_source  string   Can be None
@@ -27,11 +31,29 @@ class FSNode:
 		downloading  double   (timestamp)   Can be None
 		uploading    double   (timestamp)   Can be None
 		dirty        boolean  Can be None
+		etag         string   The etag of the object in Swift, when known. Can be None
+		validated    double   (timestamp)   When the cached copy was last known to match Swift. Can be None
 	"""
 	# the 'folder' is the key to the root and the value is anonther hash with directory contents where each
-	# value is a FSNode object
+	# value is a FSNode object. Only live entries are kept here; soft deleted entries are moved to _tombstones
+	# (same layout) so listing a directory never has to look at them.
 	_fsdata = {}
+	_tombstones = {}
+	# when disabled, entries missing from _fsdata are not looked up in Swift
+	_remote_lookups = True
+	# PathRules of the local-only paths, which are never looked up in Swift either
+	_local_only = None
+	# (deleted_on, folder, name) for entries with a deletion time still in the future; they stay in _fsdata until
+	# that time passes
+	_pending_deletions = []
 	_swift_connection = None
+	# one HEAD per path at a time; threads looking up the same missing entry wait for its node
+	_lookups = SingleFlight("metadata")
+	# one shared copy of every folder string; the builtin intern() does not accept the unicode names Swift returns
+	_folder_names = {}
+
+	__slots__ = ('name', 'folder', 'link_source', 'mode', 'uid', 'gid', 'nlink', 'size', 'mtime', 'atime', 'ctime',
+		'deleted_on', 'downloading', 'uploading', 'dirty', 'etag', 'validated')
 
 	def __init__(self, deleted_on=None, downloading=None, uploading=None, dirty=None, link_source=None):
 		self.link_source = link_source
@@ -39,6 +61,14 @@ class FSNode:
 		self.dirty = dirty
 		self.downloading = downloading
 		self.uploading = uploading
+		self.etag = None
+		self.validated = None
+
+	@property
+	def path(self):
+		if self.folder:
+			return self.folder + "/" + self.name
+		return self.name
 
 	def attr(self):
 		result = {
@@ -57,14 +87,35 @@ class FSNode:
 	def get_by_path(path):
 		file_folder, file_name = FSNode._parse_folder_and_file_from_path(path.lstrip("/"))
 
+		if not FSNode._remote_lookups or (FSNode._local_only and FSNode._local_only.matches(path)):
+			return FSNode.loaded(path)
+
 		if file_folder not in FSNode._fsdata:
 			FSNode._update_cache_for_object(file_folder)
 		if file_folder in FSNode._fsdata:
 			folder = FSNode._fsdata[file_folder]
-			if file_name not in folder:
-				FSNode._update_cache_for_object(path)
 			if file_name in folder:
 				return folder[file_name]
+			tombstones = FSNode._tombstones.get(file_folder)
+			if tombstones and file_name in tombstones:
+				return tombstones[file_name]
+			FSNode._update_cache_for_object(path)
+			if file_name in folder:
+				return folder[file_name]
+			if file_folder in FSNode._tombstones:
+				return FSNode._tombstones[file_folder].get(file_name)
+		return None
+
+	@staticmethod
+	def loaded(path):
+		"""
+		Returns the entry at path, deleted or not, if it is already in memory; nothing is looked up in Swift
+		"""
+		file_folder, file_name = FSNode._parse_folder_and_file_from_path(path.lstrip("/"))
+		if file_folder in FSNode._fsdata and file_name in FSNode._fsdata[file_folder]:
+			return FSNode._fsdata[file_folder][file_name]
+		if file_folder in FSNode._tombstones:
+			return FSNode._tombstones[file_folder].get(file_name)
 		return None
 
 	def is_directory(self):
@@ -82,60 +133,139 @@ class FSNode:
 		else:
 			return self.deleted_on is not None
 
+	def is_visible(self, as_of_timestamp):
+		"""
+		Whether the entry existed, and was not yet deleted, at the given time. ctime and mtime only ever move forward, so
+		an entry where both are later than the timestamp was created after it.
+		"""
+		if self.is_deleted(as_of_timestamp):
+			return False
+		return min(self.ctime, self.mtime) <= as_of_timestamp
+
 	def delete(self):
 		self.deleted_on = time.time()
+		if hasattr(self, 'folder'):
+			self._index()
 
 	def undelete(self):
 		self.deleted_on = None
+		if hasattr(self, 'folder'):
+			self._index()
+
+	def renamed(self, path):
+		"""
+		Returns a copy of this node at another path, as it is after a rename: the same attributes apart from a new ctime
+		"""
+		file_folder, file_name = FSNode._parse_folder_and_file_from_path(path)
+		node = FSNode(link_source=self.link_source)
+		node.name = file_name
+		node.folder = FSNode._intern_folder(file_folder)
+		node.mode = self.mode
+		node.uid = self.uid
+		node.gid = self.gid
+		node.nlink = self.nlink
+		node.size = self.size
+		node.mtime = self.mtime
+		node.atime = self.atime
+		node.ctime = time.time()
+		node.etag = self.etag
+		node.validated = self.validated
+		return node
+
+	def swift_metadata(self):
+		"""
+		The fs-* metadata the object of this node carries in Swift (without the x-object-meta- prefix)
+		"""
+		metadata = {
+			"fs-mode": "%i" % self.mode,
+			"fs-uid": "%i" % self.uid,
+			"fs-gid": "%i" % self.gid,
+			"fs-mtime": "%f" % self.mtime,
+			"fs-atime": "%f" % self.atime,
+			"fs-ctime": "%f" % self.ctime,
+			"fs-nlink": "%i" % self.nlink,
+			"fs-size": "%i" % self.size
+		}
+		if self.link_source is not None:
+			metadata["fs-link-source"] = self.link_source
+		return metadata
+
+	@staticmethod
+	def forget(path):
+		"""
+		Drops the entry at path, and for a directory everything under it, without leaving a tombstone. This is for
+		entries that never reach Swift, so there is nothing to tell other mounts about.
+		"""
+		path = path.lstrip("/")
+		file_folder, file_name = FSNode._parse_folder_and_file_from_path(path)
+		for table in (FSNode._fsdata, FSNode._tombstones):
+			if file_folder in table:
+				table[file_folder].pop(file_name, None)
+		if path in FSNode._fsdata or path in FSNode._tombstones:
+			prefix = path + "/"
+			for table in (FSNode._fsdata, FSNode._tombstones):
+				for folder in [folder for folder in table if folder == path or folder.startswith(prefix)]:
+					del table[folder]
 
 	def children(self):
+		FSNode._expire_pending_deletions()
 		if self.path in FSNode._fsdata:
 			folder = FSNode._fsdata[self.path]
 		else:
 			return []
-		dir_files = [folder[f] for f in folder.keys() if not f == ""]
-		current_time = time.time()
-		return [fsnode for fsnode in dir_files if not fsnode.deleted_on or fsnode.deleted_on > current_time]
+		return [fsnode for name, fsnode in folder.iteritems() if name != ""]
+
+	def child_names(self):
+		"""
+		Names of the live entries in this directory, without building a list of nodes
+		"""
+		FSNode._expire_pending_deletions()
+		if self.path in FSNode._fsdata:
+			return [name for name in FSNode._fsdata[self.path] if name != ""]
+		else:
+			return []
 
 	def save(self):
 		"""
 		This function should be overridden in any subclass that needs to perform an explicit save to end a transaction or
 		flush changes to disk
 		"""
-		if self.folder in self._fsdata:
-			self._fsdata[self.folder][self.name] = self
-		else:
-			self._fsdata[self.folder] = {self.name: self}
+		self._index()
 		if self.is_directory() and not self.path in FSNode._fsdata:
-			FSNode._fsdata[self.path] = {}
+			FSNode._fsdata[FSNode._intern_folder(self.path)] = {}
 
 	@staticmethod
 	def set_swift_connection(swift_connection):
 		FSNode._swift_connection = swift_connection
 
+	@staticmethod
+	def set_remote_lookups(enabled):
+		FSNode._remote_lookups = enabled
+
+	@staticmethod
+	def set_local_only(rules):
+		FSNode._local_only = rules
+
 	def update_from_cache(self, path, cache_path):
 		# split the file name out from its parent directory
 		file_folder, file_name = FSNode._parse_folder_and_file_from_path(path)
 
 		cached_st = os.lstat(cache_path)
-		cached_attr = dict((key, getattr(cached_st, key)) for key in ('st_atime', 'st_ctime',
-			'st_gid', 'st_mode', 'st_mtime', 'st_nlink', 'st_size', 'st_uid'))
 
 		link_source = None
-		if os.path.islink(cache_path):
+		if stat.S_ISLNK(cached_st.st_mode):
 			link_source = os.readlink(cache_path)
 
-		self.path = path.lstrip("/")
 		self.name = file_name
-		self.folder = file_folder.lstrip("/")
-		self.mode = int(cached_attr['st_mode'])
-		self.uid = int(cached_attr['st_uid'])
-		self.gid = int(cached_attr['st_gid'])
-		self.mtime = float(cached_attr['st_mtime'])
-		self.atime = float(cached_attr['st_atime'])
-		self.ctime = float(cached_attr['st_ctime'])
-		self.nlink = int(cached_attr['st_nlink'])
-		self.size = int(cached_attr['st_size'])
+		self.folder = FSNode._intern_folder(file_folder)
+		self.mode = int(cached_st.st_mode)
+		self.uid = int(cached_st.st_uid)
+		self.gid = int(cached_st.st_gid)
+		self.mtime = float(cached_st.st_mtime)
+		self.atime = float(cached_st.st_atime)
+		self.ctime = float(cached_st.st_ctime)
+		self.nlink = int(cached_st.st_nlink)
+		self.size = int(cached_st.st_size)
 		self.link_source = link_source
 
 	def update_from_swift(self, swift_obj):
@@ -143,13 +273,11 @@ class FSNode:
 
 		# split the file name out from its parent directory
 		file_folder, file_name = FSNode._parse_folder_and_file_from_path(swift_obj.name)
-		if file_folder not in FSNode._fsdata:
-			FSNode._fsdata[file_folder] = {}
-		folder = FSNode._fsdata[file_folder]
 
-		self.path = swift_obj.name.lstrip("/")
 		self.name = file_name
-		self.folder = file_folder.lstrip("/")
+		self.folder = FSNode._intern_folder(file_folder)
+		if self.folder not in FSNode._fsdata:
+			FSNode._fsdata[self.folder] = {}
 		self.mode = int(obj_metadata['x-object-meta-fs-mode'])
 		self.uid = int(obj_metadata['x-object-meta-fs-uid'])
 		self.gid = int(obj_metadata['x-object-meta-fs-gid'])
@@ -159,9 +287,10 @@ class FSNode:
 		self.nlink = int(obj_metadata['x-object-meta-fs-nlink'])
 		self.size = int(obj_metadata['x-object-meta-fs-size'])
 		self.dirty = 0
+		self.etag = getattr(swift_obj, 'etag', None)
 
 		if 'x-object-meta-fs-deleted-on' in obj_metadata:
-			self.deleted_on = obj_metadata['x-object-meta-fs-deleted-on']
+			self.deleted_on = float(obj_metadata['x-object-meta-fs-deleted-on'])
 
 		if 'x-object-meta-fs-link-source' in obj_metadata:
 			self.link_source = obj_metadata['x-object-meta-fs-link-source']
@@ -177,8 +306,50 @@ class FSNode:
 			file_name = path_data[1]
 		return (file_folder, file_name)
 
+	def _index(self):
+		"""
+		Files the node under the live or the tombstoned entries of its folder, according to deleted_on
+		"""
+		if self.folder in self._fsdata:
+			live = self._fsdata[self.folder]
+		else:
+			live = self._fsdata[self.folder] = {}
+		if self.deleted_on is None or self.deleted_on > time.time():
+			live[self.name] = self
+			if self.folder in FSNode._tombstones:
+				FSNode._tombstones[self.folder].pop(self.name, None)
+			if self.deleted_on is not None:
+				heapq.heappush(FSNode._pending_deletions, (self.deleted_on, self.folder, self.name))
+		else:
+			live.pop(self.name, None)
+			if self.folder in FSNode._tombstones:
+				FSNode._tombstones[self.folder][self.name] = self
+			else:
+				FSNode._tombstones[self.folder] = {self.name: self}
+
+	@staticmethod
+	def _expire_pending_deletions():
+		"""
+		Moves entries whose future deletion time has now passed over to the tombstones. Heap entries for nodes that were
+		undeleted (or re-deleted with another time) in the meantime are simply dropped.
+		"""
+		current_time = time.time()
+		while FSNode._pending_deletions and FSNode._pending_deletions[0][0] <= current_time:
+			deleted_on, folder, name = heapq.heappop(FSNode._pending_deletions)
+			node = FSNode._fsdata.get(folder, {}).get(name)
+			if node is not None and node.deleted_on == deleted_on:
+				node._index()
+
+	@staticmethod
+	def _intern_folder(folder):
+		return FSNode._folder_names.setdefault(folder, folder)
+
 	@staticmethod
 	def _update_cache_for_object(path):
+		FSNode._lookups.do(path.lstrip("/"), FSNode._look_up_object, path)
+
+	@staticmethod
+	def _look_up_object(path):
 		file_folder, file_name = FSNode._parse_folder_and_file_from_path(path)
 		try:
 			obj = FSNode._swift_connection.get_object(path)
@@ -188,5 +359,4 @@ class FSNode:
 			node = FSNode()
 			node.update_from_swift(obj)
 			node.save()
-			FSNode._fsdata[file_folder][file_name] = node
 
@@ -0,0 +1,48 @@
+import binascii
+import os
+import string
+
+class ImmutableIndex:
+	"""
+	Paths matching the immutable_paths rules hold content that never changes once written, like Moodle's
+	filedir/xx/yy/<sha1> blobs, which are named after the sha1 of their content. Files under them are never
+	revalidated, and the index remembers which of them are known to be in Swift so a rewrite of one (the same content
+	again) skips the upload altogether.
+
+	Known objects are kept in an exact set rather than a bloom filter: a false positive would skip the upload of a
+	blob that is not in Swift. Names that are a sha1 are stored as their 20 byte digest, anything else by path.
+
+	complete says the index was built from a full listing of the container (prefetch), so uploads of objects missing
+	from it do not HEAD for an existing copy first. Should another mount have stored the object since, the upload
+	just writes the same content again.
+
+	Parameters
+		rules: the PathRules of the immutable paths
+	"""
+	def __init__(self, rules):
+		self.rules = rules
+		self.known = set()
+		self.complete = False
+
+	def covers(self, path):
+		return bool(self.rules) and self.rules.matches(path)
+
+	def add(self, path):
+		if self.covers(path):
+			self.known.add(self._key(path))
+
+	def discard(self, path):
+		if self.covers(path):
+			self.known.discard(self._key(path))
+
+	def contains(self, path):
+		return self.covers(path) and self._key(path) in self.known
+
+	def __len__(self):
+		return len(self.known)
+
+	def _key(self, path):
+		name = os.path.basename(path)
+		if len(name) == 40 and all(c in string.hexdigits for c in name):
+			return binascii.unhexlify(name)
+		return path.lstrip("/")
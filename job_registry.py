@@ -0,0 +1,100 @@
+import logging
+import time
+
+from multiprocessing.pool import ThreadPool
+from threading import Lock, Condition
+
+import metrics
+
+backpressure_waits = metrics.counter("swift_backpressure_waits_total",
+	"Background submissions that had to wait for jobs in flight to drop below the limit")
+backpressure_seconds = metrics.counter("swift_backpressure_wait_seconds_total",
+	"Time background submissions spent waiting for jobs in flight to drop below the limit")
+
+class JobRegistry:
+	"""
+	Keeps every task handed to the SwiftWorkers, with its callback, until its response arrives. Job ids count up
+	from 1 so they never collide, and a job is forgotten as soon as it completes, along with its callback and
+	whatever the callback holds on to (typically an FSNode).
+
+	At most max_in_flight jobs are kept: a background task submitted beyond that waits in register until others
+	complete, which slows down whoever floods the workers (an rm -rf, a sync) instead of queueing without bound.
+	Interactive tasks are never held up.
+
+	Callbacks run on a small pool of threads, so one slow callback does not hold up the responses behind it.
+
+	Parameters
+		max_in_flight: the number of jobs beyond which background submissions wait
+		callback_threads: threads running callbacks
+	"""
+	def __init__(self, max_in_flight=10000, callback_threads=4):
+		self.logger = logging.getLogger('swift')
+		self.max_in_flight = max_in_flight
+		self.lock = Lock()
+		self.capacity = Condition(self.lock)
+		self.next_job_id = 1
+		# job id -> (task, callback, registered at)
+		self.jobs = {}
+		self.pool = ThreadPool(callback_threads)
+		metrics.gauge("swift_tasks_in_flight", "Tasks submitted to the SwiftWorkers and not yet answered",
+			lambda: len(self.jobs))
+		metrics.gauge("swift_oldest_task_age_seconds", "Age of the oldest task not yet answered", self.oldest_age)
+
+	@staticmethod
+	def from_config(config):
+		"""
+		Config keys: swift_max_in_flight and swift_callback_threads
+		"""
+		return JobRegistry(
+			int(config["swift_max_in_flight"]) if "swift_max_in_flight" in config else 10000,
+			int(config["swift_callback_threads"]) if "swift_callback_threads" in config else 4)
+
+	def register(self, task, callback):
+		"""
+		Gives the task its job id and keeps it until complete is called for it. Blocks background tasks while
+		max_in_flight jobs are registered
+		"""
+		with self.lock:
+			if task.is_background() and len(self.jobs) >= self.max_in_flight:
+				backpressure_waits.inc()
+				start = time.time()
+				while len(self.jobs) >= self.max_in_flight:
+					self.capacity.wait()
+				backpressure_seconds.inc(time.time() - start)
+			task.job_id = self.next_job_id
+			self.next_job_id += 1
+			self.jobs[task.job_id] = (task, callback, time.time())
+
+	def task(self, job_id):
+		with self.lock:
+			entry = self.jobs.get(job_id)
+		return entry[0] if entry is not None else None
+
+	def complete(self, job_id):
+		"""
+		Forgets a job. Returns its (task, callback), or None if it had already completed
+		"""
+		with self.lock:
+			entry = self.jobs.pop(job_id, None)
+			if entry is None:
+				return None
+			self.capacity.notify_all()
+		return entry[0], entry[1]
+
+	def run_callback(self, callback, response):
+		self.pool.apply_async(self._run_callback, (callback, response))
+
+	def oldest_age(self):
+		with self.lock:
+			if not self.jobs:
+				return 0
+			return time.time() - min(registered for task, callback, registered in self.jobs.itervalues())
+
+	def _run_callback(self, callback, response):
+		try:
+			if response.result is not None:
+				callback(response.success, response.error_message, response.result)
+			else:
+				callback(response.success, response.error_message)
+		except Exception, e:
+			self.logger.error("error in the callback of %s job %d: %s", response.command, response.job_id, e)
@@ -0,0 +1,232 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tarfile
+import time
+import urllib
+from multiprocessing.pool import ThreadPool
+
+class NoSuchObject(Exception):
+	pass
+
+class LocalSwiftObject(object):
+	'''
+	The parts of a pyrax StorageObject that FSNode and FileSystem use
+	'''
+	def __init__(self, name, metadata, etag, last_modified=None):
+		self.name = name
+		self.metadata = metadata
+		self.etag = etag
+		self.last_modified = last_modified
+
+	def get_metadata(self):
+		return self.metadata
+
+class LocalSwiftSource:
+	"""
+	A stand-in for SwiftSource that keeps the "container" in a local directory, so a FileSystem can be driven offline
+	(trace replay, benchmarks) without a Swift cluster. It has the same interface as SwiftSource: requests that go
+	through SwiftWorkers there run on a small thread pool here and report back through the same callbacks.
+
+	Object data is kept in <root>/data and metadata (the same x-object-meta-* keys Swift returns) in <root>/meta,
+	both under the URL-quoted object name.
+
+	Parameters
+		root: the directory holding the container
+		workers: the number of threads running requests
+		latency: seconds added to every request, to approximate a remote object store
+	"""
+	def __init__(self, root, workers=20, latency=0.0):
+		self.logger = logging.getLogger('swift')
+		self.root = root
+		self.latency = latency
+		self.data_root = os.path.join(root, "data")
+		self.meta_root = os.path.join(root, "meta")
+		for directory in (self.data_root, self.meta_root):
+			if not os.path.exists(directory):
+				os.makedirs(directory)
+		self.num_workers = workers
+		self.pool = ThreadPool(workers)
+
+	def download_object(self, object_name, destination, callback, etag=None, size=None):
+		def download():
+			if etag is None:
+				shutil.copyfile(self._data_path(object_name), destination)
+				return True
+			current_etag = self._etag(object_name)
+			if current_etag == etag:
+				return {"modified": False, "etag": etag}
+			shutil.copyfile(self._data_path(object_name), destination + ".download")
+			os.rename(destination + ".download", destination)
+			return {"modified": True, "etag": current_etag}
+		self._run(callback, download)
+
+	def get_object(self, path, cached=False):
+		name = path.lstrip("/")
+		if self.latency:
+			time.sleep(self.latency)
+		if not os.path.exists(self._meta_path(name)):
+			raise NoSuchObject(name)
+		return self._object(name)
+
+	def get_objects(self, path):
+		prefix = path.lstrip("/")
+		names = sorted(urllib.unquote(quoted) for quoted in os.listdir(self.meta_root))
+		return [self._object(name) for name in names if name.startswith(prefix)]
+
+	def list_objects(self, marker=None, limit=10000):
+		names = sorted(urllib.unquote(quoted) for quoted in os.listdir(self.meta_root))
+		if marker is not None:
+			names = [name for name in names if name > marker]
+		return [self._object(name) for name in names[:limit]]
+
+	def copy_object(self, fsnode, source_path, callback):
+		def copy():
+			source_name = source_path.lstrip("/")
+			object_name = fsnode.path.lstrip("/")
+			if not os.path.exists(self._meta_path(source_name)):
+				return {"success": False, "source_missing": True}
+			metadata = self._read_metadata(source_name)
+			metadata.update(self._prefixed(fsnode.swift_metadata()))
+			shutil.copyfile(self._data_path(source_name), self._data_path(object_name))
+			self._write_metadata(object_name, metadata)
+			return {"etag": self._etag(object_name)}
+		self._run(callback, copy)
+
+	def set_object_metadata(self, path, metadata, callback):
+		def set_metadata():
+			name = path.lstrip("/")
+			if not os.path.exists(self._meta_path(name)):
+				return False
+			stored = self._read_metadata(name)
+			stored.update(self._prefixed(metadata))
+			self._write_metadata(name, stored)
+			return True
+		self._run(callback, set_metadata)
+
+	def extract_archive(self, archive_path, object_names, callback):
+		"""
+		Emulates Swift's bulk extract: every file in the tar archive becomes an object, with metadata from its
+		user.meta.* extended attributes
+		"""
+		def extract():
+			failed = []
+			archive = tarfile.open(archive_path, encoding="utf-8")
+			try:
+				for member in archive:
+					if not member.isfile():
+						continue
+					name = member.name.lstrip("/")
+					try:
+						with open(self._data_path(name), 'wb') as fp:
+							shutil.copyfileobj(archive.extractfile(member), fp)
+						metadata = dict((key[len("SCHILY.xattr.user.meta."):], value) for key, value in
+							member.pax_headers.iteritems() if key.startswith("SCHILY.xattr.user.meta."))
+						self._write_metadata(name, self._prefixed(metadata))
+					except Exception, e:
+						failed.append(name)
+			finally:
+				archive.close()
+			return {"failed": failed}
+		self._run(callback, extract)
+
+	def set_objects_metadata(self, objects, callback):
+		def set_metadata():
+			failed = []
+			for path, metadata in objects:
+				name = path.lstrip("/")
+				try:
+					if os.path.exists(self._meta_path(name)):
+						self._write_metadata(name, self._prefixed(metadata))
+				except Exception, e:
+					failed.append(name)
+			return {"failed": failed}
+		self._run(callback, set_metadata)
+
+	def update_object(self, fsnode, cache_root, callback, md5sum = None, check_existing = True):
+		source_path = os.path.join(cache_root, fsnode.path.lstrip("/"))
+		metadata = fsnode.swift_metadata()
+		if os.path.islink(source_path):
+			metadata["fs-link-source"] = fsnode.link_source
+		object_name = fsnode.path.lstrip("/")
+		def create():
+			self.put_object(object_name, source_path if os.path.isfile(source_path) else None, metadata)
+			return {"etag": self._etag(object_name)}
+		self._run(callback, create)
+
+	def put_object(self, object_name, source_path, metadata):
+		"""
+		Stores an object directly. source_path can be None for an empty object
+		"""
+		name = object_name.lstrip("/")
+		if source_path is None:
+			open(self._data_path(name), 'w').close()
+		else:
+			shutil.copyfile(source_path, self._data_path(name))
+		self._write_metadata(name, self._prefixed(metadata))
+
+	def terminate_workers(self):
+		self.pool.close()
+		self.pool.join()
+
+	def _run(self, callback, function):
+		def task():
+			if self.latency:
+				time.sleep(self.latency)
+			result = None
+			try:
+				success = function()
+				if isinstance(success, dict):
+					# a result, which may say that the request failed
+					result, success = success, success.pop("success", True)
+				error_message = None if success else "request failed"
+			except Exception, e:
+				success = False
+				error_message = str(e)
+			try:
+				if result is not None:
+					callback(success, error_message, result)
+				else:
+					callback(success, error_message)
+			except Exception, e:
+				self.logger.error("error in callback: %s", e)
+		self.pool.apply_async(task)
+
+	def _etag(self, name):
+		md5 = hashlib.md5()
+		with open(self._data_path(name.lstrip("/")), 'rb') as fp:
+			for chunk in iter(lambda: fp.read(1024 * 1024), ""):
+				md5.update(chunk)
+		return md5.hexdigest()
+
+	def _object(self, name):
+		metadata = self._read_metadata(name)
+		# formatted like the last_modified of a Swift listing
+		modified = os.stat(self._meta_path(name)).st_mtime
+		last_modified = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(modified)) + ".%06d" % (modified % 1 * 1000000)
+		return LocalSwiftObject(name, metadata, self._etag(name), last_modified)
+
+	def _prefixed(self, metadata):
+		result = {}
+		for key, value in metadata.iteritems():
+			key = key.lower()
+			if not key.startswith("x-object-meta-"):
+				key = "x-object-meta-" + key
+			result[key] = value
+		return result
+
+	def _read_metadata(self, name):
+		with open(self._meta_path(name), 'r') as fp:
+			return json.load(fp)
+
+	def _write_metadata(self, name, metadata):
+		with open(self._meta_path(name), 'w') as fp:
+			json.dump(metadata, fp)
+
+	def _data_path(self, name):
+		return os.path.join(self.data_root, urllib.quote(name, safe=""))
+
+	def _meta_path(self, name):
+		return os.path.join(self.meta_root, urllib.quote(name, safe=""))
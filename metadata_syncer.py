@@ -0,0 +1,81 @@
+import logging
+import thread
+import time
+
+import metrics
+
+changes_applied = metrics.counter("metadata_sync_changes_total", "Changes to the container picked up by the metadata syncer, by kind")
+poll_seconds = metrics.histogram("metadata_sync_poll_seconds", "Time taken by one metadata syncer poll of the container listing",
+	buckets=(0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0))
+
+class MetadataSyncer:
+	"""
+	Keeps the metadata of a mount coherent with changes made by other mounts of the same container.
+
+	Every interval seconds the container listing is read page by page (marker pagination) and the etag and
+	last_modified of each object compared with the previous poll. Only objects that were added, rewritten or had
+	their metadata changed (a tombstone is a metadata POST, which moves last_modified) are handed to the file
+	system, which HEADs just those. Unlike refresh_from_object_store, this never fetches the metadata of unchanged
+	objects.
+
+	The first poll only records the state of the container; changes made between mounting and that poll are not
+	seen, which is why it runs as soon as the syncer starts.
+
+	Parameters
+		file_system: the FileSystem to apply changes to (see FileSystem.apply_remote_change)
+		interval: seconds between the end of one poll and the start of the next
+		page_size: objects per listing request
+	"""
+	def __init__(self, file_system, interval=30, page_size=10000):
+		self.logger = logging.getLogger('fuse')
+		self.file_system = file_system
+		self.interval = interval
+		self.page_size = page_size
+		# object name -> hash of (etag, last_modified), which is all we need to notice a change
+		self.known = None
+
+	def start(self):
+		thread.start_new_thread(self._sync_thread_main, ())
+
+	def poll(self):
+		"""
+		Reads the whole listing once and applies what changed since the previous poll. Returns the number of changes
+		"""
+		start = time.time()
+		current = {}
+		changed = []
+		marker = None
+		while True:
+			page = self.file_system.swift_connection.list_objects(marker, self.page_size)
+			for obj in page:
+				state = hash((obj.etag, obj.last_modified))
+				current[obj.name] = state
+				if self.known is not None and self.known.get(obj.name) != state:
+					changed.append(obj.name)
+			if len(page) < self.page_size:
+				break
+			marker = page[-1].name
+
+		removed = []
+		if self.known is not None:
+			removed = [name for name in self.known if name not in current]
+		self.known = current
+
+		for name in changed:
+			changes_applied.inc(kind="changed")
+			self.file_system.apply_remote_change(name)
+		for name in removed:
+			changes_applied.inc(kind="removed")
+			self.file_system.apply_remote_removal(name)
+		poll_seconds.observe(time.time() - start)
+		if changed or removed:
+			self.logger.info("metadata sync applied %d changed and %d removed objects", len(changed), len(removed))
+		return len(changed) + len(removed)
+
+	def _sync_thread_main(self):
+		while True:
+			try:
+				self.poll()
+			except Exception, e:
+				self.logger.error("metadata sync failed: %s", e)
+			time.sleep(self.interval)
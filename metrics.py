@@ -0,0 +1,199 @@
+import bisect
+import logging
+import os
+import thread
+import time
+import BaseHTTPServer
+import SocketServer
+
+from threading import Lock
+
+'''
+Low overhead instrumentation for the mount: counters, gauges and latency histograms kept in process and rendered in
+the Prometheus text exposition format by a small HTTP server on a local TCP port or Unix socket.
+
+Metrics are registered once, at module level, where they are used:
+	requests = metrics.counter("fuse_requests_total", "Requests by operation")
+	requests.inc(op="read")
+'''
+
+# bucket upper bounds in seconds, from 50us to 30s
+DEFAULT_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+	1.0, 2.5, 5.0, 10.0, 30.0)
+
+_metrics = []
+_metrics_lock = Lock()
+
+def _label_key(labels):
+	return tuple(sorted(labels.iteritems()))
+
+def _format_labels(label_key, extra=()):
+	pairs = list(label_key) + list(extra)
+	if not pairs:
+		return ""
+	return "{%s}" % ",".join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in pairs)
+
+class Counter:
+	def __init__(self, name, description):
+		self.name = name
+		self.description = description
+		self.kind = "counter"
+		self.lock = Lock()
+		self.values = {}
+
+	def inc(self, amount=1, **labels):
+		key = _label_key(labels)
+		with self.lock:
+			self.values[key] = self.values.get(key, 0) + amount
+
+	def value(self, **labels):
+		return self.values.get(_label_key(labels), 0)
+
+	def samples(self):
+		with self.lock:
+			return [(self.name + _format_labels(key), value) for key, value in self.values.items()]
+
+class Gauge:
+	"""
+	A gauge is either set explicitly or, when a function is given, read from that function at render time
+	"""
+	def __init__(self, name, description, function=None):
+		self.name = name
+		self.description = description
+		self.kind = "gauge"
+		self.function = function
+		self.lock = Lock()
+		self.values = {}
+
+	def set(self, value, **labels):
+		with self.lock:
+			self.values[_label_key(labels)] = value
+
+	def samples(self):
+		if self.function is not None:
+			return [(self.name, self.function())]
+		with self.lock:
+			return [(self.name + _format_labels(key), value) for key, value in self.values.items()]
+
+class Histogram:
+	def __init__(self, name, description, buckets=DEFAULT_BUCKETS):
+		self.name = name
+		self.description = description
+		self.kind = "histogram"
+		self.buckets = tuple(buckets)
+		self.lock = Lock()
+		# label key -> [per bucket counts (last one is +Inf), sum, count]
+		self.values = {}
+
+	def observe(self, value, **labels):
+		key = _label_key(labels)
+		index = bisect.bisect_left(self.buckets, value)
+		with self.lock:
+			if key not in self.values:
+				self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+			entry = self.values[key]
+			entry[0][index] += 1
+			entry[1] += value
+			entry[2] += 1
+
+	def time(self, **labels):
+		return _Timer(self, labels)
+
+	def samples(self):
+		result = []
+		with self.lock:
+			for key, (counts, total, count) in self.values.items():
+				cumulative = 0
+				for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+					cumulative += bucket_count
+					result.append((self.name + "_bucket" + _format_labels(key, [("le", bound)]), cumulative))
+				result.append((self.name + "_sum" + _format_labels(key), total))
+				result.append((self.name + "_count" + _format_labels(key), count))
+		return result
+
+class _Timer:
+	def __init__(self, histogram, labels):
+		self.histogram = histogram
+		self.labels = labels
+
+	def __enter__(self):
+		self.start = time.time()
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.histogram.observe(time.time() - self.start, **self.labels)
+		return False
+
+def _register(metric):
+	with _metrics_lock:
+		_metrics.append(metric)
+	return metric
+
+def counter(name, description):
+	return _register(Counter(name, description))
+
+def gauge(name, description, function=None):
+	return _register(Gauge(name, description, function))
+
+def histogram(name, description, buckets=DEFAULT_BUCKETS):
+	return _register(Histogram(name, description, buckets))
+
+def render():
+	"""
+	Returns every registered metric in the Prometheus text exposition format
+	"""
+	lines = []
+	with _metrics_lock:
+		metrics = list(_metrics)
+	for metric in metrics:
+		try:
+			samples = metric.samples()
+		except Exception, e:
+			logging.getLogger('fuse').error("unable to collect metric %s: %s", metric.name, e)
+			continue
+		lines.append("# HELP %s %s" % (metric.name, metric.description))
+		lines.append("# TYPE %s %s" % (metric.name, metric.kind))
+		for sample_name, value in samples:
+			lines.append("%s %s" % (sample_name, repr(float(value))))
+	return "\n".join(lines) + "\n"
+
+class _MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	def do_GET(self):
+		if self.path.split("?", 1)[0] not in ("/", "/metrics"):
+			self.send_error(404)
+			return
+		body = render()
+		self.send_response(200)
+		self.send_header("Content-Type", "text/plain; version=0.0.4")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		# scrapes are frequent and the client address of a Unix socket can not be formatted
+		pass
+
+class _ThreadedHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+
+class _ThreadedUnixHTTPServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+	daemon_threads = True
+
+	def server_bind(self):
+		SocketServer.UnixStreamServer.server_bind(self)
+		# attributes BaseHTTPRequestHandler expects from an HTTPServer
+		self.server_name = "localhost"
+		self.server_port = 0
+
+def start_server(address="127.0.0.1", port=None, socket_path=None):
+	"""
+	Serves the metrics on either a TCP port or a Unix socket from a background thread
+	"""
+	if socket_path is not None:
+		if os.path.exists(socket_path):
+			os.unlink(socket_path)
+		server = _ThreadedUnixHTTPServer(socket_path, _MetricsRequestHandler)
+	else:
+		server = _ThreadedHTTPServer((address, port), _MetricsRequestHandler)
+	thread.start_new_thread(server.serve_forever, ())
+	return server
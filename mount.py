@@ -5,14 +5,65 @@ from sys import argv, exit
 from fuse import FUSE
 from file_system import FileSystem
 import logging, logging.config
+import metrics
 
 from config import Config
 
+def fuse_options(config, file_system):
+	"""
+	Builds the FUSE mount options from the config:
+		fuse.attr_timeout, fuse.entry_timeout, fuse.negative_timeout
+			seconds the kernel may cache attributes, name lookups and failed lookups without asking getattr again
+		fuse.kernel_cache
+			"auto_cache" keeps file pages in the page cache across opens and drops them when an open finds a different
+			mtime or size than when they were cached; "kernel_cache" keeps them unconditionally; "none" (default)
+			drops them on every open
+		fuse.max_read, fuse.max_write
+			the largest read and write requests the kernel sends us, in bytes
+	A snapshot mount never changes, so it defaults to caching everything for an hour.
+	"""
+	options = {"foreground": True, "allow_other": True}
+	# FUSE dispatches operations from multiple threads unless fuse_threads is 1; FileSystem caps the concurrency
+	# at fuse_threads otherwise
+	if "fuse_threads" in config and int(config["fuse_threads"]) == 1:
+		options["nothreads"] = True
+
+	kernel_cache = "none"
+	if file_system.read_only:
+		options.update(ro=True, attr_timeout=3600, entry_timeout=3600, negative_timeout=3600)
+		kernel_cache = "kernel_cache"
+
+	for timeout in ("attr_timeout", "entry_timeout", "negative_timeout"):
+		if "fuse." + timeout in config:
+			options[timeout] = float(config["fuse." + timeout])
+	if "fuse.kernel_cache" in config:
+		kernel_cache = config["fuse.kernel_cache"]
+	if kernel_cache in ("auto_cache", "kernel_cache"):
+		options[kernel_cache] = True
+	elif kernel_cache != "none":
+		raise ValueError("fuse.kernel_cache must be one of auto_cache, kernel_cache or none")
+
+	if "fuse.max_read" in config:
+		options["max_read"] = int(config["fuse.max_read"])
+	if "fuse.max_write" in config:
+		options["max_write"] = int(config["fuse.max_write"])
+		# without big_writes libfuse 2 splits writes into 4KB requests regardless of max_write
+		options["big_writes"] = True
+	return options
+
 if __name__ == '__main__':
 	if len(argv) == 2:
 		md_config = Config(argv[1])
 	else:
 		md_config = Config()
 	logging.config.fileConfig('logging.conf')
-	fuse = FUSE(FileSystem(md_config), md_config["mount_dir"], foreground=True, allow_other=True)
+	file_system = FileSystem(md_config)
+	if "metrics_socket" in md_config:
+		metrics.start_server(socket_path=md_config["metrics_socket"])
+	elif "metrics_port" in md_config:
+		metrics_address = md_config["metrics_address"] if "metrics_address" in md_config else "127.0.0.1"
+		metrics.start_server(metrics_address, int(md_config["metrics_port"]))
+	# the throttle.* limits can be changed on a running mount by editing the config
+	file_system.swift_connection.throttle.watch(lambda: Config(md_config.section), md_config.config_paths)
+	fuse = FUSE(file_system, md_config["mount_dir"], **fuse_options(md_config, file_system))
 
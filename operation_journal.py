@@ -0,0 +1,145 @@
+import json
+import logging
+import os
+import time
+import thread
+
+from threading import Lock
+
+class OperationJournal:
+	"""
+	An append-only journal of the operations queued for Swift, so that after a crash or restart we know exactly
+	which paths never made it to the object store and only those need to be re-queued.
+
+	Each line of the journal file is a JSON object. An operation is written when it is queued:
+		{"id": 12, "event": "queued", "kind": "upload", "path": "a/b.txt", "metadata": null, "time": 1400000000.0}
+	and again once Swift has acknowledged it:
+		{"id": 12, "event": "done"}
+	Anything queued without a matching "done" is still outstanding.
+
+	Writes are buffered and made durable in groups: a background thread fsyncs the file every sync_interval seconds
+	if anything was written since the last sync. Once the file holds many more lines than there are outstanding
+	operations it is compacted, i.e. rewritten with only the outstanding operations.
+
+	Parameters
+		journal_path: the journal file, created if it does not exist
+		sync_interval: seconds between group fsyncs
+		compact_after: the minimum number of lines in the file before compaction is considered
+	"""
+	def __init__(self, journal_path, sync_interval=0.05, compact_after=100000):
+		self.logger = logging.getLogger('fuse')
+		self.journal_path = journal_path
+		self.sync_interval = sync_interval
+		self.compact_after = compact_after
+		self.lock = Lock()
+
+		self.pending = {}
+		self.next_id = 0
+		self.lines = 0
+		self._load()
+		# whatever is outstanding now was left over by a previous mount
+		self.recovered = sorted(self.pending.values(), key=lambda record: record["id"])
+
+		self.fp = open(self.journal_path, 'a')
+		self.unsynced = 0
+		self.sync_thread = thread.start_new_thread(self._sync_thread_main, ())
+
+	def queued(self, kind, path, metadata=None):
+		"""
+		Records an operation as queued and returns its journal id
+		"""
+		with self.lock:
+			entry_id = self.next_id
+			self.next_id += 1
+			record = {"id": entry_id, "event": "queued", "kind": kind, "path": path, "metadata": metadata,
+				"time": time.time()}
+			self.pending[entry_id] = record
+			self._write(record)
+		return entry_id
+
+	def done(self, entry_id):
+		"""
+		Records the operation with the given journal id as acknowledged by Swift
+		"""
+		with self.lock:
+			if self.pending.pop(entry_id, None) is not None:
+				self._write({"id": entry_id, "event": "done"})
+
+	def sync(self):
+		with self.lock:
+			self._sync()
+
+	def compact(self):
+		"""
+		Rewrites the journal with only the outstanding operations
+		"""
+		with self.lock:
+			self._sync()
+			temp_path = self.journal_path + ".compact"
+			with open(temp_path, 'w') as fp:
+				for entry_id in sorted(self.pending):
+					fp.write(json.dumps(self.pending[entry_id]) + "\n")
+				fp.flush()
+				os.fsync(fp.fileno())
+			os.rename(temp_path, self.journal_path)
+			self.fp.close()
+			self.fp = open(self.journal_path, 'a')
+			self.lines = len(self.pending)
+			self.logger.info("compacted operation journal to %d outstanding operations", self.lines)
+
+	def _load(self):
+		if not os.path.exists(self.journal_path):
+			return
+		# the end of the last complete line, and whether a last line without its newline still holds a record
+		complete = 0
+		torn = None
+		with open(self.journal_path, 'r') as fp:
+			for line in fp:
+				if line.endswith("\n"):
+					complete += len(line)
+				else:
+					torn = "unreadable"
+				self.lines += 1
+				try:
+					record = json.loads(line)
+				except ValueError, e:
+					# a torn write at the end of the file from a crash mid-append
+					self.logger.warning("skipping unreadable operation journal line: %r", line)
+					continue
+				if torn:
+					torn = "readable"
+				if record["event"] == "queued":
+					self.pending[record["id"]] = record
+				else:
+					self.pending.pop(record["id"], None)
+				self.next_id = max(self.next_id, record["id"] + 1)
+		# the records appended next have to start on a line of their own
+		if torn == "unreadable":
+			with open(self.journal_path, 'r+') as fp:
+				fp.truncate(complete)
+				os.fsync(fp.fileno())
+		elif torn == "readable":
+			with open(self.journal_path, 'a') as fp:
+				fp.write("\n")
+				os.fsync(fp.fileno())
+
+	def _write(self, record):
+		self.fp.write(json.dumps(record) + "\n")
+		self.lines += 1
+		self.unsynced += 1
+
+	def _sync(self):
+		if self.unsynced:
+			self.fp.flush()
+			os.fsync(self.fp.fileno())
+			self.unsynced = 0
+
+	def _sync_thread_main(self):
+		while True:
+			time.sleep(self.sync_interval)
+			try:
+				self.sync()
+				if self.lines > self.compact_after and self.lines > 4 * len(self.pending):
+					self.compact()
+			except Exception, e:
+				self.logger.error("operation journal sync failed: %s", e)
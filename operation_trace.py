@@ -0,0 +1,83 @@
+import hashlib
+import json
+import os
+import time
+
+from threading import Lock
+
+class TraceRecorder:
+	"""
+	Records every FUSE operation handled by a FileSystem to a JSONL file so real workloads can be replayed offline
+	(see tool_replay_trace.py).
+
+	Each line looks like:
+		{"t": 1400000000.123, "op": "read", "path": "a/b.txt", "args": [4096, 0, 7], "dur": 0.0002, "res": 4096}
+	where args are the operation's arguments after the path, with write data replaced by its length and any
+	other paths (rename targets, symlink sources) handled like the path. res is the file handle returned by
+	open/create, the length of what read/readdir returned, or the return value of other operations. Failed
+	operations have "err" (the errno) instead of "res".
+
+	With hash_paths, every component of every path is replaced by a salted hash. The directory structure is kept, so
+	the trace can still be replayed, but no file names are written out.
+	"""
+	# operations whose first argument after the path is another path
+	_path_arguments = frozenset(['rename', 'symlink', 'link'])
+
+	def __init__(self, trace_path, hash_paths=False, salt=""):
+		self.trace_path = trace_path
+		self.hash_paths = hash_paths
+		self.salt = salt
+		self.lock = Lock()
+		self.fp = open(trace_path, 'a')
+
+	def record(self, op, path, args, start, duration, result=None, error=None):
+		entry = {"t": round(start, 6), "op": op, "path": self.trace_path_for(path), "args": self._args(op, args),
+			"dur": round(duration, 6)}
+		if error is not None:
+			entry["err"] = error
+		else:
+			entry["res"] = self._result(result)
+		line = json.dumps(entry, separators=(',', ':')) + "\n"
+		with self.lock:
+			self.fp.write(line)
+
+	def trace_path_for(self, path):
+		if path is None or not self.hash_paths:
+			return path
+		return "/".join(self._hash(component) for component in path.lstrip("/").split("/"))
+
+	def close(self):
+		with self.lock:
+			self.fp.close()
+
+	def _hash(self, component):
+		if component == "":
+			return component
+		if isinstance(component, unicode):
+			component = component.encode('utf-8')
+		return hashlib.sha1(self.salt + component).hexdigest()[:16]
+
+	def _args(self, op, args):
+		if op == "write":
+			data, offset, fh = args
+			return [len(data), offset, fh]
+		if op in self._path_arguments and args:
+			return [self.trace_path_for(args[0])] + list(args[1:])
+		return [arg if isinstance(arg, (int, long, float, basestring)) or arg is None else None for arg in args]
+
+	def _result(self, result):
+		if isinstance(result, (str, list)):
+			return len(result)
+		if isinstance(result, (int, long, float)) or result is None:
+			return result
+		return None
+
+def load(trace_path):
+	"""
+	Yields the entries of a trace file in order
+	"""
+	with open(trace_path, 'r') as fp:
+		for line in fp:
+			line = line.strip()
+			if line:
+				yield json.loads(line)
@@ -0,0 +1,42 @@
+import fnmatch
+
+class PathRules:
+	"""
+	A set of path patterns from the config, given as a comma separated list. A pattern containing any of the glob
+	characters *?[ is matched with fnmatch against the whole path (where * also matches across /); any other
+	pattern is a prefix, so "temp/" covers everything under the temp directory. Paths are compared without their
+	leading /.
+
+	Example:
+		revalidate_never = filedir/, theme/*.png
+	"""
+	def __init__(self, patterns):
+		self.prefixes = []
+		self.globs = []
+		for pattern in patterns:
+			pattern = pattern.strip().lstrip("/")
+			if not pattern:
+				continue
+			if any(c in pattern for c in "*?["):
+				self.globs.append(pattern)
+			else:
+				self.prefixes.append(pattern)
+		self.prefixes = tuple(self.prefixes)
+
+	@staticmethod
+	def from_config(config, key):
+		if key in config:
+			return PathRules(config[key].split(","))
+		return PathRules([])
+
+	def matches(self, path):
+		path = path.lstrip("/")
+		if self.prefixes and (path.startswith(self.prefixes) or path + "/" in self.prefixes):
+			return True
+		for pattern in self.globs:
+			if fnmatch.fnmatchcase(path, pattern):
+				return True
+		return False
+
+	def __nonzero__(self):
+		return bool(self.prefixes or self.globs)
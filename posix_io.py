@@ -0,0 +1,65 @@
+import ctypes, ctypes.util, os, errno
+
+from threading import Lock, local
+
+'''
+Positional reads and writes (pread/pwrite) on raw file descriptors. Unlike lseek followed by read/write these do not
+touch the shared file offset, so any number of threads can use the same descriptor at once.
+
+Python 2 has no os.pread/os.pwrite, so we call the libc functions through ctypes (which releases the GIL for the
+duration of the call). If libc can not be loaded we fall back to lseek + read/write under a single lock.
+'''
+
+_libc = None
+_pread = None
+_pwrite = None
+_fallback_lock = Lock()
+# per thread read buffer, so a read does not have to allocate and zero a new one
+_buffers = local()
+
+try:
+	_libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+	# the 64 bit variants take a 64 bit offset even on 32 bit platforms
+	_pread = getattr(_libc, "pread64", _libc.pread)
+	_pread.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int64]
+	_pread.restype = ctypes.c_ssize_t
+	_pwrite = getattr(_libc, "pwrite64", _libc.pwrite)
+	_pwrite.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_size_t, ctypes.c_int64]
+	_pwrite.restype = ctypes.c_ssize_t
+except (OSError, AttributeError), e:
+	_libc = None
+
+def pread(fd, size, offset):
+	"""
+	Reads up to size bytes from fd starting at offset. Returns the data read (an empty string at end of file)
+	"""
+	if _libc is None:
+		with _fallback_lock:
+			os.lseek(fd, offset, os.SEEK_SET)
+			return os.read(fd, size)
+	buf = getattr(_buffers, "buf", None)
+	if buf is None or len(buf) < size:
+		buf = _buffers.buf = ctypes.create_string_buffer(size)
+	while True:
+		count = _pread(fd, buf, size, offset)
+		if count >= 0:
+			return ctypes.string_at(buf, count)
+		error = ctypes.get_errno()
+		if error != errno.EINTR:
+			raise OSError(error, os.strerror(error))
+
+def pwrite(fd, data, offset):
+	"""
+	Writes data to fd starting at offset. Returns the number of bytes written
+	"""
+	if _libc is None:
+		with _fallback_lock:
+			os.lseek(fd, offset, os.SEEK_SET)
+			return os.write(fd, data)
+	while True:
+		count = _pwrite(fd, data, len(data), offset)
+		if count >= 0:
+			return count
+		error = ctypes.get_errno()
+		if error != errno.EINTR:
+			raise OSError(error, os.strerror(error))
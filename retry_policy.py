@@ -0,0 +1,130 @@
+import httplib
+import multiprocessing
+import random
+import socket
+import time
+
+from swiftclient import client as _swift_client
+
+class RetryPolicy:
+	"""
+	Decides which failed Swift requests a SwiftWorker retries, and how long it waits before each retry.
+
+	Failures fall into classes:
+		server_error  500, 502 and 504
+		unavailable   503 and 429: Swift is shedding load, so these get more attempts and longer waits
+		timeout       no answer at all: timeouts, refused or reset connections
+	Anything else (a 404, a 412, ...) is an answer and is never retried. Each class has its own number of attempts.
+	The wait before retry n is drawn uniformly from 0 to min(max_delay, base_delay * 2^n), so workers that failed
+	together do not all come back together.
+
+	The policy also says whether interactive downloads are hedged: when the first GET has not answered within the
+	95th percentile of recent response times (never sooner than hedge_min_delay), a second one is sent and whichever
+	answers first is used.
+
+	Parameters
+		attempts: dict of class -> attempts in total, 1 meaning no retries
+		base_delay, max_delay: seconds
+		hedge_reads: whether interactive downloads are hedged
+		hedge_min_delay: seconds, the earliest a hedged request is sent
+	"""
+	DEFAULT_ATTEMPTS = {"server_error": 5, "unavailable": 8, "timeout": 3}
+
+	def __init__(self, attempts=None, base_delay=0.1, max_delay=10.0, hedge_reads=True, hedge_min_delay=0.05):
+		self.attempts = dict(RetryPolicy.DEFAULT_ATTEMPTS)
+		if attempts:
+			self.attempts.update(attempts)
+		self.base_delay = base_delay
+		self.max_delay = max_delay
+		self.hedge_reads = hedge_reads
+		self.hedge_min_delay = hedge_min_delay
+
+	@staticmethod
+	def from_config(config):
+		"""
+		Config keys: retry_attempts (e.g. "server_error:5,unavailable:8,timeout:3"), retry_base_delay,
+		retry_max_delay, hedge_reads and hedge_min_delay
+		"""
+		attempts = {}
+		if "retry_attempts" in config:
+			for rule in config["retry_attempts"].split(","):
+				kind, count = rule.split(":")
+				attempts[kind.strip()] = int(count)
+		return RetryPolicy(attempts,
+			base_delay=float(config["retry_base_delay"]) if "retry_base_delay" in config else 0.1,
+			max_delay=float(config["retry_max_delay"]) if "retry_max_delay" in config else 10.0,
+			hedge_reads=config["hedge_reads"].lower() in ("true", "yes", "on", "1") if "hedge_reads" in config else True,
+			hedge_min_delay=float(config["hedge_min_delay"]) if "hedge_min_delay" in config else 0.05)
+
+	def classify(self, e):
+		"""
+		The failure class of an exception raised by a request, or None if it is not worth retrying
+		"""
+		if isinstance(e, _swift_client.ClientException):
+			if e.http_status in (500, 502, 504):
+				return "server_error"
+			if e.http_status in (503, 429):
+				return "unavailable"
+			if e.http_status is None:
+				# swiftclient gives up on connection errors without a status
+				return "timeout"
+			return None
+		if isinstance(e, (socket.error, httplib.HTTPException)):
+			return "timeout"
+		return None
+
+	def delay(self, kind, attempt):
+		"""
+		Seconds to wait before the next attempt after attempt (counting from 1) failed with kind, or None if there is
+		no next attempt
+		"""
+		if attempt >= self.attempts.get(kind, 1):
+			return None
+		return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+class CircuitBreaker:
+	"""
+	Counts consecutive failed Swift requests over all the SwiftWorkers (the counts are in shared memory, so the
+	breaker is made before the workers are started). After failure_threshold of them the circuit opens for cooldown
+	seconds, during which SwiftSource holds background tasks back instead of queueing them, leaving whatever Swift
+	can still do to interactive requests. After the cooldown requests go through again: the first to succeed closes
+	the circuit, a failure opens it for another cooldown.
+
+	Parameters
+		failure_threshold: consecutive failures that open the circuit
+		cooldown: seconds the circuit stays open
+	"""
+	def __init__(self, failure_threshold=20, cooldown=30.0):
+		self.failure_threshold = failure_threshold
+		self.cooldown = cooldown
+		self.failures = multiprocessing.Value('i', 0)
+		self.opened_at = multiprocessing.Value('d', 0.0)
+
+	@staticmethod
+	def from_config(config):
+		"""
+		Config keys: breaker_failure_threshold and breaker_cooldown
+		"""
+		return CircuitBreaker(
+			int(config["breaker_failure_threshold"]) if "breaker_failure_threshold" in config else 20,
+			float(config["breaker_cooldown"]) if "breaker_cooldown" in config else 30.0)
+
+	def is_open(self):
+		opened_at = self.opened_at.value
+		return opened_at > 0 and time.time() < opened_at + self.cooldown
+
+	def is_closed(self):
+		"""
+		Whether requests have been going through: false while open, and after the cooldown until one succeeds
+		"""
+		return self.failures.value < self.failure_threshold
+
+	def record(self, success):
+		with self.failures.get_lock():
+			if success:
+				self.failures.value = 0
+				self.opened_at.value = 0.0
+			else:
+				self.failures.value += 1
+				if self.failures.value >= self.failure_threshold and not self.is_open():
+					self.opened_at.value = time.time()
@@ -0,0 +1,81 @@
+from threading import Lock, Event
+
+import metrics
+
+# joined / (leader + joined) is the share of the calls that were saved
+calls = metrics.counter("single_flight_calls_total",
+	"Lookups and downloads by kind (metadata or download) and result: leader when the call went to Swift, joined when "
+	"it waited on one already in flight for the same path")
+
+class _Flight:
+	def __init__(self):
+		self.done = Event()
+		self.result = None
+		self.error = None
+
+class SingleFlight:
+	"""
+	Lets only one call per key be in flight at a time. When several FUSE threads touch the same path at once (PHP
+	workers opening the same uncached file, say), the first one does the HEAD or the download and the others wait for
+	its outcome instead of each sending their own request and racing to save their own node or write the same cache
+	file.
+
+	do runs a function for the key, or waits for the one already running. Calls that finish asynchronously (downloads
+	run on the SwiftWorkers) use begin and finish instead.
+
+	Parameters
+		kind: the label of the calls in single_flight_calls_total
+	"""
+	def __init__(self, kind):
+		self.kind = kind
+		self.lock = Lock()
+		# key -> _Flight
+		self.flights = {}
+
+	def do(self, key, function, *args):
+		"""
+		Returns function(*args), run by this thread unless another one is running it for the same key, in which case
+		its result (or exception) is shared
+		"""
+		with self.lock:
+			flight = self.flights.get(key)
+			leader = flight is None
+			if leader:
+				flight = self.flights[key] = _Flight()
+		if not leader:
+			calls.inc(kind=self.kind, result="joined")
+			flight.done.wait()
+			if flight.error is not None:
+				raise flight.error
+			return flight.result
+		calls.inc(kind=self.kind, result="leader")
+		try:
+			flight.result = function(*args)
+			return flight.result
+		except Exception, e:
+			flight.error = e
+			raise
+		finally:
+			self.finish(key)
+
+	def begin(self, key):
+		"""
+		Returns True if the caller is to start the call for key, and then must finish it; False if one is in flight
+		"""
+		with self.lock:
+			if key in self.flights:
+				calls.inc(kind=self.kind, result="joined")
+				return False
+			self.flights[key] = _Flight()
+		calls.inc(kind=self.kind, result="leader")
+		return True
+
+	def finish(self, key):
+		with self.lock:
+			flight = self.flights.pop(key, None)
+		if flight is not None:
+			flight.done.set()
+
+	def in_flight(self, key):
+		with self.lock:
+			return key in self.flights
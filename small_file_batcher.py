@@ -0,0 +1,166 @@
+import hashlib
+import logging
+import os
+import tarfile
+import tempfile
+import thread
+import time
+
+from StringIO import StringIO
+from threading import Lock
+
+import metrics
+
+bulk_uploads = metrics.counter("bulk_uploads_total", "Small files uploaded inside bulk-extract archives, by result")
+bulk_archives = metrics.counter("bulk_upload_archives_total", "Bulk-extract archives handed to the Swift workers")
+
+# prefix of the tar extended attributes Swift's bulk middleware turns into object metadata
+METADATA_PAX_PREFIX = "SCHILY.xattr.user.meta."
+
+class SmallFileBatcher:
+	"""
+	Uploads small files in batches: the files collect for up to window seconds (or until there are max_files of them)
+	and go out as one tar archive through Swift's bulk middleware (PUT ?extract-archive=tar), which stores every member
+	as its own object. A member carries the node's fs-* metadata as user.meta.* extended attributes (PAX headers),
+	which the middleware sets as the object's x-object-meta-* metadata. One worker task then replaces a HEAD and a PUT
+	per file.
+
+	Files are handed over by the job executor (add is the operation of the file's FileOperation), so they are ordered
+	with the other operations on their path like any upload. The result for each file is mapped back to its own
+	callback, with the md5 of what was archived as its etag.
+
+	Parameters
+		swift_connection: the SwiftSource (or stand-in) to upload the archives through
+		cache_root: where the files are read from
+		max_size: files up to this many bytes are batched
+		window: seconds a file waits for others to join its archive
+		max_files: members per archive
+	"""
+	def __init__(self, swift_connection, cache_root, max_size, window=0.2, max_files=500):
+		self.logger = logging.getLogger('fuse')
+		self.swift_connection = swift_connection
+		self.cache_root = cache_root
+		self.max_size = max_size
+		self.window = window
+		self.max_files = max_files
+		self.lock = Lock()
+		# (node, callback) of the files waiting for the next archive
+		self.pending = []
+		self.first_pending_at = None
+		metrics.gauge("bulk_upload_pending_files", "Small files waiting for the next bulk-extract archive",
+			lambda: len(self.pending))
+
+	def start(self):
+		thread.start_new_thread(self._flush_thread_main, ())
+
+	def accepts(self, node):
+		return node.is_file() and node.size <= self.max_size
+
+	def add(self, node, callback):
+		"""
+		Queues the upload of a node's cached file. The callback gets (success, error_message, {"etag": md5})
+		"""
+		with self.lock:
+			if not self.pending:
+				self.first_pending_at = time.time()
+			self.pending.append((node, callback))
+			full = len(self.pending) >= self.max_files
+		if full:
+			self.flush()
+
+	def flush(self):
+		with self.lock:
+			batch, self.pending = self.pending, []
+		if batch:
+			self._submit(batch)
+
+	def _submit(self, batch):
+		try:
+			archive_path, members = self._build_archive(batch)
+		except Exception, e:
+			self.logger.error("unable to build a bulk upload archive: %s", e)
+			for node, callback in batch:
+				callback(False, "unable to build archive: %s" % e)
+			return
+		if not members:
+			os.unlink(archive_path)
+			return
+
+		def done(success, error_message, result=None):
+			try:
+				os.unlink(archive_path)
+			except OSError, e:
+				pass
+			if result is not None:
+				failed = set(result["failed"])
+			elif success:
+				failed = set()
+			else:
+				failed = set(name for name, callback, etag in members)
+			bulk_uploads.inc(len(members) - len(failed), result="done")
+			if failed:
+				bulk_uploads.inc(len(failed), result="failed")
+			for name, callback, etag in members:
+				try:
+					if name in failed:
+						callback(False, error_message or "not extracted")
+					else:
+						callback(True, None, {"etag": etag})
+				except Exception, e:
+					self.logger.error("error in the bulk upload callback of %s: %s", name, e)
+
+		bulk_archives.inc()
+		self.swift_connection.extract_archive(archive_path, [name for name, callback, etag in members], done)
+
+	def _build_archive(self, batch):
+		"""
+		Writes the archive of a batch to a temporary file. Returns its path and (object name, callback, md5) per member
+		"""
+		fd, archive_path = tempfile.mkstemp(prefix="bulk-", suffix=".tar")
+		members = []
+		with os.fdopen(fd, 'wb') as fp:
+			archive = tarfile.open(fileobj=fp, mode='w', format=tarfile.PAX_FORMAT, encoding="utf-8")
+			for node, callback in batch:
+				name = node.path.lstrip("/")
+				source_path = os.path.join(self.cache_root, name)
+				if not os.path.isfile(source_path):
+					# removed since; the tombstone queued behind this upload takes care of the object
+					callback(True, None)
+					continue
+				try:
+					member, data = self._member(node, name, source_path)
+				except Exception, e:
+					# only this file fails, and is retried on its own like any failed upload
+					self.logger.error("unable to add %s to a bulk upload archive: %s", name, e)
+					callback(False, "unable to add to archive: %s" % e)
+					continue
+				archive.addfile(member, StringIO(data))
+				members.append((name, callback, hashlib.md5(data).hexdigest()))
+			archive.close()
+		return archive_path, members
+
+	def _member(self, node, name, source_path):
+		"""
+		Returns the tar header and the data of a node's file. The header is encoded here already, so that a name or
+		metadata that can not be stored raises before anything is written to the archive
+		"""
+		with open(source_path, 'rb') as source:
+			data = source.read()
+		member = tarfile.TarInfo(name)
+		member.size = len(data)
+		member.mtime = int(node.mtime)
+		member.mode = node.mode & 07777
+		# PAX headers are written as UTF-8 and have to be unicode for that
+		member.pax_headers = dict(((METADATA_PAX_PREFIX + key).decode("utf-8"), value.decode("utf-8"))
+			for key, value in node.swift_metadata().iteritems())
+		member.tobuf(tarfile.PAX_FORMAT, "utf-8", "strict")
+		return member, data
+
+	def _flush_thread_main(self):
+		while True:
+			time.sleep(self.window / 4)
+			try:
+				if self.pending and time.time() - self.first_pending_at >= self.window:
+					self.flush()
+			except Exception, e:
+				self.logger.error("sending a bulk upload failed: %s", e)
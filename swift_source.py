@@ -4,10 +4,37 @@ import pyrax
 import os
 import multiprocessing
 import thread
+from collections import deque
+from threading import Lock
 from swift_worker import SwiftWorker, SwiftTask, SwiftResponse
+from container_map import ContainerMap
+from retry_policy import RetryPolicy, CircuitBreaker
+from task_watchdog import TaskWatchdog
+from job_registry import JobRegistry
+from throttle import Throttle
+import metrics
+
+request_seconds = metrics.histogram("swift_request_seconds", "Time SwiftWorkers spent on a task, by command")
+request_failures = metrics.counter("swift_request_failures_total", "SwiftWorker tasks that failed, by command")
+retries = metrics.counter("swift_retries_total", "Swift requests retried by the SwiftWorkers, by command and failure class")
+hedged_downloads = metrics.counter("swift_hedged_downloads_total",
+	"Downloads that sent a second GET, by which of the two answered first")
+throttle_wait_seconds = metrics.counter("swift_throttle_wait_seconds_total",
+	"Time SwiftWorkers spent waiting on the throttle, by traffic class")
+deferred_tasks = metrics.counter("swift_tasks_deferred_total",
+	"Background tasks held back while the circuit breaker was open, by command")
+worker_busy_seconds = metrics.counter("swift_worker_busy_seconds_total",
+	"Time SwiftWorkers spent on tasks; its rate divided by swift_workers is the worker utilization")
 
 class SwiftSource:
-	def __init__(self, auth_url, username, password, tenant_id, region_name, source_bucket):
+	def __init__(self, auth_url, username, password, tenant_id, region_name, source_bucket, container_map=None,
+			retry_policy=None, circuit_breaker=None, config=None, traffic_class="background"):
+		"""
+		container_map says which container each object lives in (see ContainerMap); by default everything is in
+		source_bucket. retry_policy and circuit_breaker (see RetryPolicy, CircuitBreaker) govern how the workers deal
+		with failing requests. The TaskWatchdog's deadlines, the JobRegistry's limits and the Throttle's rates are
+		read from config. traffic_class is the class of everything but downloads, which are interactive.
+		"""
 		# TODO: now that we have swift workers, should we move away from having swift connections here?
 		#       The advantage would be that we no longer would block on simple requests (which may or may not be a
 		#       performance bottleneck)
@@ -17,38 +44,96 @@ class SwiftSource:
 		pyrax.set_credentials(username=username, api_key=password, tenant_id=tenant_id)
 		self.swift_client = pyrax.connect_to_cloudfiles(region_name)
 		self.swift_mount = self.swift_client.get_container(source_bucket)
+		self.container_map = container_map if container_map is not None else ContainerMap(source_bucket)
+		self.swift_mounts = {source_bucket: self.swift_mount}
 
 		self.task_queue = multiprocessing.JoinableQueue()
 		self.response_queue = multiprocessing.JoinableQueue()
 		# TODO: the number of workers should be a setting in the config file
 		self.num_workers = 20
-		self.workers = [SwiftWorker(self.task_queue, self.response_queue, auth_url, username, password, tenant_id, region_name, source_bucket) for i in xrange(self.num_workers)]
+		self.circuit_breaker = circuit_breaker if circuit_breaker is not None else CircuitBreaker()
+		self.throttle = Throttle.from_config(config) if config is not None else Throttle()
+		self.traffic_class = traffic_class
+		self.worker_args = (self.task_queue, self.response_queue, auth_url, username, password, tenant_id,
+			region_name, source_bucket, retry_policy, self.circuit_breaker, self.throttle)
+		self.workers = [SwiftWorker(*self.worker_args) for i in xrange(self.num_workers)]
 		for worker in self.workers:
 			worker.start()
 
-		# TODO: do we need to keep this reference?
-		self.active_job_callbacks = {}
+		self.jobs = JobRegistry.from_config(config) if config is not None else JobRegistry()
+		metrics.gauge("swift_workers", "Number of SwiftWorker processes", lambda: self.num_workers)
+		# background tasks held back while the circuit breaker is open
+		self.deferred = deque()
+		self.deferred_lock = Lock()
+		metrics.gauge("swift_tasks_deferred", "Background tasks held back while the circuit breaker is open",
+			lambda: len(self.deferred))
+		metrics.gauge("swift_circuit_open", "1 while the circuit breaker holds background tasks back",
+			lambda: 1 if self.circuit_breaker.is_open() else 0)
+		self.watchdog = TaskWatchdog.from_config(self, config) if config is not None else TaskWatchdog(self)
 		self.swift_response_thread = thread.start_new_thread(self._response_thread_main, ())
+		thread.start_new_thread(self._deferred_thread_main, ())
+		self.watchdog.start()
 
-	def download_object(self, object_name, destination, callback):
+	def download_object(self, object_name, destination, callback, etag=None, size=None):
 		"""
 		Downloads the specified object to the destionation
 		If the file does not yet exist we create it. This will cover the case that the calling
 		code needs to open the file for reading before the file is created.
+		With an etag this is a conditional download that only replaces destination if the object
+		no longer has that etag; callback then gets a third argument, {"modified": bool, "etag": etag}.
+		The size of the object, when known, sets how long the download may take.
 		"""
 		task = SwiftTask(command = "download_object",
 				args = {
 					"object_name": object_name,
-					"destination_path": destination
-					})
-		self.active_job_callbacks[task.job_id] = callback
-		self.task_queue.put(task)
+					"destination_path": destination,
+					"etag": etag
+					},
+				traffic_class = "interactive",
+				size = size)
+		self._submit(task, callback)
 
 	def get_object(self, path, cached=False):
-		return self.swift_mount.get_object(path.lstrip("/"), cached)
+		name = path.lstrip("/")
+		if not self.container_map.sharded:
+			return self.swift_mount.get_object(name, cached)
+		try:
+			return self._mount(self.container_map.container(name)).get_object(name, cached)
+		except pyrax.exceptions.NoSuchObject, e:
+			if self.container_map.fallback is None:
+				raise
+			return self._mount(self.container_map.fallback).get_object(name, cached)
 
 	def get_objects(self, path):
-		return self.swift_mount.get_objects(prefix = path.lstrip("/"))
+		if not self.container_map.sharded:
+			return self.swift_mount.get_objects(prefix = path.lstrip("/"))
+		return self._merge([self._mount(container).get_objects(prefix = path.lstrip("/"))
+			for container in self._listed_containers()])
+
+	def list_objects(self, marker=None, limit=10000):
+		"""
+		Returns one page of the container listing, the objects named after marker. Only the listing is fetched, so
+		each object has its name, etag and last_modified but getting its metadata takes another request.
+		When sharded this is a page of all the containers listed together.
+		"""
+		if not self.container_map.sharded:
+			return self.swift_mount.get_objects(marker = marker, limit = limit)
+		# each container's first limit names after marker include all of the first limit names overall
+		return self._merge([self._mount(container).get_objects(marker = marker, limit = limit)
+			for container in self._listed_containers()])[:limit]
+
+	def copy_object(self, fsnode, source_path, callback):
+		"""
+		Creates the node's object as a server-side copy of the object at source_path, with the node's metadata. On
+		success the callback gets a third argument, {"etag": etag}, when the etag of the copy is known.
+		"""
+		task = SwiftTask(command = "copy_object",
+				args = {
+					"object_name": fsnode.path.lstrip("/"),
+					"source_name": source_path.lstrip("/"),
+					"metadata": fsnode.swift_metadata()
+				})
+		self._submit(task, callback)
 
 	def set_object_metadata(self, path, metadata, callback):
 		"""
@@ -59,24 +144,45 @@ class SwiftSource:
 					"object_name": path.lstrip("/"),
 					"metadata": metadata
 				})
-		self.active_job_callbacks[task.job_id] = callback
-		self.task_queue.put(task)
+		self._submit(task, callback)
+
+	def extract_archive(self, archive_path, object_names, callback):
+		"""
+		Uploads a tar archive whose members (named object_names) become objects, through Swift's bulk middleware.
+		Metadata comes from user.meta.* extended attributes of the members. The callback gets a third argument,
+		{"failed": [object names]}, when the archive reached Swift.
+		"""
+		task = SwiftTask(command = "extract_archive",
+				args = {
+					"archive_path": archive_path,
+					"object_names": object_names
+				},
+				size = os.path.getsize(archive_path))
+		self._submit(task, callback)
 
-	def update_object(self, fsnode, cache_root, callback, md5sum = None):
+	def set_objects_metadata(self, objects, callback):
+		"""
+		Replaces the metadata of a batch of objects, given as (path, metadata) pairs, in one worker task. Each object
+		takes one POST and no HEAD, so the metadata has to be complete. The callback gets a third argument,
+		{"failed": [object names]}.
+		"""
+		task = SwiftTask(command = "set_objects_metadata",
+				args = {
+					"objects": [(path.lstrip("/"), metadata) for path, metadata in objects]
+				})
+		self._submit(task, callback)
+
+	def update_object(self, fsnode, cache_root, callback, md5sum = None, check_existing = True):
+		"""
+		Uploads the node's cached file (or an empty object) with its metadata. On success the callback gets a third
+		argument, {"etag": etag}, when the etag of the stored object is known. Unless check_existing is False, the
+		worker first HEADs the object and skips the upload if Swift already has the same data.
+		"""
 		# TODO: Do we really need to pass the cache_root? Can it perhaps be set on the fsnode already?
 		source_path = os.path.join(cache_root, fsnode.path.lstrip("/"))
 		object_name = fsnode.path.lstrip("/")
 
-		metadata = {
-				"fs-mode": "%i" % fsnode.mode,
-				"fs-uid": "%i" % fsnode.uid,
-				"fs-gid": "%i" % fsnode.gid,
-				"fs-mtime": "%f" % fsnode.mtime,
-				"fs-atime": "%f" % fsnode.atime,
-				"fs-ctime": "%f" % fsnode.ctime,
-				"fs-nlink": "%i" % fsnode.nlink,
-				"fs-size": "%i" % fsnode.size
-			}
+		metadata = fsnode.swift_metadata()
 
 		if os.path.islink(source_path):
 			metadata["fs-link-source"] = fsnode.link_source
@@ -86,30 +192,130 @@ class SwiftSource:
 					"object_name": object_name,
 					"source_path": source_path,
 					"metadata": metadata,
-					"md5sum": md5sum
-				})
-		self.active_job_callbacks[task.job_id] = callback
-		self.task_queue.put(task)
+					"md5sum": md5sum,
+					"check_existing": check_existing
+				},
+				size = os.path.getsize(source_path) if os.path.isfile(source_path) else 0)
+		self._submit(task, callback)
 
 	def terminate_workers(self):
 		def callback(success, error_message):
 			pass
 		for i in range(0,self.num_workers):
-			task = SwiftTask(command = "shutdown", args = {})
-			self.active_job_callbacks[task.job_id] = callback
-			self.task_queue.put(task)
+			task = SwiftTask(command = "shutdown", args = {}, traffic_class = "control")
+			self._submit(task, callback)
+
+	def replace_worker(self, index):
+		"""
+		Kills the worker at index (stuck on a task, see TaskWatchdog) and starts a fresh one in its place
+		"""
+		worker = self.workers[index]
+		worker.terminate()
+		worker.join(5)
+		replacement = SwiftWorker(*self.worker_args)
+		replacement.start()
+		self.workers[index] = replacement
+
+	def _mount(self, container):
+		if container not in self.swift_mounts:
+			self.swift_mounts[container] = self.swift_client.get_container(container)
+		return self.swift_mounts[container]
+
+	def _listed_containers(self):
+		containers = self.container_map.containers()
+		if self.container_map.fallback is not None:
+			# the shards go first so their copy of an object wins over the one still in the fallback
+			containers = containers + [self.container_map.fallback]
+		return containers
+
+	def _merge(self, listings):
+		"""
+		Merges the listings of several containers into one sorted by name, keeping the first listing's object when a
+		name appears in several
+		"""
+		merged = {}
+		for listing in listings:
+			for obj in listing:
+				if obj.name not in merged:
+					merged[obj.name] = obj
+		return [merged[name] for name in sorted(merged)]
+
+	def _route(self, task):
+		"""
+		Adds the containers a task's objects live in to its arguments
+		"""
+		containers = self.container_map
+		if "object_name" in task.args:
+			task.args["container"] = containers.container(task.args["object_name"])
+		if "source_name" in task.args:
+			task.args["source_container"] = containers.container(task.args["source_name"])
+		if "objects" in task.args:
+			task.args["containers"] = dict((name, containers.container(name)) for name, metadata in task.args["objects"])
+		if "object_names" in task.args:
+			task.args["containers"] = dict((name, containers.container(name)) for name in task.args["object_names"])
+		task.args["fallback_container"] = containers.fallback
+
+	def _submit(self, task, callback):
+		if self.container_map.sharded:
+			self._route(task)
+		if task.traffic_class == "background":
+			task.traffic_class = self.traffic_class
+		self.jobs.register(task, callback)
+		if task.is_background():
+			with self.deferred_lock:
+				# behind anything already deferred, even once the circuit has closed
+				if self.deferred or self.circuit_breaker.is_open():
+					deferred_tasks.inc(command=task.command)
+					self.deferred.append(task)
+					return
+		self._enqueue(task)
+
+	def _enqueue(self, task):
+		self.task_queue.put(task)
+
+	def _deferred_thread_main(self):
+		"""
+		Hands deferred tasks to the workers once the circuit breaker lets them through, a few at a time until it has
+		closed, so a Swift that is still struggling is not flooded again
+		"""
+		while True:
+			time.sleep(1)
+			try:
+				with self.deferred_lock:
+					if self.circuit_breaker.is_open():
+						continue
+					# only a trickle until a request has gone through since the cooldown
+					count = len(self.deferred) if self.circuit_breaker.is_closed() else min(self.num_workers, len(self.deferred))
+					released = [self.deferred.popleft() for i in xrange(count)]
+				for task in released:
+					self._enqueue(task)
+			except Exception, e:
+				self.logger.error("error releasing deferred swift tasks: %s", e)
 
 	def _response_thread_main(self):
 		while True:
 			try:
 				response = self.response_queue.get()
-				callback = self.active_job_callbacks[response.job_id]
-				callback(response.success, response.error_message)
+				job = self.jobs.complete(response.job_id)
+				if job is None:
+					# a worker that finished just as the watchdog declared it stuck, with the task reassigned
+					self.logger.debug("dropping a second response for job %d", response.job_id)
+					continue
+				task, callback = job
+				self.watchdog.finished(task, response)
+				if response.command is not None:
+					request_seconds.observe(response.elapsed, command=response.command)
+					worker_busy_seconds.inc(response.elapsed)
+					if not response.success:
+						request_failures.inc(command=response.command)
+				if response.stats is not None:
+					for kind, count in response.stats.get("retries", {}).iteritems():
+						retries.inc(count, command=response.command, reason=kind)
+					if "hedge" in response.stats:
+						hedged_downloads.inc(result=response.stats["hedge"])
+					if "throttled" in response.stats:
+						throttle_wait_seconds.inc(response.stats["throttled"], traffic_class=task.traffic_class)
+				self.jobs.run_callback(callback, response)
 			except Exception, e:
-				print e
-			# TODO: from whatever is passed in the response, we need to be able to determine:
-			#       a) did the request succeed
-			#       b) execute the callback for the request
-			#          > for this we'll likely need a dict so we can find the callback as you can't pass callbacks
-			#            through a multiprocess queue
+				self.logger.error("error handling swift response: %s", e)
 
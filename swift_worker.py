@@ -1,17 +1,33 @@
 from functools import wraps
 import hashlib
+import json
 import logging
 import multiprocessing
 import os
+import Queue
+import tarfile
+import tempfile
+import threading
+import time
+import urllib
 import pyrax
 import pyrax.utils as utils
-from random import randint
+from collections import deque
 from sys import exit
 
 from swiftclient import client as _swift_client
 
+from retry_policy import RetryPolicy, CircuitBreaker
+from throttle import Throttle, ThrottledFile
+
+# downloads are hedged at this percentile of recent response times, once there are enough of them
+HEDGE_PERCENTILE = 0.95
+HEDGE_MIN_SAMPLES = 20
+# and after this many seconds before that
+HEDGE_INITIAL_DELAY = 1.0
+
 class SwiftWorker(multiprocessing.Process):
-	def __init__(self, task_queue, response_queue, auth_url, username, password, tenant_id, region_name, source_bucket, max_attempts = 5):
+	def __init__(self, task_queue, response_queue, auth_url, username, password, tenant_id, region_name, source_bucket, retry_policy = None, circuit_breaker = None, throttle = None):
 		multiprocessing.Process.__init__(self)
 		self.logger = logging.getLogger('swift_worker')
 		self.task_queue = task_queue
@@ -22,30 +38,59 @@ class SwiftWorker(multiprocessing.Process):
 		self.swift_client = pyrax.connect_to_cloudfiles(region_name)
 		self.swift_client.max_file_size = 1073741823	# 1GB - 1
 		self.swift_mount = self.swift_client.get_container(source_bucket)
-		self.max_attempts = max_attempts
+		self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+		self.circuit_breaker = circuit_breaker if circuit_breaker is not None else CircuitBreaker()
+		self.throttle = throttle if throttle is not None else Throttle()
+		# times to the first byte of recent downloads, for the hedging delay
+		self.response_times = deque(maxlen=200)
+		self.traffic_class = None
+		# retries and hedging of the current task, sent back with its response
+		self.task_stats = {}
+		# with sharding (see ContainerMap) each task names the containers it works on; swift_mount is pointed at the
+		# task's container before it runs
+		self.default_mount = self.swift_mount
+		self.swift_mounts = {source_bucket: self.swift_mount}
+		self.source_mount = self.swift_mount
+		self.fallback_mount = None
+		self.containers = None
+		# the job running, since when and how long it has waited on the throttle, in shared memory for the
+		# TaskWatchdog; 0 when idle
+		self.current_job = multiprocessing.Value('l', 0)
+		self.task_started = multiprocessing.Value('d', 0.0)
+		self.task_throttled = multiprocessing.Value('d', 0.0)
 
 	def handle_client_exception(fnc):
 		"""
 		Here we wrap all our functions that actually make requests to Swift to do some generic
-		exception handling. If an exception can not be handled generically then we just re-raise it.
+		exception handling: failures the retry policy considers transient are retried after a backoff, and every
+		outcome is reported to the circuit breaker. Anything else is re-raised.
 		"""
 		@wraps(fnc)
 		def _wrapped(self, *args, **kwargs):
 			attempts = 0
 
-			while attempts < self.max_attempts:
+			while True:
 				attempts += 1
+				self._throttled(self.throttle.request(self.traffic_class))
 				try:
 					ret = fnc(self, *args, **kwargs)
+					self.circuit_breaker.record(True)
 					return ret
-				except _swift_client.ClientException, e:
-					if e.http_status == 500:
-						self.logger.error('''"worker":"%s", "message":"500 error, attempt %d: %s"''', self.name, attempts, e.message)
-						continue
-					else:
+				except Exception, e:
+					kind = self.retry_policy.classify(e)
+					if kind is None:
+						# Swift answered, it just did not like the request
+						if isinstance(e, _swift_client.ClientException):
+							self.circuit_breaker.record(True)
 						raise
-				except:
-					raise
+					self.circuit_breaker.record(False)
+					delay = self.retry_policy.delay(kind, attempts)
+					if delay is None:
+						raise
+					self.logger.error('''"worker":"%s", "message":"%s, attempt %d, retrying in %.2fs: %s"''', self.name, kind, attempts, delay, e)
+					retries = self.task_stats.setdefault("retries", {})
+					retries[kind] = retries.get(kind, 0) + 1
+					time.sleep(delay)
 		return _wrapped
 
 	def run(self):
@@ -60,15 +105,28 @@ class SwiftWorker(multiprocessing.Process):
 		while stay_alive:
 			self.logger.debug('''"worker":"%s", "message":"waiting for task"''', self.name)
 			task = self.task_queue.get()
+			self.task_throttled.value = 0.0
+			self.task_started.value = time.time()
+			self.current_job.value = task.job_id
+			self._route(task)
+			self.traffic_class = task.traffic_class
+			self.task_stats = {}
+			task_start = time.time()
 			task_success = True
 			task_error_message = None
+			task_result = None
 			if task.command == "download_object":
 				if "object_name" in task.args.keys() and "destination_path" in task.args.keys():
 					object_name = task.args["object_name"]
 					destination_path = task.args["destination_path"]
+					etag = task.args["etag"] if ("etag" in task.args.keys()) else None
 					self.logger.debug('''"worker":"%s", "message":"downloading object '%s'"''', self.name, object_name)
 					try:
-						task_success = self.download_object(object_name, destination_path)
+						if etag is None:
+							task_success = self.download_object(object_name, destination_path)
+						else:
+							task_result = self.download_object_if_modified(object_name, destination_path, etag)
+							task_success = task_result is not None
 						if not task_success:
 							task_error_message = "unable to download object"
 					except Exception, e:
@@ -83,9 +141,13 @@ class SwiftWorker(multiprocessing.Process):
 					source_path = task.args["source_path"]
 					metadata = task.args["metadata"] if ("metadata" in task.args.keys()) else {}
 					md5sum = task.args["md5sum"] if ("md5sum" in task.args.keys()) else None
+					check_existing = task.args["check_existing"] if ("check_existing" in task.args.keys()) else True
 					self.logger.debug('''"worker":"%s", "message":"creating object '%s'"''', self.name, object_name)
 					try:
-						task_success = self.create_object(object_name, source_path, metadata, md5sum)
+						etag = self.create_object(object_name, source_path, metadata, md5sum, check_existing)
+						task_success = bool(etag)
+						if isinstance(etag, basestring):
+							task_result = {"etag": etag}
 						if not task_success:
 							task_error_message = "unable to create object"
 					except Exception, e:
@@ -94,6 +156,69 @@ class SwiftWorker(multiprocessing.Process):
 				else:
 					task_success = False
 					task_error_message = "missing arguments in 'upload_object' command"
+			elif task.command == "copy_object":
+				if "object_name" in task.args.keys() and "source_name" in task.args.keys():
+					object_name = task.args["object_name"]
+					source_name = task.args["source_name"]
+					metadata = task.args["metadata"] if ("metadata" in task.args.keys()) else {}
+					self.logger.debug('''"worker":"%s", "message":"copying object '%s' to '%s'"''', self.name, source_name, object_name)
+					try:
+						etag = self.copy_object(object_name, source_name, metadata)
+						task_success = bool(etag)
+						if isinstance(etag, basestring):
+							task_result = {"etag": etag}
+						if etag is None:
+							# no point in trying again
+							task_result = {"source_missing": True}
+							task_error_message = "copy source not found"
+						elif not task_success:
+							task_error_message = "unable to copy object"
+					except Exception, e:
+						task_success = False
+						task_error_message = e.message
+				else:
+					task_success = False
+					task_error_message = "missing arguments in 'copy_object' command"
+			elif task.command == "extract_archive":
+				if "archive_path" in task.args.keys() and "object_names" in task.args.keys():
+					archive_path = task.args["archive_path"]
+					object_names = task.args["object_names"]
+					self.logger.debug('''"worker":"%s", "message":"uploading archive of %d objects"''', self.name, len(object_names))
+					try:
+						failed = self.extract_archive(archive_path)
+						if failed is None:
+							failed = object_names
+						task_result = {"failed": [name for name in object_names if name in failed]}
+						if task_result["failed"]:
+							task_success = False
+							task_error_message = "unable to extract %d of %d objects" % (len(task_result["failed"]), len(object_names))
+					except Exception, e:
+						task_success = False
+						task_error_message = e.message
+				else:
+					task_success = False
+					task_error_message = "missing arguments in 'extract_archive' command"
+			elif task.command == "set_objects_metadata":
+				if "objects" in task.args.keys():
+					objects = task.args["objects"]
+					self.logger.debug('''"worker":"%s", "message":"replacing metadata of %d objects"''', self.name, len(objects))
+					failed = []
+					for object_name, metadata in objects:
+						try:
+							if self.containers is not None:
+								self.swift_mount = self._mount(self.containers[object_name])
+							if not self.replace_object_metadata(object_name, metadata):
+								failed.append(object_name)
+						except Exception, e:
+							self.logger.debug('''"worker":"%s", "message":"replacing metadata of '%s' failed: %s"''', self.name, object_name, e)
+							failed.append(object_name)
+					task_result = {"failed": failed}
+					if failed:
+						task_success = False
+						task_error_message = "unable to set metadata for %d of %d objects" % (len(failed), len(objects))
+				else:
+					task_success = False
+					task_error_message = "missing arguments in 'set_objects_metadata' command"
 			elif task.command == "set_object_metadata":
 				if "object_name" in task.args.keys() and "metadata" in task.args.keys():
 					object_name = task.args["object_name"]
@@ -119,8 +244,10 @@ class SwiftWorker(multiprocessing.Process):
 				task_success = False
 				task_error_message = "Invalid command"
 			self.task_queue.task_done()
-			response = SwiftResponse(task.job_id, task_success, task_error_message)
+			response = SwiftResponse(task.job_id, task_success, task_error_message, task.command, time.time() - task_start,
+				task_result, self.task_stats or None)
 			self.response_queue.put(response)
+			self.current_job.value = 0
 
 			if task_success:
 				self.logger.debug('''"worker":"%s", "message":"task successful"''', self.name)
@@ -136,23 +263,50 @@ class SwiftWorker(multiprocessing.Process):
 			fp = open(destination_path, 'wb')
 		except IOError, e:
 			return e
-		obj = self.swift_mount.get_object(object_name, cached=False)
-		if obj == None:
-			return False
-		for chunk in obj.get(chunk_size=chunk_size):
-			fp.write(chunk)
+		try:
+			headers, body = self._fetch(object_name, chunk_size)
+			for chunk in body:
+				fp.write(chunk)
+				self._throttled(self.throttle.transfer(self.traffic_class, len(chunk)))
+		finally:
+			fp.close()
 		# TODO: at this point it is probably a good idea to check the file size and make
 		#       sure that the MD5 hash matches. If either of these do not check out, we
 		#       should return false
-		fp.close()
 		return True
 
 	@handle_client_exception
-	def create_object(self, object_name, source_path, metadata, md5sum = None):
+	def download_object_if_modified(self, object_name, destination_path, etag):
+		"""
+		Conditional GET of an object we already have a copy of. Returns {"modified": False} if the object still has
+		the given etag, which leaves the copy at destination_path alone. Otherwise the new data is downloaded next to
+		it and renamed over it (so readers of the old copy are not cut short) and {"modified": True, "etag": <new
+		etag>} is returned.
+		"""
+		chunk_size = 1024*1024 # 1MB chunks
+		try:
+			headers, body = self._fetch(object_name, chunk_size, {"If-None-Match": etag})
+		except _swift_client.ClientException, e:
+			if e.http_status == 304:
+				return {"modified": False, "etag": etag}
+			raise
+		temp_path = destination_path + ".download"
+		with open(temp_path, 'wb') as fp:
+			for chunk in body:
+				fp.write(chunk)
+				self._throttled(self.throttle.transfer(self.traffic_class, len(chunk)))
+		os.rename(temp_path, destination_path)
+		return {"modified": True, "etag": headers.get("etag")}
+
+	@handle_client_exception
+	def create_object(self, object_name, source_path, metadata, md5sum = None, check_existing = True):
 		"""
 		Creates the specified object in Swift. If the source_path points to a file
 		then we upload the file, otherwise, we upload an empty object.
-		Will return true iff the returned http status code is 201 (Created)
+		Will return the etag of the object (or True if it is not known) iff the returned
+		http status code is 201 (Created), False otherwise
+		Without check_existing the upload is made without first looking for an existing copy
+		of the object (for callers that already know there is none).
 
 		NOTE: Pyrax's upload_file function takes care of segmenting files if they
 				  exceed the max object size.
@@ -162,7 +316,7 @@ class SwiftWorker(multiprocessing.Process):
 		# exists. If it does then we check the md5 hash to see if it is the same as what we're
 		# trying to upload.
 		try:
-			existing_object = self.swift_mount.get_object(object_name)
+			existing_object = self._get_object(object_name) if check_existing else None
 			if existing_object is not None:
 				# TODO: comparing checksums for objects more than max_object_size does not work
 				#				It seems like the best place to be doing this is probably in the function to store
@@ -173,7 +327,7 @@ class SwiftWorker(multiprocessing.Process):
 					local_etag = utils.get_checksum(source_path) if md5sum is None else md5sum
 				if existing_object.etag == local_etag:
 					self.logger.debug('''"worker":"%s", "message":"task successful, object already exists with same md5 hash, not uploading"''', self.name)
-					return True
+					return local_etag
 				print "mismatch %s, %s" % (local_etag, existing_object.etag)
 		except Exception, e:
 			# if we get an exception here, then the object does not yet exist, so continue on
@@ -181,7 +335,18 @@ class SwiftWorker(multiprocessing.Process):
 
 		metadata = self._massage_metakeys(metadata, self.swift_client.object_meta_prefix)
 		upload_response = {}
-		if os.path.isfile(source_path):
+		if (os.path.isfile(source_path) and self.throttle.limited(self.traffic_class, "bytes")
+				and os.path.getsize(source_path) <= self.swift_client.max_file_size):
+			# pyrax reads the file itself, so a throttled upload goes through swiftclient, reading the file through
+			# the throttle
+			with open(source_path, 'rb') as fp:
+				etag = self.swift_client.connection.put_object(self.swift_mount.name, object_name,
+					ThrottledFile(fp, self.throttle, self.traffic_class, self._throttled),
+					content_length=os.path.getsize(source_path), headers=metadata, response_dict=upload_response)
+			if upload_response['status'] != 201:
+				return False
+			return etag or True
+		elif os.path.isfile(source_path):
 			# TODO: we currently can't use the swift object's upload_file as it does not
 			#				accept the extra_info arguement. A fix is has been merged, but until
 			#       it becomes available we use the swift_client directly
@@ -193,7 +358,37 @@ class SwiftWorker(multiprocessing.Process):
 		
 		# TODO: right now our error checking consists of making sure we get a 201 http response
 		#				this could be enough, but really this deserves more research.
-		return upload_response['status'] == 201
+		if upload_response['status'] != 201:
+			return False
+		return getattr(obj, "etag", None) or True
+
+	@handle_client_exception
+	def copy_object(self, object_name, source_name, metadata):
+		"""
+		Creates object_name as a server-side copy of source_name (a PUT with X-Copy-From), so the data never leaves
+		Swift. The given metadata is set on the copy over that of the source.
+		Will return the etag of the copy (or True if it is not known) iff the returned
+		http status code is 201 (Created), None if the source is not in Swift, False otherwise
+		"""
+		headers = self._massage_metakeys(metadata, self.swift_client.object_meta_prefix)
+		sources = [self.source_mount.name]
+		if self.fallback_mount is not None:
+			sources.append(self.fallback_mount.name)
+		for source_container in sources:
+			headers["X-Copy-From"] = "/%s/%s" % (urllib.quote(source_container), urllib.quote(source_name))
+			call_response = {}
+			try:
+				self.swift_client.connection.put_object(self.swift_mount.name, object_name, None, content_length=0,
+					headers=headers, response_dict=call_response)
+				break
+			except _swift_client.ClientException, e:
+				if e.http_status != 404:
+					raise
+				if source_container == sources[-1]:
+					return None
+		if call_response['status'] != 201:
+			return False
+		return call_response.get('headers', {}).get('etag') or True
 
 	@handle_client_exception
 	def set_object_metadata(self, object_name, metadata):
@@ -205,15 +400,237 @@ class SwiftWorker(multiprocessing.Process):
 		#	      to set the metadata before the object replication completes. This will need some
 		#       thought to find the best way of detecting and dealing with this situation.
 		call_response = {}
-		obj = self.swift_mount.get_object(object_name)
+		obj = self._get_object(object_name)
 		if obj:
-			self.swift_client.set_object_metadata(self.swift_mount, obj, metadata, extra_info = call_response)
+			self.swift_client.set_object_metadata(obj.container, obj, metadata, extra_info = call_response)
 			# TODO: right now our error checking consists of making sure we get a 201 http response
 			#				this could be enough, but really this deserves more research.
 			return call_response['status'] == 202
 		else:
 			return False
 
+	@handle_client_exception
+	def extract_archive(self, archive_path):
+		"""
+		Uploads a tar archive to the container through the bulk middleware, which stores each member as an object.
+		Will return the set of the object names that could not be stored (empty if all were), or None if the request
+		as a whole failed
+		"""
+		upload_path = archive_path
+		if self.containers is not None and len(set(self.containers.values())) > 1:
+			# members bound for several containers are uploaded to the account, with their container in their name
+			upload_path = self._archive_by_container(archive_path)
+			container = None
+		else:
+			if self.containers:
+				self.swift_mount = self._mount(self.containers.values()[0])
+			container = self.swift_mount.name
+		try:
+			for renew in (False, True):
+				url, token = self._auth(renew)
+				parsed, conn = self.swift_client.connection.http_connection(url)
+				path = "%s/?extract-archive=tar" % parsed.path
+				if container is not None:
+					path = "%s/%s/?extract-archive=tar" % (parsed.path, urllib.quote(container))
+				headers = {"X-Auth-Token": token, "Accept": "application/json",
+					"Content-Length": str(os.path.getsize(upload_path))}
+				with open(upload_path, 'rb') as fp:
+					conn.request('PUT', path, ThrottledFile(fp, self.throttle, self.traffic_class, self._throttled), headers)
+					response = conn.getresponse()
+					body = response.read()
+				if response.status != 401:
+					break
+		finally:
+			if upload_path != archive_path:
+				os.unlink(upload_path)
+		if response.status < 200 or response.status >= 300:
+			return None
+		# the middleware answers 200 and puts the real outcome in the body
+		result = json.loads(body)
+		if not result.get("Response Status", "").startswith("2") and not result.get("Errors"):
+			return None
+		containers = set(self.containers.values()) if self.containers else set([self.swift_mount.name])
+		failed = set()
+		for name, status in result.get("Errors", []):
+			name = urllib.unquote(name).lstrip("/")
+			container = name.split("/", 1)[0]
+			if container in containers and "/" in name:
+				name = name.split("/", 1)[1]
+			failed.add(name)
+		return failed
+
+	def _archive_by_container(self, archive_path):
+		"""
+		Rewrites an archive with each member's container as the first part of its name, as an upload to the account
+		expects. Returns the path of the new archive
+		"""
+		fd, path = tempfile.mkstemp(prefix="bulk-", suffix=".tar")
+		with os.fdopen(fd, 'wb') as fp:
+			source = tarfile.open(archive_path, encoding="utf-8")
+			archive = tarfile.open(fileobj=fp, mode='w', format=tarfile.PAX_FORMAT, encoding="utf-8")
+			for member in source:
+				data = source.extractfile(member) if member.isfile() else None
+				member.name = self.containers[member.name] + "/" + member.name
+				# a path header read with the member would be written back and win over the new name
+				member.pax_headers.pop("path", None)
+				archive.addfile(member, data)
+			archive.close()
+			source.close()
+		return path
+
+	def _throttled(self, seconds):
+		if seconds:
+			self.task_stats["throttled"] = self.task_stats.get("throttled", 0) + seconds
+			self.task_throttled.value += seconds
+
+	def _fetch(self, object_name, chunk_size, headers=None):
+		"""
+		GET of an object from its container, or from the fallback container while resharding. Returns the response
+		headers and an iterator over the body
+		"""
+		containers = [self.swift_mount.name]
+		if self.fallback_mount is not None:
+			containers.append(self.fallback_mount.name)
+		hedge = (self.retry_policy.hedge_reads and self.traffic_class == "interactive"
+			and not self.circuit_breaker.is_open())
+		for container in containers:
+			try:
+				if hedge:
+					return self._hedged_get(container, object_name, chunk_size, headers)
+				start = time.time()
+				response = self.swift_client.connection.get_object(container, object_name,
+					resp_chunk_size=chunk_size, headers=headers)
+				self.response_times.append(time.time() - start)
+				return response
+			except _swift_client.ClientException, e:
+				if e.http_status != 404 or container == containers[-1]:
+					raise
+
+	def _hedge_delay(self):
+		if len(self.response_times) < HEDGE_MIN_SAMPLES:
+			return HEDGE_INITIAL_DELAY
+		times = sorted(self.response_times)
+		return max(self.retry_policy.hedge_min_delay, times[int(len(times) * HEDGE_PERCENTILE)])
+
+	def _hedged_get(self, container, object_name, chunk_size, headers):
+		"""
+		Sends a GET and, if it has not answered within the hedging delay, a second one (likely served by another
+		proxy and object server). The first answer is used and the other request is dropped. Each request has its
+		own connection, as swiftclient connections can not be shared between threads.
+		"""
+		for renew in (False, True):
+			url, token = self._auth(renew)
+			try:
+				return self._hedged_get_with(url, token, container, object_name, chunk_size, headers)
+			except _swift_client.ClientException, e:
+				# the token expired: get a new one, once
+				if e.http_status != 401 or renew:
+					raise
+
+	def _auth(self, renew=False):
+		"""
+		Returns the storage URL and token of the connection, authenticating if it has none yet or renew is set (the
+		token was refused). For requests made outside the connection, which does this itself.
+		"""
+		connection = self.swift_client.connection
+		if renew or connection.url is None or connection.token is None:
+			connection.url, connection.token = connection.get_auth()
+		return connection.url, connection.token
+
+	def _hedged_get_with(self, url, token, container, object_name, chunk_size, headers):
+		answers = Queue.Queue()
+		lock = threading.Lock()
+		state = {"answered": False}
+		start = time.time()
+
+		def request(hedged):
+			answer, error = None, None
+			try:
+				answer = _swift_client.get_object(url, token, container, object_name, resp_chunk_size=chunk_size,
+					headers=headers)
+			except Exception, e:
+				error = e
+			with lock:
+				if state["answered"]:
+					# the other request won
+					if answer is not None and hasattr(answer[1], "close"):
+						answer[1].close()
+					return
+				if error is None or self.retry_policy.classify(error) is None:
+					state["answered"] = True
+			answers.put((hedged, answer, error))
+
+		threading.Thread(target=request, args=(False,)).start()
+		outstanding = 1
+		try:
+			hedged, answer, error = answers.get(timeout=self._hedge_delay())
+		except Queue.Empty:
+			threading.Thread(target=request, args=(True,)).start()
+			outstanding = 2
+			hedged, answer, error = answers.get()
+			self.task_stats["hedge"] = "hedge_won" if hedged else "primary_won"
+		outstanding -= 1
+		# a transient failure of one request still leaves the other one
+		while error is not None and self.retry_policy.classify(error) is not None and outstanding:
+			hedged, answer, error = answers.get()
+			outstanding -= 1
+		if error is not None:
+			raise error
+		self.response_times.append(time.time() - start)
+		return answer
+
+	def _route(self, task):
+		"""
+		Points swift_mount (and source_mount, fallback_mount) at the containers named in the task, if any
+		"""
+		args = task.args
+		self.swift_mount = self._mount(args["container"]) if "container" in args.keys() else self.default_mount
+		self.source_mount = self._mount(args["source_container"]) if "source_container" in args.keys() else self.swift_mount
+		fallback = args["fallback_container"] if "fallback_container" in args.keys() else None
+		self.fallback_mount = self._mount(fallback) if fallback else None
+		self.containers = args["containers"] if "containers" in args.keys() else None
+
+	def _mount(self, container):
+		if container not in self.swift_mounts:
+			self.swift_mounts[container] = self.swift_client.get_container(container)
+		return self.swift_mounts[container]
+
+	def _get_object(self, object_name, cached=False):
+		"""
+		The object from its container, or from the fallback container while resharding
+		"""
+		try:
+			return self.swift_mount.get_object(object_name, cached=cached)
+		except pyrax.exceptions.NoSuchObject, e:
+			if self.fallback_mount is None:
+				raise
+			return self.fallback_mount.get_object(object_name, cached=cached)
+
+	@handle_client_exception
+	def replace_object_metadata(self, object_name, metadata):
+		"""
+		Replaces all the metadata of the object with a single POST, without looking at the object first, so metadata
+		has to be complete. An object that does not exist counts as done: there is nothing left to update.
+		Will return true iff the returned http status code is 202 (Accepted) or 404 (Not Found)
+		"""
+		headers = self._massage_metakeys(metadata, self.swift_client.object_meta_prefix)
+		call_response = {}
+		try:
+			self.swift_client.connection.post_object(self.swift_mount.name, object_name, headers, response_dict=call_response)
+		except _swift_client.ClientException, e:
+			if e.http_status != 404:
+				raise
+			if self.fallback_mount is None:
+				return True
+			# not moved to its shard yet
+			try:
+				self.swift_client.connection.post_object(self.fallback_mount.name, object_name, headers, response_dict=call_response)
+			except _swift_client.ClientException, e:
+				if e.http_status == 404:
+					return True
+				raise
+		return call_response['status'] == 202
+
 	# This function was taken from the pyrax library. We need it here, but its a private function
 	# in pyrax, so we'll just copy it incase things change in the library
 	def _massage_metakeys(self, dct, prfx):
@@ -233,14 +650,23 @@ class SwiftTask(object):
 	'''
 	SwiftTask is used to kick off a SwiftWorker job.
 	Arguments:
-		- job_id: The ID of the job
+		- job_id: The ID of the job, given by the JobRegistry when the task is submitted
 		- command: the command name you want the swift worker to execute
 		- args: a dict that contains any needed arguments for the command
+		- traffic_class: "interactive" for requests someone is waiting on (their downloads are hedged and never
+		  held back by the circuit breaker), "background" for the rest, or "bulk" for background work of tools
+		  (a sync) that should be throttled separately. "control" tasks are never held back or throttled.
+		- size: the bytes the task transfers, when known, from which its deadline is derived
 	'''
-	def __init__(self, command, args):
-		self.job_id = randint(0,1000000000)
+	def __init__(self, command, args, traffic_class="background", size=None):
+		self.job_id = None
 		self.command = command
 		self.args = args
+		self.traffic_class = traffic_class
+		self.size = size
+
+	def is_background(self):
+		return self.traffic_class in ("background", "bulk")
 
 class SwiftResponse(object):
 	'''
@@ -249,9 +675,18 @@ class SwiftResponse(object):
 		- job_id: The ID of the job
 		- success: boolean value indicating if the job succeeded or not
 		- error_messagee: if the job did not succeed an optional message can be attached here
+		- command: the command of the task this is the response to
+		- elapsed: the time in seconds the worker spent on the task
+		- result: an optional dict with command specific details of the outcome (e.g. the etag of an upload)
+		- stats: an optional dict of how the task went: "retries" ({failure class: count}), "hedge" (which
+		  request of a hedged download answered first) and "throttled" (seconds spent waiting on the throttle)
 	'''
-	def __init__(self, job_id, success, error_message=""):
+	def __init__(self, job_id, success, error_message="", command=None, elapsed=0.0, result=None, stats=None):
 		self.job_id = job_id
 		self.success = success
 		self.error_message = error_message
+		self.command = command
+		self.elapsed = elapsed
+		self.result = result
+		self.stats = stats
 
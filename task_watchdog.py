@@ -0,0 +1,130 @@
+import logging
+import thread
+import time
+
+from threading import Lock
+
+import metrics
+from swift_worker import SwiftResponse
+
+timeouts = metrics.counter("swift_task_timeouts_total", "SwiftWorker tasks that ran past their deadline, by command")
+reassigned = metrics.counter("swift_tasks_reassigned_total", "Timed out tasks handed to another SwiftWorker, by command")
+recycled = metrics.counter("swift_workers_recycled_total", "Stuck SwiftWorker processes killed and replaced")
+
+def task_units(task):
+	"""
+	How much work a task is: bytes for transfers, objects for batches, nothing beyond the request for the rest
+	"""
+	if task.command in ("download_object", "create_object", "extract_archive"):
+		return task.size or 0
+	if task.command == "set_objects_metadata":
+		return len(task.args["objects"])
+	return 0
+
+# seconds per unit assumed until a command has been observed: 1MB/s, 50ms per object
+DEFAULT_RATES = {"set_objects_metadata": 0.05}
+DEFAULT_RATE = 1.0 / (1024 * 1024)
+MIN_SAMPLE_UNITS = {"set_objects_metadata": 1}
+
+class TaskWatchdog:
+	"""
+	Gives every task handed to the SwiftWorkers a deadline and kills the worker of a task that runs past it. A worker
+	hanging mid-transfer would otherwise keep its node downloading or uploading forever, with read() polling and the
+	job executor deferring every other operation on the path.
+
+	The deadline of a task is timeout plus slack times how long its size should take at the throughput observed for
+	its command (an exponentially weighted average over finished tasks). The stuck worker is terminated and replaced,
+	and the task handed to another worker, up to max_reassignments times; after that it fails with a timeout so its
+	callback clears the node's flags.
+
+	The workers publish the job they are running, since when and the seconds it has spent waiting on the throttle in
+	shared memory (SwiftWorker.current_job, SwiftWorker.task_started, SwiftWorker.task_throttled), which is what the
+	watchdog checks every interval seconds against the tasks of the source's JobRegistry. Throttle waits do not count
+	against the deadline.
+
+	Parameters
+		swift_source: the SwiftSource whose workers are watched
+		timeout: seconds every task gets regardless of its size
+		slack: factor over the expected transfer time
+		max_reassignments: times a timed out task is tried again
+		interval: seconds between checks
+	"""
+	def __init__(self, swift_source, timeout=60.0, slack=4.0, max_reassignments=1, interval=1.0):
+		self.logger = logging.getLogger('swift')
+		self.swift_source = swift_source
+		self.timeout = timeout
+		self.slack = slack
+		self.max_reassignments = max_reassignments
+		self.interval = interval
+		self.lock = Lock()
+		# job id -> times the task timed out
+		self.timed_out = {}
+		# command -> observed seconds per unit
+		self.rates = {}
+
+	@staticmethod
+	def from_config(swift_source, config):
+		"""
+		Config keys: task_timeout, task_timeout_slack and task_max_reassignments
+		"""
+		return TaskWatchdog(swift_source,
+			float(config["task_timeout"]) if "task_timeout" in config else 60.0,
+			float(config["task_timeout_slack"]) if "task_timeout_slack" in config else 4.0,
+			int(config["task_max_reassignments"]) if "task_max_reassignments" in config else 1)
+
+	def start(self):
+		thread.start_new_thread(self._watchdog_thread_main, ())
+
+	def finished(self, task, response):
+		"""
+		Takes note of how long a task took
+		"""
+		with self.lock:
+			self.timed_out.pop(response.job_id, None)
+		units = task_units(task)
+		# small transfers are mostly request overhead and say little about throughput
+		if response.success and units >= MIN_SAMPLE_UNITS.get(task.command, 1024 * 1024) and response.elapsed > 0:
+			rate = response.elapsed / units
+			previous = self.rates.get(task.command)
+			self.rates[task.command] = rate if previous is None else 0.8 * previous + 0.2 * rate
+
+	def deadline(self, task):
+		rate = self.rates.get(task.command, DEFAULT_RATES.get(task.command, DEFAULT_RATE))
+		return self.timeout + self.slack * rate * task_units(task)
+
+	def _check(self):
+		now = time.time()
+		for index, worker in enumerate(self.swift_source.workers):
+			job_id = worker.current_job.value
+			if not job_id:
+				continue
+			task = self.swift_source.jobs.task(job_id)
+			if task is None:
+				continue
+			# time held back by the throttle is not the worker being stuck
+			running = now - worker.task_started.value - worker.task_throttled.value
+			if running <= self.deadline(task):
+				continue
+			timeouts.inc(command=task.command)
+			self.logger.error("%s of job %d on %s stuck for %.0fs, recycling the worker", task.command, job_id,
+				worker.name, running)
+			self.swift_source.replace_worker(index)
+			recycled.inc()
+			with self.lock:
+				attempts = self.timed_out.get(job_id, 0) + 1
+				self.timed_out[job_id] = attempts
+			if attempts <= self.max_reassignments:
+				reassigned.inc(command=task.command)
+				self.swift_source.task_queue.put(task)
+			else:
+				# answered like any failed task, so the callback clears the node's flags
+				self.swift_source.response_queue.put(SwiftResponse(job_id, False,
+					"timed out after %.0fs" % running, task.command, running))
+
+	def _watchdog_thread_main(self):
+		while True:
+			time.sleep(self.interval)
+			try:
+				self._check()
+			except Exception, e:
+				self.logger.error("error checking swift task deadlines: %s", e)
@@ -0,0 +1,154 @@
+import logging
+import multiprocessing
+import os
+import thread
+import time
+
+import metrics
+
+# the classes of SwiftTask.traffic_class that can be limited; "control" tasks never are
+TRAFFIC_CLASSES = ("interactive", "background", "bulk")
+
+rates = metrics.gauge("swift_throttle_rate", "Configured limits of the Swift traffic by class and kind (bytes or "
+	"requests per second), 0 meaning unlimited")
+
+class TokenBucket:
+	"""
+	A token bucket in shared memory, so all the SwiftWorker processes draw from the same one. Tokens come in at rate
+	per second, 0 meaning unlimited, and up to burst of them collect while the bucket is not used.
+
+	Taking more tokens than there are puts the bucket in debt and the taker sleeps until the debt is paid off, so a
+	chunk larger than the bucket can be taken and the rate still holds on average.
+	"""
+	def __init__(self, rate=0.0, burst=None):
+		self.lock = multiprocessing.Lock()
+		self.rate = multiprocessing.RawValue('d', 0.0)
+		self.burst = multiprocessing.RawValue('d', 0.0)
+		self.tokens = multiprocessing.RawValue('d', 0.0)
+		self.updated = multiprocessing.RawValue('d', time.time())
+		self.set_rate(rate, burst)
+
+	def set_rate(self, rate, burst=None):
+		"""
+		Changes the rate, and the burst (one second's worth of tokens unless given)
+		"""
+		with self.lock:
+			self.rate.value = rate
+			self.burst.value = burst if burst is not None else rate
+			self.tokens.value = min(self.tokens.value, self.burst.value)
+
+	def take(self, amount):
+		"""
+		Takes amount tokens, sleeping as long as the rate requires. Returns the seconds slept
+		"""
+		rate = self.rate.value
+		if rate <= 0:
+			return 0
+		with self.lock:
+			now = time.time()
+			self.tokens.value = min(self.burst.value, self.tokens.value + (now - self.updated.value) * rate)
+			self.updated.value = now
+			self.tokens.value -= amount
+			wait = -self.tokens.value / rate if self.tokens.value < 0 else 0
+		if wait:
+			time.sleep(wait)
+		return wait
+
+class Throttle:
+	"""
+	Limits the bytes per second and the requests per second of each traffic class, so bulk work (a sync, a burst of
+	uploads after a big write) can run next to live users without saturating the uplink or the Swift proxies. The
+	SwiftWorkers take a request token before every request and byte tokens as they move each chunk of data.
+
+	The limits live in shared memory, so they can be changed on a running mount (see configure and watch) and all the
+	workers see the new values at once.
+	"""
+	def __init__(self):
+		self.logger = logging.getLogger('swift')
+		self.buckets = dict(((traffic_class, kind), TokenBucket()) for traffic_class in TRAFFIC_CLASSES
+			for kind in ("bytes", "requests"))
+		for traffic_class, kind in self.buckets:
+			rates.set(0, traffic_class=traffic_class, kind=kind)
+
+	@staticmethod
+	def from_config(config):
+		throttle = Throttle()
+		throttle.configure(config)
+		return throttle
+
+	def configure(self, config):
+		"""
+		Sets the limits from the config keys throttle.<class>.bytes_per_second and throttle.<class>.requests_per_second,
+		where class is interactive, background or bulk. A limit missing from the config is lifted.
+		"""
+		for traffic_class, kind in self.buckets:
+			key = "throttle.%s.%s_per_second" % (traffic_class, kind)
+			self.set_rate(traffic_class, kind, float(config[key]) if key in config else 0.0)
+
+	def watch(self, load_config, paths, interval=5.0):
+		"""
+		Configures the limits again, from load_config(), whenever one of the config files at paths changes. Polling is
+		used rather than a signal because Python only runs signal handlers in the main thread, which a multithreaded
+		mount leaves inside the libfuse loop until it is unmounted.
+		"""
+		thread.start_new_thread(self._watch_thread_main, (load_config, paths, interval))
+
+	def set_rate(self, traffic_class, kind, rate):
+		self.buckets[(traffic_class, kind)].set_rate(rate)
+		rates.set(rate, traffic_class=traffic_class, kind=kind)
+
+	def limited(self, traffic_class, kind):
+		bucket = self.buckets.get((traffic_class, kind))
+		return bucket is not None and bucket.rate.value > 0
+
+	def transfer(self, traffic_class, nbytes):
+		"""
+		Waits until nbytes may be moved. Returns the seconds waited
+		"""
+		bucket = self.buckets.get((traffic_class, "bytes"))
+		return bucket.take(nbytes) if bucket is not None else 0
+
+	def request(self, traffic_class):
+		"""
+		Waits until a request may be sent. Returns the seconds waited
+		"""
+		bucket = self.buckets.get((traffic_class, "requests"))
+		return bucket.take(1) if bucket is not None else 0
+
+	def _watch_thread_main(self, load_config, paths, interval):
+		def modified():
+			return [os.stat(path).st_mtime if os.path.exists(path) else None for path in paths]
+		seen = modified()
+		while True:
+			time.sleep(interval)
+			try:
+				current = modified()
+				if current != seen:
+					seen = current
+					self.configure(load_config())
+					self.logger.info("throttle limits reloaded from the config")
+			except Exception, e:
+				self.logger.error("unable to reload the throttle limits: %s", e)
+
+class ThrottledFile:
+	"""
+	A file object whose reads wait on the throttle, for uploads that read the data themselves
+	"""
+	def __init__(self, fp, throttle, traffic_class, waited):
+		self.fp = fp
+		self.throttle = throttle
+		self.traffic_class = traffic_class
+		# callback getting the seconds each read waited
+		self.waited = waited
+
+	def read(self, size=-1):
+		data = self.fp.read(size)
+		if data:
+			self.waited(self.throttle.transfer(self.traffic_class, len(data)))
+		return data
+
+	def tell(self):
+		return self.fp.tell()
+
+	def seek(self, offset, whence=0):
+		self.fp.seek(offset, whence)
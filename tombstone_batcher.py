@@ -0,0 +1,107 @@
+import logging
+import thread
+import time
+
+from threading import Lock
+
+import metrics
+
+tombstones = metrics.counter("tombstones_total", "Objects tombstoned through the tombstone batcher, by result")
+tombstone_batches = metrics.counter("tombstone_batches_total", "Batches of tombstones handed to the Swift workers")
+
+class TombstoneBatcher:
+	"""
+	Groups the metadata updates that tombstone objects (unlink, rmdir, the source of a rename) into batches, each of
+	them one worker task. An rm -rf of a large tree arrives as one unlink or rmdir per entry; instead of one queued job
+	per path, each doing a HEAD before its POST, the tombstones collect for up to delay seconds and go out batch_size
+	objects at a time, spread over all the workers, with a single POST per object carrying the node's full metadata.
+
+	Callers only hand over tombstones for nodes with no upload or other Swift operation outstanding, since nothing
+	here orders them after those.
+
+	Progress is reported in aggregate: the tombstones_total counter, and a log line once a run of tombstones has
+	been completely sent.
+
+	Parameters
+		swift_connection: the SwiftSource (or stand-in) to send the batches to
+		batch_size: objects per worker task
+		delay: seconds a tombstone waits for others to join its batch
+	"""
+	def __init__(self, swift_connection, batch_size=100, delay=0.05):
+		self.logger = logging.getLogger('fuse')
+		self.swift_connection = swift_connection
+		self.batch_size = batch_size
+		self.delay = delay
+		self.lock = Lock()
+		# (path, metadata, callback) of the tombstones waiting to be sent
+		self.pending = []
+		# batches handed to the workers and not answered yet
+		self.in_flight = 0
+		# totals of the current run, reported and reset once nothing is pending or in flight
+		self.run_started_at = None
+		self.run_completed = 0
+		self.run_failed = 0
+		metrics.gauge("tombstones_pending", "Tombstones waiting to be sent", lambda: len(self.pending))
+
+	def start(self):
+		thread.start_new_thread(self._flush_thread_main, ())
+
+	def add(self, path, metadata, callback):
+		"""
+		Queues a tombstone. metadata is the complete metadata of the object, fs-deleted-on included; the callback gets
+		(success, error_message) once Swift has answered for this object.
+		"""
+		with self.lock:
+			if self.run_started_at is None:
+				self.run_started_at = time.time()
+			self.pending.append((path.lstrip("/"), metadata, callback))
+
+	def flush(self):
+		with self.lock:
+			batch, self.pending = self.pending, []
+			self.in_flight += (len(batch) + self.batch_size - 1) / self.batch_size
+		for start in xrange(0, len(batch), self.batch_size):
+			self._submit(batch[start:start + self.batch_size])
+
+	def _submit(self, batch):
+		callbacks = [(path, callback) for path, metadata, callback in batch]
+		def done(success, error_message, result=None):
+			if result is not None:
+				failed = set(result["failed"])
+			elif success:
+				failed = set()
+			else:
+				failed = set(path for path, callback in callbacks)
+			tombstones.inc(len(callbacks) - len(failed), result="done")
+			if failed:
+				tombstones.inc(len(failed), result="failed")
+			for path, callback in callbacks:
+				try:
+					if path in failed:
+						callback(False, error_message)
+					else:
+						callback(True, None)
+				except Exception, e:
+					self.logger.error("error in the tombstone callback of %s: %s", path, e)
+			with self.lock:
+				self.in_flight -= 1
+				self.run_completed += len(callbacks) - len(failed)
+				self.run_failed += len(failed)
+				if self.in_flight == 0 and not self.pending:
+					self.logger.info("tombstoned %d objects (%d failed) in %.1fs", self.run_completed + self.run_failed,
+						self.run_failed, time.time() - self.run_started_at)
+					self.run_started_at = None
+					self.run_completed = 0
+					self.run_failed = 0
+
+		tombstone_batches.inc()
+		self.swift_connection.set_objects_metadata([(path, metadata) for path, metadata, callback in batch], done)
+
+	def _flush_thread_main(self):
+		while True:
+			time.sleep(self.delay)
+			try:
+				if self.pending:
+					self.flush()
+			except Exception, e:
+				self.logger.error("sending tombstones failed: %s", e)
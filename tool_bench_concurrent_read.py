@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+import argparse
+import os
+import random
+import tempfile
+import time
+from sys import exit
+from threading import Lock, Thread
+
+import posix_io
+
+'''
+Compares read throughput of the old read path (lseek + read under one global lock) against positional reads
+(posix_io.pread) as the number of reader threads grows. Reads all hit the page cache after the first pass, so this
+measures the overhead of the read path itself.
+'''
+
+global_lock = Lock()
+
+def locked_read(fd, size, offset):
+	with global_lock:
+		os.lseek(fd, offset, 0)
+		return os.read(fd, size)
+
+def reader(read_function, fd, file_size, chunk_size, reads, totals):
+	read_bytes = 0
+	for i in xrange(reads):
+		offset = random.randrange(0, file_size - chunk_size)
+		read_bytes += len(read_function(fd, chunk_size, offset))
+	totals.append(read_bytes)
+
+def run(read_function, fd, file_size, chunk_size, threads, reads):
+	totals = []
+	workers = [Thread(target=reader, args=(read_function, fd, file_size, chunk_size, reads, totals)) for i in xrange(threads)]
+	start = time.time()
+	for worker in workers:
+		worker.start()
+	for worker in workers:
+		worker.join()
+	elapsed = time.time() - start
+	return sum(totals) / elapsed / (1024 * 1024)
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Reports read throughput by number of threads")
+	parser.add_argument("-s", "--file_size", type=int, default=64, help="Size of the test file in MB")
+	parser.add_argument("-c", "--chunk_size", type=int, default=128, help="Size of each read in KB")
+	parser.add_argument("-r", "--reads", type=int, default=5000, help="Reads per thread")
+	parser.add_argument("-t", "--threads", default="1,2,4,8,16", help="Comma separated thread counts to test")
+	args = parser.parse_args()
+
+	file_size = args.file_size * 1024 * 1024
+	chunk_size = args.chunk_size * 1024
+	handle, test_path = tempfile.mkstemp()
+	try:
+		block = os.urandom(1024 * 1024)
+		for i in xrange(args.file_size):
+			os.write(handle, block)
+		fd = os.open(test_path, os.O_RDONLY)
+
+		print "threads   lseek+read (MB/s)   pread (MB/s)"
+		for threads in [int(t) for t in args.threads.split(",")]:
+			locked = run(locked_read, fd, file_size, chunk_size, threads, args.reads)
+			positional = run(posix_io.pread, fd, file_size, chunk_size, threads, args.reads)
+			print "%7d   %17.1f   %12.1f" % (threads, locked, positional)
+		os.close(fd)
+	finally:
+		os.close(handle)
+		os.unlink(test_path)
+	exit()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+import argparse
+import random
+import resource
+import time
+from sys import exit
+
+from fsnode import FSNode
+
+class BenchObject:
+	'''
+	Stands in for a pyrax StorageObject; only what FSNode.update_from_swift needs
+	'''
+	def __init__(self, name, metadata):
+		self.name = name
+		self.metadata = metadata
+
+	def get_metadata(self):
+		return self.metadata
+
+def object_names(count, files_per_folder):
+	'''
+	Generates names laid out like a Moodle filedir: filedir/xx/yy/<sha1-like name>
+	'''
+	for i in xrange(count):
+		folder = i / files_per_folder
+		yield "filedir/%0.2x/%0.2x/%040x" % ((folder >> 8) & 0xff, folder & 0xff, i)
+
+def max_rss_bytes():
+	# ru_maxrss is reported in kilobytes on Linux
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Reports FSNode memory use per node and lookup latency")
+	parser.add_argument("-n", "--nodes", type=int, default=1000000, help="The number of nodes to create")
+	parser.add_argument("-f", "--files_per_folder", type=int, default=16, help="The number of files in each folder")
+	parser.add_argument("-l", "--lookups", type=int, default=100000, help="The number of lookups to time")
+	args = parser.parse_args()
+
+	metadata = {
+		'x-object-meta-fs-mode': "33188",
+		'x-object-meta-fs-uid': "33",
+		'x-object-meta-fs-gid': "33",
+		'x-object-meta-fs-mtime': "1400000000.000000",
+		'x-object-meta-fs-atime': "1400000000.000000",
+		'x-object-meta-fs-ctime': "1400000000.000000",
+		'x-object-meta-fs-nlink': "1",
+		'x-object-meta-fs-size': "4096"
+	}
+
+	names = list(object_names(args.nodes, args.files_per_folder))
+	rss_before = max_rss_bytes()
+	start = time.time()
+	for name in names:
+		node = FSNode()
+		node.update_from_swift(BenchObject(name, metadata))
+		node.save()
+	load_time = time.time() - start
+	rss_after = max_rss_bytes()
+
+	sample = random.sample(names, min(args.lookups, len(names)))
+	start = time.time()
+	for name in sample:
+		FSNode.get_by_path(name)
+	lookup_time = time.time() - start
+
+	print "nodes:            %d" % args.nodes
+	print "folders:          %d" % len(FSNode._fsdata)
+	print "bytes per node:   %.1f" % (float(rss_after - rss_before) / args.nodes)
+	print "load time:        %.2fs (%.2fus per node)" % (load_time, load_time * 1000000 / args.nodes)
+	print "lookup latency:   %.2fus" % (lookup_time * 1000000 / len(sample))
+	exit()
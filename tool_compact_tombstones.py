@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import logging, logging.config
+import os
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from sys import exit
+import urllib
+
+import pyrax
+from swiftclient import client as _swift_client
+
+from config import Config
+from container_map import ContainerMap
+
+'''
+Deletes only tombstone objects (they get an fs-deleted-on metadata value), so tombstones pile up in the container and
+every listing, prefetch and directory read pays for them. This purges tombstones older than a retention window,
+either deleting them outright or moving them (server-side copy, then delete) to an archive container.
+
+Snapshot mounts keep working for any snapshot time inside the retention window: a snapshot only shows objects deleted
+after its time, and only objects deleted before the window starts are purged.
+
+Every container of a sharded mount is compacted (see ContainerMap), the fallback container of a resharding included.
+
+Running mounts with metadata_sync_interval set forget purged objects on their next poll. Purged paths are also pruned
+from the file manifest (see tool_build_modified_table.py) when one is given.
+'''
+
+local = threading.local()
+
+def connection():
+	'''
+	swiftclient connections are not thread safe, so every thread of the pool gets its own
+	'''
+	if not hasattr(local, "client"):
+		local.client = pyrax.connect_to_cloudfiles(config["swift.region_name"])
+	return local.client.connection
+
+def list_container(container, page_size):
+	'''
+	Yields every object of the container listing as a dict with name, bytes, hash and last_modified
+	'''
+	marker = None
+	while True:
+		headers, page = connection().get_container(container, marker=marker, limit=page_size)
+		for obj in page:
+			yield obj
+		if len(page) < page_size:
+			return
+		marker = page[-1]["name"]
+
+def deleted_on(container, name):
+	try:
+		headers = connection().head_object(container, name)
+	except _swift_client.ClientException, e:
+		if e.http_status == 404:
+			return None
+		raise
+	if "x-object-meta-fs-deleted-on" in headers:
+		return float(headers["x-object-meta-fs-deleted-on"])
+	return None
+
+def purge(container, archive_container, name, deletion_time):
+	'''
+	Deletes a tombstoned object, after copying it to the archive container if there is one. Returns whether it worked,
+	or None when the object is no longer the tombstone found by the scan
+	'''
+	try:
+		# the scan may be hours old by now; a path written again since (Moodle re-adds a file under the same sha1
+		# path) is live and must stay
+		if deleted_on(container, name) != deletion_time:
+			return None
+		if archive_container:
+			connection().put_object(archive_container, name, None, content_length=0,
+				headers={"X-Copy-From": "/%s/%s" % (urllib.quote(container), urllib.quote(name))})
+		connection().delete_object(container, name)
+		return True
+	except _swift_client.ClientException, e:
+		if e.http_status == 404:
+			# someone else got there first
+			return True
+		logging.getLogger('swift').error("unable to purge %s: %s", name, e)
+		return False
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Purges tombstoned objects older than a retention window")
+	parser.add_argument("-c", "--config", help="The config file to be used")
+	parser.add_argument("-d", "--days", type=float, required=True, help="Retention window; only tombstones older than this many days are purged")
+	parser.add_argument("-a", "--archive_container", help="Move purged objects to this container instead of deleting them")
+	parser.add_argument("-m", "--file_manifest", help="A file manifest to prune the purged paths from")
+	parser.add_argument("-t", "--threads", type=int, default=32, help="Concurrent Swift requests")
+	parser.add_argument("-b", "--batch_size", type=int, default=1000, help="Objects purged per batch between progress reports")
+	parser.add_argument("-n", "--dry_run", action="store_true", help="Only report what would be purged")
+	args = parser.parse_args()
+
+	config = Config(args.config) if args.config else Config()
+	logging.config.fileConfig('logging.conf')
+
+	pyrax.settings.set('identity_type', 'keystone')
+	pyrax.set_setting("auth_endpoint", config["swift.auth_url"])
+	pyrax.set_credentials(username=config["swift.username"], api_key=config["swift.password"], tenant_id=config["swift.tenant_id"])
+	container_map = ContainerMap.from_config(config)
+	containers = container_map.containers()
+	if container_map.fallback is not None:
+		containers.append(container_map.fallback)
+	if args.archive_container and not args.dry_run:
+		connection().put_container(args.archive_container)
+
+	cutoff = time.time() - args.days * 86400
+	pool = ThreadPool(args.threads)
+	start = time.time()
+
+	listed = 0
+	sizes = {}
+	purged = []
+	failed = 0
+	changed = 0
+	for container in containers:
+		# the listing has no metadata, so every object takes a HEAD to find its tombstone
+		listing = list(list_container(container, 10000))
+		listed += len(listing)
+		sizes.update((obj["name"], obj["bytes"]) for obj in listing)
+		print "%d objects in %s, looking for tombstones from before %s" % (len(listing), container, time.ctime(cutoff))
+		deletion_times = pool.map(lambda obj: deleted_on(container, obj["name"]), listing, chunksize=100)
+		tombstones = [obj["name"] for obj, deleted in zip(listing, deletion_times) if deleted is not None]
+		expired = [(obj["name"], deleted) for obj, deleted in zip(listing, deletion_times)
+			if deleted is not None and deleted < cutoff]
+		print "%d tombstones, %d of them older than %g days (%d bytes)" % (len(tombstones), len(expired), args.days,
+			sum(sizes[name] for name, deleted in expired))
+
+		if not args.dry_run:
+			purged_here = 0
+			for batch_start in xrange(0, len(expired), args.batch_size):
+				batch = expired[batch_start:batch_start + args.batch_size]
+				results = pool.map(lambda (name, deleted): purge(container, args.archive_container, name, deleted), batch)
+				purged.extend(name for (name, deleted), success in zip(batch, results) if success)
+				purged_here += results.count(True)
+				failed += results.count(False)
+				changed += results.count(None)
+				print "%d of %d purged (%d failed, %d changed since the scan and kept)" % (purged_here, len(expired),
+					failed, changed)
+	pool.close()
+
+	if purged and args.file_manifest and os.path.isfile(args.file_manifest):
+		with open(args.file_manifest, 'r') as json_file:
+			manifest = json.load(json_file)
+		pruned = 0
+		for name in purged:
+			if manifest.pop(name, None) is not None:
+				pruned += 1
+		with open(args.file_manifest, 'w') as json_file:
+			json_file.write(json.dumps(manifest))
+		print "%d entries pruned from %s" % (pruned, args.file_manifest)
+
+	reclaimed = sum(sizes[name] for name in purged)
+	print "%s %d objects (%d bytes%s) in %.1fs; the listing went from %d to %d objects (%.1f%% smaller)" % (
+		"moved" if args.archive_container else "purged", len(purged), reclaimed,
+		" moved to %s" % args.archive_container if args.archive_container else " reclaimed", time.time() - start,
+		listed, listed - len(purged), 100.0 * len(purged) / listed if listed else 0)
+	exit(1 if failed else 0)
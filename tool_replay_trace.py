@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+
+import argparse
+import logging, logging.config
+import os
+import shutil
+import stat
+import tempfile
+import time
+from sys import exit
+
+import file_system
+from file_system import FileSystem
+from local_swift_source import LocalSwiftSource
+import operation_trace
+
+'''
+Replays a trace recorded with trace_path (see operation_trace.TraceRecorder) against a FileSystem backed by a
+LocalSwiftSource, either at the recorded pace or as fast as possible, and reports the latency distribution of every
+operation next to the one that was recorded.
+
+Objects the trace reads but never creates are generated in the local container before the replay starts, with the
+sizes the trace implies.
+'''
+
+# operations that bring a path into existence; anything else needs the object to be there beforehand
+CREATING_OPERATIONS = frozenset(['create', 'mkdir', 'symlink'])
+DIRECTORY_OPERATIONS = frozenset(['readdir', 'rmdir', 'opendir', 'releasedir'])
+# operations that are not meaningful outside a real mount
+SKIPPED_OPERATIONS = frozenset(['statfs', 'init', 'destroy'])
+
+def parent_folders(path):
+	parts = path.split("/")[:-1]
+	return ["/".join(parts[:i]) for i in xrange(1, len(parts) + 1)]
+
+def prepare_container(swift, entries, staging_dir):
+	'''
+	Creates every object the trace expects to already exist
+	'''
+	sizes = {}
+	directories = set()
+	created = set()
+	for entry in entries:
+		path = entry["path"]
+		if path is None:
+			continue
+		path = path.lstrip("/")
+		directories.update(parent_folders(path))
+		if entry["op"] in CREATING_OPERATIONS:
+			created.add(path)
+		if path in created or "err" in entry:
+			continue
+		if entry["op"] in DIRECTORY_OPERATIONS:
+			directories.add(path)
+		elif entry["op"] == "read" and entry.get("res"):
+			offset = entry["args"][1]
+			sizes[path] = max(sizes.get(path, 0), offset + entry["res"])
+		elif entry["op"] not in ("getattr", "access") or path not in sizes:
+			sizes.setdefault(path, 0)
+	directories.discard("")
+	directories -= created
+
+	now = time.time()
+	def metadata(mode, size):
+		return {"fs-mode": "%i" % mode, "fs-uid": "%i" % os.getuid(), "fs-gid": "%i" % os.getgid(),
+			"fs-mtime": "%f" % now, "fs-atime": "%f" % now, "fs-ctime": "%f" % now, "fs-nlink": "1", "fs-size": "%i" % size}
+
+	for directory in directories:
+		swift.put_object(directory, None, metadata(stat.S_IFDIR | 0755, 0))
+	staging_file = os.path.join(staging_dir, "object")
+	for path, size in sizes.iteritems():
+		if path in directories:
+			continue
+		with open(staging_file, 'wb') as fp:
+			fp.truncate(size)
+		swift.put_object(path, staging_file, metadata(stat.S_IFREG | 0644, size))
+	return len(directories), len(sizes)
+
+def replay_arguments(entry, handles, fs):
+	'''
+	Turns a trace entry back into the arguments of the FUSE call, mapping recorded file handles to live ones
+	'''
+	op, path, args = entry["op"], entry["path"], list(entry["args"])
+	def handle(recorded):
+		if recorded in handles:
+			return handles[recorded]
+		# opened before recording started
+		live = fs("open", path, os.O_RDWR)
+		handles[recorded] = live
+		return live
+
+	if op == "read":
+		return [args[0], args[1], handle(args[2])]
+	if op == "write":
+		return ["\0" * args[0], args[1], handle(args[2])]
+	if op in ("release", "flush"):
+		return [handle(args[0])]
+	if op == "fsync":
+		return [args[0], handle(args[1])]
+	if op == "truncate" and len(args) > 1 and args[1]:
+		return [args[0], handle(args[1])]
+	if op == "getattr":
+		return [None]
+	return args
+
+def percentile(sorted_values, fraction):
+	if not sorted_values:
+		return 0.0
+	return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+def report(recorded, replayed, errors):
+	print "%-10s %8s %7s   %-31s   %-31s" % ("op", "count", "errors", "recorded p50/p99/max (ms)", "replayed p50/p99/max (ms)")
+	for op in sorted(replayed):
+		old = sorted(recorded[op])
+		new = sorted(replayed[op])
+		print "%-10s %8d %7d   %9.3f %9.3f %9.3f   %9.3f %9.3f %9.3f" % (op, len(new), errors.get(op, 0),
+			percentile(old, 0.5) * 1000, percentile(old, 0.99) * 1000, (old[-1] if old else 0) * 1000,
+			percentile(new, 0.5) * 1000, percentile(new, 0.99) * 1000, new[-1] * 1000)
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Replays a FUSE operation trace against a local Swift stand-in")
+	parser.add_argument("trace", help="The trace file to replay")
+	parser.add_argument("-s", "--speed", type=float, default=0,
+		help="Replay speed relative to the recording (1 is the recorded pace); 0 replays as fast as possible")
+	parser.add_argument("-l", "--latency", type=float, default=0.0, help="Seconds of latency added to every Swift request")
+	parser.add_argument("-w", "--work_dir", help="Where to keep the local container and cache (default: a temporary directory)")
+	args = parser.parse_args()
+
+	logging.config.fileConfig('logging.conf')
+
+	# outside of a real mount there is no FUSE request context to ask for the caller's ids
+	file_system.fuse_get_context = lambda: (os.getuid(), os.getgid(), os.getpid())
+
+	work_dir = args.work_dir or tempfile.mkdtemp(prefix="replay-")
+	cache_dir = os.path.join(work_dir, "cache")
+	if not os.path.exists(cache_dir):
+		os.makedirs(cache_dir)
+
+	entries = list(operation_trace.load(args.trace))
+	swift = LocalSwiftSource(os.path.join(work_dir, "swift"), latency=args.latency)
+	directories, files = prepare_container(swift, entries, work_dir)
+	print "replaying %d operations (%d directories and %d files generated)" % (len(entries), directories, files)
+
+	fs = FileSystem({"cache_dir": cache_dir, "metadata_collection": "lazy"}, swift)
+
+	handles = {}
+	recorded = {}
+	replayed = {}
+	errors = {}
+	replay_start = time.time()
+	trace_start = entries[0]["t"] if entries else 0
+	for entry in entries:
+		op = entry["op"]
+		if op in SKIPPED_OPERATIONS:
+			continue
+		if args.speed > 0:
+			delay = (entry["t"] - trace_start) / args.speed - (time.time() - replay_start)
+			if delay > 0:
+				time.sleep(delay)
+		start = time.time()
+		try:
+			result = fs(op, entry["path"], *replay_arguments(entry, handles, fs))
+			if op in ("open", "create") and "res" in entry:
+				handles[entry["res"]] = result
+		except (OSError, IOError), e:
+			errors[op] = errors.get(op, 0) + 1
+		except Exception, e:
+			errors[op] = errors.get(op, 0) + 1
+			logging.getLogger('fuse').error("replaying %s on %s failed: %s", op, entry["path"], e)
+		replayed.setdefault(op, []).append(time.time() - start)
+		recorded.setdefault(op, []).append(entry["dur"])
+
+	print "replayed in %.2fs (recorded over %.2fs)" % (time.time() - replay_start, (entries[-1]["t"] - trace_start) if entries else 0)
+	report(recorded, replayed, errors)
+	if not args.work_dir:
+		shutil.rmtree(work_dir, ignore_errors=True)
+	exit()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+import argparse
+import logging, logging.config
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from sys import exit
+import urllib
+
+import pyrax
+from swiftclient import client as _swift_client
+
+from config import Config
+from container_map import ContainerMap
+
+'''
+Moves the objects of an existing container into the shard containers of a sharded mount (see ContainerMap), while the
+mounts keep running.
+
+	1. set shard_count (and shard_key) in the config, with shard_fallback_container naming the old container, and
+	   remount. Mounts now write to the shards, and look for anything not found in its shard in the old container.
+	2. run this tool with the old container as --source. Every object is copied server-side into its shard, unless
+	   the shard already has it (it was written since step 1, so it is newer), and the copy's etag checked afterwards.
+	3. once a run reports nothing left to copy, remove shard_fallback_container from the config and remount, then
+	   rerun with --delete (or delete the old container).
+
+The tool can be stopped and rerun at any time; objects already in their shard are skipped.
+'''
+
+local = threading.local()
+
+def connection():
+	'''
+	swiftclient connections are not thread safe, so every thread of the pool gets its own
+	'''
+	if not hasattr(local, "client"):
+		local.client = pyrax.connect_to_cloudfiles(config["swift.region_name"])
+	return local.client.connection
+
+def list_container(container, page_size):
+	'''
+	Yields every object of the container listing as a dict with name, bytes, hash and last_modified
+	'''
+	marker = None
+	while True:
+		headers, page = connection().get_container(container, marker=marker, limit=page_size)
+		for obj in page:
+			yield obj
+		if len(page) < page_size:
+			return
+		marker = page[-1]["name"]
+
+def move(source, target, name, delete):
+	'''
+	Copies an object into its shard and checks the copy has the source's etag. The server-side copy carries the
+	metadata along, which is not posted again: a mount may have changed the target's since. Returns "copied",
+	"present" (the shard had it already) or "failed"
+	'''
+	try:
+		try:
+			# If-None-Match keeps a newer object written by a mount since sharding was turned on
+			connection().put_object(target, name, None, content_length=0, headers={
+				"X-Copy-From": "/%s/%s" % (urllib.quote(source), urllib.quote(name)), "If-None-Match": "*"})
+			result = "copied"
+		except _swift_client.ClientException, e:
+			if e.http_status != 412:
+				raise
+			result = "present"
+		if result == "copied":
+			source_headers = connection().head_object(source, name)
+			target_headers = connection().head_object(target, name)
+			if source_headers["etag"] != target_headers["etag"]:
+				raise Exception("etag %s of the copy does not match %s" % (target_headers["etag"], source_headers["etag"]))
+		if delete:
+			connection().delete_object(source, name)
+		return result
+	except _swift_client.ClientException, e:
+		if e.http_status == 404:
+			# gone from the source since it was listed
+			return "present"
+		logging.getLogger('swift').error("unable to move %s to %s: %s", name, target, e)
+	except Exception, e:
+		logging.getLogger('swift').error("unable to move %s to %s: %s", name, target, e)
+	return "failed"
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Moves the objects of a container into the shard containers of the configured ContainerMap")
+	parser.add_argument("-c", "--config", help="The config file to be used")
+	parser.add_argument("-s", "--source", help="The container to move objects out of (default: shard_fallback_container)")
+	parser.add_argument("-d", "--delete", action="store_true", help="Delete each object from the source once it is in its shard")
+	parser.add_argument("-t", "--threads", type=int, default=32, help="Concurrent Swift requests")
+	parser.add_argument("-b", "--batch_size", type=int, default=1000, help="Objects moved per batch between progress reports")
+	parser.add_argument("-n", "--dry_run", action="store_true", help="Only report where objects would go")
+	args = parser.parse_args()
+
+	config = Config(args.config) if args.config else Config()
+	logging.config.fileConfig('logging.conf')
+
+	container_map = ContainerMap.from_config(config)
+	source = args.source or container_map.fallback
+	if container_map.shard_count <= 1 or source is None:
+		print "shard_count must be set, and the source container given with --source or shard_fallback_container"
+		exit(2)
+	if source in container_map.containers():
+		print "%s is one of the shards" % source
+		exit(2)
+
+	pyrax.settings.set('identity_type', 'keystone')
+	pyrax.set_setting("auth_endpoint", config["swift.auth_url"])
+	pyrax.set_credentials(username=config["swift.username"], api_key=config["swift.password"], tenant_id=config["swift.tenant_id"])
+	if not args.dry_run:
+		for container in container_map.containers():
+			connection().put_container(container)
+
+	pool = ThreadPool(args.threads)
+	start = time.time()
+
+	listing = [obj["name"] for obj in list_container(source, 10000)]
+	targets = dict((name, container_map.container(name)) for name in listing)
+	print "%d objects in %s" % (len(listing), source)
+	for container in container_map.containers():
+		print "  %d for %s" % (targets.values().count(container), container)
+
+	counts = {"copied": 0, "present": 0, "failed": 0}
+	if not args.dry_run:
+		for batch_start in xrange(0, len(listing), args.batch_size):
+			batch = listing[batch_start:batch_start + args.batch_size]
+			for result in pool.map(lambda name: move(source, targets[name], name, args.delete), batch):
+				counts[result] += 1
+			print "%d of %d done (%d copied, %d already in their shard, %d failed)" % (batch_start + len(batch),
+				len(listing), counts["copied"], counts["present"], counts["failed"])
+	pool.close()
+
+	print "%d objects copied, %d already in their shard, %d failed in %.1fs" % (counts["copied"], counts["present"],
+		counts["failed"], time.time() - start)
+	exit(1 if counts["failed"] else 0)
@@ -9,6 +9,8 @@ import logging, logging.config
 import os
 
 from swift_source import SwiftSource
+from container_map import ContainerMap
+from retry_policy import RetryPolicy, CircuitBreaker
 from config import Config
 
 def upload_path(base, path):
@@ -96,7 +98,15 @@ if __name__ == '__main__':
 		password=config["swift.password"],
 		tenant_id=config["swift.tenant_id"],
 		region_name=config["swift.region_name"],
-		source_bucket=config["source_bucket"])
+		source_bucket=config["source_bucket"],
+		container_map=ContainerMap.from_config(config),
+		retry_policy=RetryPolicy.from_config(config),
+		circuit_breaker=CircuitBreaker.from_config(config),
+		config=config,
+		traffic_class="bulk")
+
+	# throttle.bulk.* limits can be changed while the sync runs by editing the config
+	swift_connection.throttle.watch(lambda: Config(config.section), config.config_paths)
 
 	# get directory
 	upload_path(args.upload_path, "")